@@ -17,9 +17,10 @@
 import sys
 import os
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import action_fail, action_set
 
 from hooks.keystone_utils import (
+    compact_unit_state,
     pause_unit_helper,
     resume_unit_helper,
     register_configs,
@@ -42,9 +43,22 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def compact_unit_state_action(args):
+    """Prune the unit state history and shrink its database.
+
+    Reports the row counts and size of the database before and after.
+    """
+    results = {}
+    for when, stats in zip(('before', 'after'), compact_unit_state()):
+        for key, value in stats.items():
+            results['{}.{}'.format(when, key.replace('_', '-'))] = value
+    action_set(results)
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume,
+           "compact-unit-state": compact_unit_state_action}
 
 
 def main(args):
@@ -22,6 +22,7 @@ sys.path.append('hooks/')
 from charmhelpers.contrib.openstack.utils import (
     do_action_openstack_upgrade,
 )
+from charmhelpers.core.hookenv import flush_log
 
 from keystone_utils import (
     do_openstack_upgrade,
@@ -43,6 +44,7 @@ def openstack_upgrade():
     if (do_action_openstack_upgrade('keystone',
                                     do_openstack_upgrade,
                                     register_configs())):
+        flush_log()
         os.execl('./hooks/config-changed-postupgrade', '')
 
 if __name__ == '__main__':
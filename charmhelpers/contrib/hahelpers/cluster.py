@@ -25,6 +25,7 @@ Helpers for clustering and determining "cluster leadership" and other
 clustering-related helpers.
 """
 
+import json
 import subprocess
 import os
 import time
@@ -34,10 +35,15 @@ from socket import gethostname as get_unit_hostname
 import six
 
 from charmhelpers.core.hookenv import (
+    leader_commit,
+    leader_get,
+    leader_set,
+    local_unit,
     log,
     relation_ids,
     related_units as relation_list,
     relation_get,
+    relation_set,
     config as config_get,
     INFO,
     DEBUG,
@@ -48,7 +54,12 @@ from charmhelpers.core.hookenv import (
 )
 from charmhelpers.core.host import (
     modulo_distribution,
+    service_restart,
+    service_running,
+    service_start,
+    service_stop,
 )
+from charmhelpers.core import unitdata
 from charmhelpers.core.decorators import (
     retry_on_exception,
 )
@@ -404,3 +415,194 @@ def distributed_wait(modulo=None, wait=None, operation_name='operation'):
     log(msg, DEBUG)
     status_set('maintenance', msg)
     time.sleep(calculated_wait)
+
+
+class RestartCoordinator(object):
+    """Rolling restarts across the units of a cluster, a few at a time
+
+    Rather than every unit restarting as soon as it needs to, a unit asks
+    for a restart slot and restarts once the leader grants it one:
+
+    - request() records the services to restart in unitdata and publishes a
+      restart request id on the peer relation;
+    - the leader grants leases on free slots to the oldest requests, keeping
+      them in leader settings as {unit: [request id, time granted]};
+    - a unit holding a lease restarts its services, runs the health check
+      and, once healthy, publishes the request id as done, upon which the
+      leader releases the lease and grants the next one.
+
+    process() drives all of this and should run in every hook, in practice
+    at hook exit, so it writes the leases out itself rather than leaving
+    them to a leader settings commit at hook exit that may already have
+    run.  A unit that is unhealthy after its restart keeps its
+    lease, and retries the health check in later hooks, so that no more
+    units go down meanwhile.  Leases not released within timeout seconds are
+    reclaimed and their units queue again behind the other requests.  Units
+    without peers restart straight away.
+    """
+
+    # Leader settings holding the leases, and the requests whose lease was
+    # reclaimed {unit: request id}, which go to the back of the queue
+    LEASES_KEY = 'restart-leases'
+    EXPIRED_KEY = 'restart-expired'
+    # Peer relation settings of each unit's outstanding and completed request
+    REQUEST_KEY = 'restart-request'
+    DONE_KEY = 'restart-done'
+    # unitdata key of the local unit's state: {'request': id, 'services':
+    # {service: stopstart}, 'restarted': bool}
+    STATE_KEY = 'hahelpers.restart-coordinator'
+
+    def __init__(self, peer_relation='cluster', slots=1, timeout=600,
+                 restart_functions=None, health_check=None):
+        """
+        :param peer_relation: name of the peer relation
+        :param slots: number of units that may restart at the same time
+        :param timeout: seconds after which an unreleased lease is reclaimed
+        :param restart_functions: nonstandard functions to use to restart
+                                  services {svc: func, ...}
+        :param health_check: callable taking the restarted services and
+                             returning whether the unit is healthy, checks
+                             that they are running by default
+        """
+        self.peer_relation = peer_relation
+        self.slots = max(slots or 1, 1)
+        self.timeout = timeout
+        self.restart_functions = restart_functions or {}
+        self.health_check = health_check or self._services_running
+
+    @staticmethod
+    def _services_running(services):
+        return all(service_running(s) for s in services)
+
+    def _state(self):
+        return unitdata.kv().get(self.STATE_KEY) or {}
+
+    def _save_state(self, state):
+        db = unitdata.kv()
+        db.set(self.STATE_KEY, state)
+        db.flush()
+
+    def _publish(self, settings):
+        for rid in relation_ids(self.peer_relation):
+            relation_set(relation_id=rid, relation_settings=settings)
+
+    def _peers(self):
+        """Return {unit: (relation id)} of the peer units"""
+        return dict((unit, rid)
+                    for rid in relation_ids(self.peer_relation)
+                    for unit in relation_list(rid))
+
+    def request(self, services):
+        """Ask for a restart slot to restart services
+
+        :param services: {service: stopstart} of the services to restart
+        """
+        state = self._state()
+        pending = state.setdefault('services', {})
+        for service_name, stopstart in six.iteritems(services):
+            pending[service_name] = bool(
+                stopstart or pending.get(service_name))
+        if not self._peers():
+            self._restart(state)
+            self._save_state({})
+            return
+        # A unit still holding a slot restarts again under the same request
+        state['restarted'] = False
+        if not state.get('request'):
+            state['request'] = '{:.6f}'.format(time.time())
+            self._publish({self.REQUEST_KEY: state['request']})
+            log('Requested a slot to restart {}'.format(
+                ', '.join(sorted(pending))), level=INFO)
+        self._save_state(state)
+        self.process()
+
+    def process(self):
+        """Grant and release leases on the leader, and restart if this unit
+        holds a lease"""
+        if juju_is_leader():
+            self._grant()
+        state = self._state()
+        request = state.get('request')
+        if not request:
+            return
+        lease = self._leases().get(local_unit())
+        if not lease or lease[0] != request:
+            log('Waiting for a slot to restart {}'.format(
+                ', '.join(sorted(state['services']))), level=DEBUG)
+            return
+        if not state.get('restarted'):
+            self._restart(state)
+            state['restarted'] = True
+            self._save_state(state)
+        if not self.health_check(list(state['services'])):
+            log('Unhealthy after restart, keeping the restart slot',
+                level=WARNING)
+            return
+        log('Restarted {}, releasing the restart slot'.format(
+            ', '.join(sorted(state['services']))), level=INFO)
+        self._save_state({})
+        self._publish({self.DONE_KEY: request, self.REQUEST_KEY: None})
+        if juju_is_leader():
+            self._grant()
+
+    def _restart(self, state):
+        for service_name, stopstart in sorted(six.iteritems(
+                state.get('services', {}))):
+            if service_name in self.restart_functions:
+                self.restart_functions[service_name](service_name)
+            elif stopstart:
+                service_stop(service_name)
+                service_start(service_name)
+            else:
+                service_restart(service_name)
+
+    def _leases(self):
+        return json.loads(leader_get(self.LEASES_KEY) or '{}')
+
+    def _requests(self):
+        """Return {unit: outstanding request id} of this unit and its peers"""
+        requests = {}
+        for unit, rid in six.iteritems(self._peers()):
+            request = relation_get(self.REQUEST_KEY, unit=unit, rid=rid)
+            done = relation_get(self.DONE_KEY, unit=unit, rid=rid)
+            if request and request != done:
+                requests[unit] = request
+        request = self._state().get('request')
+        if request:
+            requests[local_unit()] = request
+        return requests
+
+    def _grant(self):
+        leases = self._leases()
+        expired = json.loads(leader_get(self.EXPIRED_KEY) or '{}')
+        requests = self._requests()
+        now = time.time()
+        granted = {}
+        for unit, lease in six.iteritems(leases):
+            if requests.get(unit) != lease[0]:
+                continue
+            if now - lease[1] < self.timeout:
+                granted[unit] = lease
+            else:
+                log('Reclaiming the restart slot of {}'.format(unit),
+                    level=WARNING)
+                expired[unit] = lease[0]
+        expired = dict((unit, request) for unit, request
+                       in six.iteritems(expired)
+                       if requests.get(unit) == request)
+        queue = sorted((expired.get(unit) == request, request, unit)
+                       for unit, request in six.iteritems(requests)
+                       if unit not in granted)
+        for _, request, unit in queue:
+            if len(granted) >= self.slots:
+                break
+            log('Granting a restart slot to {}'.format(unit), level=INFO)
+            granted[unit] = [request, now]
+        settings = {}
+        if granted != leases:
+            settings[self.LEASES_KEY] = json.dumps(granted, sort_keys=True)
+        if expired != json.loads(leader_get(self.EXPIRED_KEY) or '{}'):
+            settings[self.EXPIRED_KEY] = json.dumps(expired, sort_keys=True)
+        if settings:
+            leader_set(settings)
+            leader_commit()
@@ -12,13 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import os
+import shutil
+import tempfile
+
+from contextlib import contextmanager
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
+from charmhelpers.core.host import (
+    record_changed_paths,
+    track_path_changes,
+)
 from charmhelpers.core.hookenv import (
+    charm_dir,
     log,
+    settings_generation,
     ERROR,
     INFO,
     TRACE
@@ -26,20 +37,158 @@ from charmhelpers.core.hookenv import (
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        FileSystemBytecodeCache,
+        FileSystemLoader,
+        ChoiceLoader,
+        Environment,
+        exceptions,
+    )
 except ImportError:
     apt_update(fatal=True)
     if six.PY2:
         apt_install('python-jinja2', fatal=True)
     else:
         apt_install('python3-jinja2', fatal=True)
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import (
+        FileSystemBytecodeCache,
+        FileSystemLoader,
+        ChoiceLoader,
+        Environment,
+        exceptions,
+    )
 
 
 class OSConfigException(Exception):
     pass
 
 
+# Results of the context generators run within a context_cache() block,
+# {id(generator): (generator, result)}, so that a generator shared by several
+# config files runs once per write_all().  Contexts also read certificates,
+# keys and installed packages that the hook changes between passes, so the
+# results are dropped at the end of the block, and whenever the hook writes
+# relation or leader settings.
+_context_cache = {}
+_context_cache_generation = [None]
+# Depth of the context_cache() blocks in progress
+_context_cache_depth = [0]
+
+
+@contextmanager
+def context_cache():
+    """Run each context generator at most once within the block"""
+    _context_cache_depth[0] += 1
+    try:
+        yield
+    finally:
+        _context_cache_depth[0] -= 1
+        if not _context_cache_depth[0]:
+            flush_context_cache()
+
+
+def generate_context(generator):
+    """Return the result of the context generator, running it at most once
+    within a context_cache() block until relation or leader settings
+    change"""
+    if not _context_cache_depth[0]:
+        return generator()
+    generation = settings_generation()
+    if _context_cache_generation[0] != generation:
+        flush_context_cache()
+        _context_cache_generation[0] = generation
+    try:
+        return _context_cache[id(generator)][1]
+    except KeyError:
+        pass
+    result = generator()
+    _context_cache[id(generator)] = (generator, result)
+    return result
+
+
+def flush_context_cache():
+    """Forget the results of all context generators"""
+    _context_cache.clear()
+
+
+# Directory under the charm holding compiled templates, one subdirectory per
+# charm revision.
+BYTECODE_CACHE_DIR = '.jinja-bytecode'
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Compiled templates kept on disk across hooks
+
+    Entries are keyed on the template's name, path and modification time.
+    The cache lives in a directory per charm revision, see charm_revision(),
+    and the directories of other revisions are removed when it is opened.
+    """
+
+    def get_cache_key(self, name, filename=None):
+        key = super(TemplateBytecodeCache, self).get_cache_key(name, filename)
+        if filename is None:
+            return key
+        try:
+            return '{}-{}'.format(key, int(os.stat(filename).st_mtime))
+        except OSError:
+            return key
+
+
+_bytecode_cache = []
+
+
+def charm_revision(root):
+    """Return a name for the revision of the charm deployed at root
+
+    The revision file is only present in charms built with one, otherwise
+    the charm URL juju records in .juju-charm identifies the revision.
+    """
+    try:
+        with open(os.path.join(root, 'revision')) as f:
+            revision = f.read().strip()
+        if revision:
+            return revision
+    except IOError:
+        pass
+    try:
+        with open(os.path.join(root, '.juju-charm'), 'rb') as f:
+            url = f.read().strip()
+        if url:
+            return hashlib.sha1(url).hexdigest()[:12]
+    except IOError:
+        pass
+    return '0'
+
+
+def get_bytecode_cache():
+    """Return the TemplateBytecodeCache of the running charm revision, or
+    None outside of a charm or where the cache cannot be created"""
+    if _bytecode_cache:
+        return _bytecode_cache[0]
+    cache = None
+    root = charm_dir()
+    if root:
+        revision = charm_revision(root)
+        base = os.path.join(root, BYTECODE_CACHE_DIR)
+        directory = os.path.join(base, revision)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            for stale in os.listdir(base):
+                if stale != revision:
+                    shutil.rmtree(os.path.join(base, stale),
+                                  ignore_errors=True)
+            cache = TemplateBytecodeCache(directory)
+        except OSError as e:
+            log('Not caching compiled templates: {}'.format(e), level=INFO)
+    _bytecode_cache.append(cache)
+    return cache
+
+
+# Loaders built by get_loader(), {(templates_dir, os_release): loader}
+_loaders = {}
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -61,6 +210,10 @@ def get_loader(templates_dir, os_release):
         jinja2.FilesystemLoaders, ordered in descending
         order by OpenStack release.
     """
+    try:
+        return _loaders[(templates_dir, os_release)]
+    except KeyError:
+        pass
     tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
                  for rel in six.itervalues(OPENSTACK_CODENAMES)]
 
@@ -85,7 +238,42 @@ def get_loader(templates_dir, os_release):
     # lots in production even when debugging.
     log('Creating choice loader with dirs: %s' %
         [l.searchpath for l in loaders], level=TRACE)
-    return ChoiceLoader(loaders)
+    loader = _loaders[(templates_dir, os_release)] = ChoiceLoader(loaders)
+    return loader
+
+
+def _write_if_changed(path, data):
+    """Atomically replace the content of path with data unless it already
+    holds it, keeping the mode and ownership of the file
+
+    :returns: whether path was written
+    """
+    path = os.path.realpath(path)
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+        st = os.stat(path)
+        mode, uid, gid = st.st_mode & 0o7777, st.st_uid, st.st_gid
+    except (IOError, OSError):
+        umask = os.umask(0)
+        os.umask(umask)
+        mode, uid, gid = 0o666 & ~umask, None, None
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        if uid is not None:
+            os.chown(tmp, uid, gid)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return True
 
 
 class OSConfigTemplate(object):
@@ -109,7 +297,7 @@ class OSConfigTemplate(object):
     def context(self):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = generate_context(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -245,13 +433,15 @@ class OSConfigRenderer(object):
             contexts=contexts,
             config_template=config_template
         )
+        track_path_changes([config_file])
         log('Registered config file: {}'.format(config_file),
             level=INFO)
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(loader=loader,
+                                         bytecode_cache=get_bytecode_cache())
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -313,6 +503,10 @@ class OSConfigRenderer(object):
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is only written, atomically, if its content changes.
+
+        :returns: set holding config_file if it changed, empty otherwise
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
@@ -322,16 +516,26 @@ class OSConfigRenderer(object):
         if six.PY3:
             _out = _out.encode('UTF-8')
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
-
+        if not _write_if_changed(config_file, _out):
+            log('Template %s unchanged.' % config_file, level=INFO)
+            return set()
+        record_changed_paths([config_file])
         log('Wrote template %s.' % config_file, level=INFO)
+        return set([config_file])
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        Context generators shared by several config files run once.
+
+        :returns: set of the config files that changed
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        changed = set()
+        with context_cache():
+            for k in six.iterkeys(self.templates):
+                changed |= self.write(k)
+        return changed
 
     def set_release(self, openstack_release):
         """
@@ -341,14 +545,16 @@ class OSConfigRenderer(object):
         self._tmpl_env = None
         self.openstack_release = openstack_release
         self._get_tmpl_env()
+        flush_context_cache()
 
     def complete_contexts(self):
         '''
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        [interfaces.extend(i.complete_contexts())
-         for i in six.itervalues(self.templates)]
+        with context_cache():
+            [interfaces.extend(i.complete_contexts())
+             for i in six.itervalues(self.templates)]
         return interfaces
 
     def get_incomplete_context_data(self, interfaces):
@@ -1429,7 +1429,7 @@ def make_assess_status_func(*args, **kwargs):
 
 
 def pausable_restart_on_change(restart_map, stopstart=False,
-                               restart_functions=None):
+                               restart_functions=None, deferred=False):
     """A restart_on_change decorator that checks to see if the unit is
     paused. If it is paused then the decorated function doesn't fire.
 
@@ -1453,6 +1453,7 @@ def pausable_restart_on_change(restart_map, stopstart=False,
     @param f: the function to decorate
     @param restart_map: the restart map {conf_file: [services]}
     @param stopstart: DEFAULT false; whether to stop, start or just restart
+    @param deferred: DEFAULT false; whether to defer restarts to hook exit
     @returns decorator to use a restart_on_change with pausability
     """
     def wrap(f):
@@ -1463,7 +1464,7 @@ def pausable_restart_on_change(restart_map, stopstart=False,
             # otherwise, normal restart_on_change functionality
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, deferred)
         return wrapped_f
     return wrap
 
@@ -19,11 +19,14 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import atexit as _interpreter_atexit
 import copy
 from distutils.version import LooseVersion
 from functools import wraps
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 import glob
+import inspect
 import os
 import json
 import yaml
@@ -32,6 +35,7 @@ import subprocess
 import sys
 import errno
 import tempfile
+import threading
 from subprocess import CalledProcessError
 
 import six
@@ -49,7 +53,90 @@ DEBUG = "DEBUG"
 TRACE = "TRACE"
 MARKER = object()
 
-cache = {}
+
+class FunctionCache(object):
+    """Results of @cached functions, kept for the life of the hook
+
+    Every function has its own table keyed on the tuple of its argument
+    values, however they were passed.  Entries are also indexed by the unit
+    and relation id arguments they were made with so that flush() drops them
+    with a direct lookup.  Hits and misses are counted per table.
+    """
+
+    # Argument names holding a unit or a relation id
+    INDEXED_ARGS = ('unit', 'service_or_unit', 'rid', 'relid', 'relation_id')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.tables = {}
+        self.hits = {}
+        self.misses = {}
+        self._index = {}
+
+    def get(self, table, key):
+        """Return a cached value, raising KeyError on a miss"""
+        try:
+            value = self.tables[table][key]
+        except KeyError:
+            self.misses[table] = self.misses.get(table, 0) + 1
+            raise
+        self.hits[table] = self.hits.get(table, 0) + 1
+        return value
+
+    def set(self, table, key, value, tags=()):
+        """Cache a value, indexed by each unit or relation id in tags"""
+        self.tables.setdefault(table, {})[key] = value
+        for tag in tags:
+            if tag:
+                self._index.setdefault(tag, set()).add((table, key))
+
+    def flush(self, tag):
+        """Drop every entry indexed by the unit or relation id tag"""
+        for table, key in self._index.pop(tag, ()):
+            self.tables.get(table, {}).pop(key, None)
+
+    def flush_table(self, table):
+        """Drop every entry of one table"""
+        self.tables.pop(table, None)
+
+    def stats(self):
+        """Return {table name: {'hits': n, 'misses': n, 'entries': n}}"""
+        return dict(
+            (getattr(table, '__name__', table),
+             {'hits': self.hits.get(table, 0),
+              'misses': self.misses.get(table, 0),
+              'entries': len(self.tables.get(table, {}))})
+            for table in set(self.tables) | set(self.hits) | set(self.misses))
+
+
+cache = FunctionCache()
+
+# FunctionCache table holding the settings of remote units fetched by
+# prefetch_relations(), keyed on (relation id, unit).
+PREFETCHED_SETTINGS = 'prefetched-settings'
+
+
+def _freeze(value):
+    """Return a hashable equivalent of value for use in a cache key"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+def _argspec(func):
+    if six.PY3:
+        spec = inspect.getfullargspec(func)
+        return spec.args, spec.defaults, spec.varargs, spec.varkw
+    spec = inspect.getargspec(func)
+    return spec.args, spec.defaults, spec.varargs, spec.keywords
 
 
 def cached(func):
@@ -65,39 +152,147 @@ def cached(func):
 
     will cache the result of unit_get + 'test' for future calls.
     """
+    argnames, defaults, varargs, varkw = _argspec(func)
+    defaults = dict(zip(reversed(argnames), reversed(defaults or ())))
+    indexed = [name for name in argnames if name in cache.INDEXED_ARGS]
+
+    def _key(args, kwargs):
+        if any((varargs, varkw, len(args) > len(argnames),
+                any(name not in argnames for name in kwargs))):
+            return (_freeze(args), _freeze(kwargs)), ()
+        values = dict(defaults)
+        values.update(zip(argnames, args))
+        values.update(kwargs)
+        return (tuple(_freeze(values.get(name)) for name in argnames),
+                [values.get(name) for name in indexed])
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = json.dumps((func, args, kwargs), sort_keys=True, default=str)
+        key, tags = _key(args, kwargs)
         try:
-            return cache[key]
+            return cache.get(func, key)
         except KeyError:
             pass  # Drop out of the exception handler scope.
         res = func(*args, **kwargs)
-        cache[key] = res
+        cache.set(func, key, res, tags)
         return res
     wrapper._wrapped = func
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache made for the unit or relation
+    id key """
+    cache.flush(key)
+    _settings_changed()
+
+
+# Count of the writes to relation or leader settings made by this hook, so
+# that anything derived from those settings can tell when to recompute.
+_settings_generation = [0]
+
+
+def _settings_changed():
+    _settings_generation[0] += 1
+
+
+def settings_generation():
+    """Return a number that changes whenever relation or leader settings are
+    written, or cached relation data is flushed"""
+    return _settings_generation[0]
+
+
+def cache_stats():
+    """Return the function cache hit and miss counters per function"""
+    return cache.stats()
+
+
+# Log levels from least to most severe; juju-log defaults to INFO
+LOG_LEVELS = (TRACE, DEBUG, INFO, WARNING, ERROR, CRITICAL)
+# Messages at these levels are written out straight away, so that they are
+# not lost should the hook be killed
+LOG_FLUSH_LEVELS = (WARNING, ERROR, CRITICAL)
+# Write the buffer out once it holds this many bytes of messages
+LOG_BUFFER_SIZE = 32 * 1024
+
+_default_log_level = os.environ.get('CHARM_LOG_LEVEL', TRACE).upper()
+_log_level = _default_log_level
+_log_buffer = []
+_log_buffer_size = [0]
+_log_lock = threading.RLock()
+_log_flush_registered = [False]
+
+
+def _log_severity(level):
+    try:
+        return LOG_LEVELS.index((level or INFO).upper())
+    except ValueError:
+        return LOG_LEVELS.index(INFO)
+
+
+def set_log_level(level):
+    """Drop log messages less severe than level
+
+    Defaults to the CHARM_LOG_LEVEL environment variable, or TRACE so that
+    everything is logged.  A level of None restores the default.
+    """
+    global _log_level
+    _log_level = (level or _default_log_level).upper()
 
 
 def log(message, level=None):
-    """Write a message to the juju log"""
+    """Write a message to the juju log
+
+    Messages below the configured log level are dropped.  The rest are
+    buffered and written with as few juju-log calls as possible when the
+    hook exits, the buffer fills up or a WARNING or more severe message
+    arrives.
+    """
+    if _log_severity(level) < _log_severity(_log_level):
+        return
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    with _log_lock:
+        if not _log_flush_registered[0]:
+            atexit(flush_log)
+            _log_flush_registered[0] = True
+        _log_buffer.append((level, message))
+        _log_buffer_size[0] += len(message)
+        full = _log_buffer_size[0] >= LOG_BUFFER_SIZE
+        if full or (level or INFO).upper() in LOG_FLUSH_LEVELS:
+            flush_log()
+
+
+def flush_log():
+    """Write out buffered log messages
+
+    Consecutive messages at the same level go out in a single juju-log call.
+    """
+    with _log_lock:
+        pending = list(_log_buffer)
+        del _log_buffer[:]
+        _log_buffer_size[0] = 0
+        _log_flush_registered[0] = False
+        start = 0
+        for end in range(1, len(pending) + 1):
+            if end == len(pending) or pending[end][0] != pending[start][0]:
+                _juju_log('\n'.join(m for _, m in pending[start:end]),
+                          pending[start][0])
+                start = end
+
+
+# Whatever is still buffered when the interpreter exits, including after an
+# unhandled exception, is written out too when running in a hook, or a
+# juju-run, context.  Elsewhere, e.g. in unit tests, nothing is left to
+# print after the process is done.
+if 'JUJU_CONTEXT_ID' in os.environ:
+    _interpreter_atexit.register(flush_log)
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
     command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
@@ -420,8 +615,18 @@ def config(scope=None):
 
 
 @cached
-def relation_get(attribute=None, unit=None, rid=None):
-    """Get relation information"""
+def _relation_get(attribute=None, unit=None, rid=None):
+    """Get published relation information"""
+    try:
+        settings = cache.get(PREFETCHED_SETTINGS, (rid, unit))
+    except KeyError:
+        pass
+    else:
+        if settings is None:
+            return None
+        if attribute:
+            return settings.get(attribute)
+        return dict(settings)
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -439,14 +644,102 @@ def relation_get(attribute=None, unit=None, rid=None):
         raise
 
 
+def relation_get(attribute=None, unit=None, rid=None):
+    """Get relation information
+
+    Settings of the local unit include any relation_set() still queued by
+    batch_relation_set().
+    """
+    settings = _relation_get(attribute=attribute, unit=unit, rid=rid)
+    if _relation_set_queue is None or unit != local_unit():
+        return settings
+    queued = _relation_set_queue.get(rid or relation_id())
+    if not queued:
+        return settings
+    if attribute:
+        return queued.get(attribute, settings)
+    settings = dict(settings or {})
+    for key, value in queued.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+    return settings
+
+
+# unitdata key recording whether relation-set takes --file, and for which
+# version of juju that was probed.
+RELATION_SET_FILE_KEY = 'hookenv.relation-set-accepts-file'
+
+
+@cached
+def _relation_set_accepts_file():
+    """Does relation-set take --file
+
+    Probed with relation-set --help once per hook, and only once per version
+    of juju where JUJU_VERSION is set.
+    """
+    version = os.environ.get('JUJU_VERSION')
+    if version:
+        from charmhelpers.core import unitdata
+        kv = unitdata.kv()
+        probed = kv.get(RELATION_SET_FILE_KEY)
+        if probed and probed.get('version') == version:
+            return probed['accepts-file']
+    accepts_file = "--file" in subprocess.check_output(
+        ['relation-set', '--help'], universal_newlines=True)
+    if version:
+        kv.set(RELATION_SET_FILE_KEY,
+               {'version': version, 'accepts-file': accepts_file})
+        kv.flush()
+    return accepts_file
+
+
+# Settings queued per relation id by relation_set() once
+# batch_relation_set() is called, None when writes go straight to juju.
+_relation_set_queue = None
+
+
+def batch_relation_set():
+    """Queue relation_set() calls until the hook exits
+
+    All writes to a relation id are merged and written with a single
+    relation-set by flush_relation_set(), which runs when the hook exits.
+    relation_get() of the local unit sees the queued settings.
+    """
+    global _relation_set_queue
+    if _relation_set_queue is None:
+        _relation_set_queue = OrderedDict()
+        atexit(_end_relation_set_batch)
+
+
+def flush_relation_set():
+    """Write the settings queued by batch_relation_set()
+
+    Settings matching what the local unit already publishes are dropped and
+    relations left with nothing to change are not written at all.
+    """
+    if not _relation_set_queue:
+        return
+    unit = local_unit()
+    while _relation_set_queue:
+        relid, settings = _relation_set_queue.popitem(last=False)
+        published = _relation_get(unit=unit, rid=relid) or {}
+        settings = dict((key, value) for key, value in settings.items()
+                        if published.get(key) != value)
+        if settings:
+            _relation_set(relid, settings)
+
+
+def _end_relation_set_batch():
+    global _relation_set_queue
+    flush_relation_set()
+    _relation_set_queue = None
+
+
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
     """Set relation information for the current unit"""
     relation_settings = relation_settings if relation_settings else {}
-    relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"], universal_newlines=True)
-    if relation_id is not None:
-        relation_cmd_line.extend(('-r', relation_id))
     settings = relation_settings.copy()
     settings.update(kwargs)
     for key, value in settings.items():
@@ -454,7 +747,20 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # sites pass in things like dicts or numbers.
         if value is not None:
             settings[key] = "{}".format(value)
-    if accepts_file:
+    if _relation_set_queue is not None:
+        relid = relation_id or os.environ.get('JUJU_RELATION_ID')
+        if relid:
+            _relation_set_queue.setdefault(relid, {}).update(settings)
+            _settings_changed()
+            return
+    _relation_set(relation_id, settings)
+
+
+def _relation_set(relation_id, settings):
+    relation_cmd_line = ['relation-set']
+    if relation_id is not None:
+        relation_cmd_line.extend(('-r', relation_id))
+    if _relation_set_accepts_file():
         # --file was introduced in Juju 1.23.2. Use it by default if
         # available, since otherwise we'll break if the relation data is
         # too big. Ideally we should tell relation-set to read the data from
@@ -509,6 +815,41 @@ def related_units(relid=None):
         subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
 
 
+def prefetch_relations(reltypes, processes=4):
+    """Fetch the ids, units and unit settings of relations in one pass
+
+    The relation-ids, relation-list and relation-get hook tools are run for
+    every relation of the given types and all their units, up to processes
+    of them at a time, and their results cached so that later calls to
+    relation_ids(reltype), related_units(relid) and relation_get() for any
+    attribute of those units do not fork hook tools at all.  What the local
+    unit publishes on each relation is fetched as well, so that
+    flush_relation_set() can drop unchanged settings without forking.
+
+    :param reltypes: names of the relations to fetch
+    :param processes: maximum number of hook tools run concurrently
+    """
+    pool = ThreadPool(processes)
+    try:
+        relids = []
+        for ids in pool.map(relation_ids, reltypes):
+            relids.extend(ids)
+        units = [(relid, unit)
+                 for relid, rel_units in zip(relids,
+                                             pool.map(related_units, relids))
+                 for unit in rel_units + [local_unit()]]
+        settings = pool.map(
+            lambda relid_unit: _relation_get(rid=relid_unit[0],
+                                             unit=relid_unit[1]),
+            units)
+    finally:
+        pool.close()
+        pool.join()
+    for (relid, unit), unit_settings in zip(units, settings):
+        cache.set(PREFETCHED_SETTINGS, (relid, unit), unit_settings,
+                  tags=(relid, unit))
+
+
 @cached
 def relation_for_unit(unit=None, rid=None):
     """Get the json represenation of a unit's relation"""
@@ -848,6 +1189,10 @@ class Hooks(object):
             except SystemExit as x:
                 if x.code is None or x.code == 0:
                     _run_atexit()
+                flush_log()
+                raise
+            except BaseException:
+                flush_log()
                 raise
             _run_atexit()
         else:
@@ -1014,20 +1359,16 @@ def is_leader():
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
-def leader_get(attribute=None):
-    """Juju leader get value(s)"""
-    cmd = ['leader-get', '--format=json'] + [attribute or '-']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+def _leader_get_all():
+    cmd = ['leader-get', '--format=json', '-']
+    return json.loads(subprocess.check_output(cmd).decode('UTF-8')) or {}
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
-def leader_set(settings=None, **kwargs):
-    """Juju leader set value(s)"""
+def _leader_set(settings):
     # Don't log secrets.
     # log("Juju leader-set '%s'" % (settings), level=DEBUG)
     cmd = ['leader-set']
-    settings = settings or {}
-    settings.update(kwargs)
     for k, v in settings.items():
         if v is None:
             cmd.append('{}='.format(k))
@@ -1036,6 +1377,92 @@ def leader_set(settings=None, **kwargs):
     subprocess.check_call(cmd)
 
 
+class LeaderSettings(object):
+    """Leader settings, read once and written back once per hook
+
+    All settings are loaded with a single leader-get the first time any of
+    them is read and every later read is served from memory.  Writes update
+    the in-memory copy straight away and are handed to juju with a single
+    leader-set by commit(), which runs when the hook exits.
+
+    Leadership is confirmed with is-leader before the first write is queued.
+    A unit that is not the leader writes through so that juju rejects the
+    change exactly as it always has.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self._settings = None
+        self._pending = {}
+        self._leader = False
+
+    def get(self, attribute=None):
+        with self._lock:
+            if self._settings is None:
+                self._settings = _leader_get_all()
+            if attribute is None:
+                return dict(self._settings)
+            return self._settings.get(attribute)
+
+    def set(self, settings):
+        with self._lock:
+            if not self._leader:
+                if not is_leader():
+                    self._settings = None
+                    _settings_changed()
+                    _leader_set(settings)
+                    return
+                self._leader = True
+                atexit(self.commit)
+            self.get()
+            for k, v in settings.items():
+                if v is None:
+                    self._settings.pop(k, None)
+                else:
+                    self._settings[k] = '{}'.format(v)
+            self._pending.update(settings)
+            _settings_changed()
+
+    def commit(self):
+        """Write queued settings with a single leader-set"""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._leader = False
+            if pending:
+                _leader_set(pending)
+
+
+leader_settings = LeaderSettings()
+# Writes queued by a hook that fails, or by a script run outside the hook
+# framework, still reach juju when the interpreter exits.
+_interpreter_atexit.register(leader_settings.commit)
+
+
+def leader_get(attribute=None):
+    """Juju leader get value(s)"""
+    return leader_settings.get(attribute)
+
+
+def leader_set(settings=None, **kwargs):
+    """Juju leader set value(s)
+
+    The values are visible to leader_get straight away but only reach juju
+    when the hook exits or leader_commit() is called.
+    """
+    settings = dict(settings or {})
+    settings.update(kwargs)
+    leader_settings.set(settings)
+
+
+def leader_commit():
+    """Write leader settings queued by leader_set to juju now"""
+    leader_settings.commit()
+
+
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
 def payload_register(ptype, klass, pid):
     """ is used while a hook is running to let Juju know that a
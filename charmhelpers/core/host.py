@@ -28,13 +28,14 @@ import random
 import string
 import subprocess
 import hashlib
+import time
 import functools
 import itertools
 import six
 
 from contextlib import contextmanager
 from collections import OrderedDict
-from .hookenv import log, DEBUG, local_unit
+from .hookenv import atexit, charm_dir, log, DEBUG, local_unit
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
 
@@ -58,6 +59,51 @@ elif __platform__ == "centos":
 
 UPDATEDB_PATH = '/etc/updatedb.conf'
 
+# Services whose restart has been deferred to the end of the hook, see
+# defer_restarts(), mapped to (stopstart, restart_function).
+_deferred_restarts = OrderedDict()
+
+# unitdata key holding [[service, stopstart], ...] of the deferred restarts
+# not yet run, so that those of a failed hook are run by the next hook, see
+# resume_deferred_restarts().
+DEFERRED_RESTARTS_KEY = 'host.deferred-restarts'
+
+# Restart maps of the restart_on_change() calls in progress, innermost last.
+_active_restart_maps = []
+
+# Callable taking over the restarts queued by defer_restarts(), see
+# set_deferred_restart_handler().
+_deferred_restart_handler = [None]
+
+# Paths whose writes by the charm are reported with record_changed_paths(),
+# see track_path_changes(), and the paths reported during each
+# restart_on_change() call in progress, innermost last.
+_tracked_paths = set()
+_changed_paths = []
+
+
+def track_path_changes(paths):
+    """Declare that the charm reports its writes to paths with
+    record_changed_paths()
+
+    restart_on_change() then takes a reported change as it is rather than
+    hashing the file again.  The paths are still hashed before and after, a
+    cheap stat through stat_file_hash() while they are unchanged, so that
+    changes made by other writers are not missed.
+    """
+    _tracked_paths.update(paths)
+
+
+def record_changed_paths(paths):
+    """Report that paths were changed, to the restart_on_change() calls in
+    progress"""
+    for changed in _changed_paths:
+        changed.update(paths)
+    for path in paths:
+        if _path_hashes.pop(path, None):
+            _path_hashes_state['dirty'] = True
+
+
 def service_start(service_name, **kwargs):
     """Start a system service.
 
@@ -552,6 +598,7 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
             if six.PY3 and isinstance(content, six.string_types):
                 content = content.encode('UTF-8')
             target.write(content)
+        record_changed_paths([path])
         return
     # the contents were the same, but we might still need to change the
     # ownership.
@@ -641,16 +688,87 @@ def file_hash(path, hash_type='md5'):
         return None
 
 
+# unitdata key holding {filename: [(inode, size, mtime, ctime), md5]} of the
+# files hashed by path_hash().
+PATH_HASHES_KEY = 'host.path-hashes'
+# Files modified less than this many seconds before they are hashed may
+# change again without their mtime or ctime moving, so their hash is not
+# kept.
+PATH_HASH_RACE_WINDOW = 2
+
+_path_hashes = {}
+_path_hashes_state = {'loaded': False, 'dirty': False}
+
+
+def _load_path_hashes():
+    _path_hashes_state['loaded'] = True
+    if not charm_dir():
+        return
+    from charmhelpers.core import unitdata
+    _path_hashes.update(unitdata.kv().get(PATH_HASHES_KEY) or {})
+    atexit(_save_path_hashes)
+
+
+def _save_path_hashes():
+    if not _path_hashes_state['dirty']:
+        return
+    from charmhelpers.core import unitdata
+    db = unitdata.kv()
+    db.set(PATH_HASHES_KEY, _path_hashes)
+    db.flush()
+    _path_hashes_state['dirty'] = False
+
+
+def _stat_key(st):
+    # The ctime cannot be set back, unlike the mtime restored by cp -p or
+    # rsync -t, so it also catches same-size rewrites under an old mtime.
+    times = [getattr(st, 'st_mtime_ns', None),
+             getattr(st, 'st_ctime_ns', None)]
+    if None in times:
+        times = [int(st.st_mtime * 1e9), int(st.st_ctime * 1e9)]
+    return [st.st_ino, st.st_size] + times
+
+
+def stat_file_hash(path):
+    """Return the md5 of the contents of path, or None if not found
+
+    The file is only read when its (inode, size, mtime, ctime) differ from
+    when it was last hashed.  Hashes are kept across hooks in unitdata.
+    """
+    if not _path_hashes_state['loaded']:
+        _load_path_hashes()
+    try:
+        st = os.stat(path)
+    except OSError:
+        if _path_hashes.pop(path, None):
+            _path_hashes_state['dirty'] = True
+        return None
+    key = _stat_key(st)
+    cached = _path_hashes.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = file_hash(path)
+    if time.time() - max(st.st_mtime, st.st_ctime) > PATH_HASH_RACE_WINDOW:
+        _path_hashes[path] = [key, digest]
+        _path_hashes_state['dirty'] = True
+    elif _path_hashes.pop(path, None):
+        _path_hashes_state['dirty'] = True
+    return digest
+
+
 def path_hash(path):
     """Generate a hash checksum of all files matching 'path'. Standard
     wildcards like '*' and '?' are supported, see documentation for the 'glob'
     module for more information.
 
+    Files are only read when their (inode, size, mtime, ctime) changed since
+    they were last hashed, see stat_file_hash().
+
     :return: dict: A { filename: hash } dictionary for all matched files.
                    Empty if none found.
     """
     return {
-        filename: file_hash(filename)
+        filename: stat_file_hash(filename)
         for filename in glob.iglob(path)
     }
 
@@ -675,7 +793,8 @@ class ChecksumError(ValueError):
     pass
 
 
-def restart_on_change(restart_map, stopstart=False, restart_functions=None):
+def restart_on_change(restart_map, stopstart=False, restart_functions=None,
+                      deferred=False):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example::
@@ -694,10 +813,15 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
     or removed. Standard wildcards are supported, see documentation
     for the 'glob' module for more information.
 
+    Functions which may be called repeatedly within a hook, e.g. once per
+    related unit, can pass deferred=True so that the restarts they trigger
+    are coalesced, see restart_on_change_helper().
+
     @param restart_map: {path_file_name: [service_name, ...]
     @param stopstart: DEFAULT false; whether to stop, start OR restart
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param deferred: DEFAULT false; whether to defer restarts to hook exit
     @returns result from decorated function
     """
     def wrap(f):
@@ -705,46 +829,216 @@ def restart_on_change(restart_map, stopstart=False, restart_functions=None):
         def wrapped_f(*args, **kwargs):
             return restart_on_change_helper(
                 (lambda: f(*args, **kwargs)), restart_map, stopstart,
-                restart_functions)
+                restart_functions, deferred)
         return wrapped_f
     return wrap
 
 
 def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
-                             restart_functions=None):
+                             restart_functions=None, deferred=False):
     """Helper function to perform the restart_on_change function.
 
     This is provided for decorators to restart services if files described
     in the restart_map have changed after an invocation of lambda_f().
+    Files are hashed before and after, those registered with
+    track_path_changes() also count as changed when their writer reports so
+    and are then not hashed again.
+
+    When deferred, the files are not checked at all if an enclosing
+    restart_on_change() already covers the whole restart_map as it will
+    restart the services once it completes.  Otherwise changed services are
+    queued with defer_restarts() and restarted once at hook exit.
 
     @param lambda_f: function to call.
     @param restart_map: {file: [service, ...]}
     @param stopstart: whether to stop, start or restart a service
     @param restart_functions: nonstandard functions to use to restart services
                               {svc: func, ...}
+    @param deferred: whether to defer restarts to hook exit
     @returns result of lambda_f()
     """
     if restart_functions is None:
         restart_functions = {}
+    if deferred and _restart_map_covered(restart_map):
+        return lambda_f()
     checksums = {path: path_hash(path) for path in restart_map}
-    r = lambda_f()
+    changed = set()
+    _active_restart_maps.append(restart_map)
+    _changed_paths.append(changed)
+    try:
+        r = lambda_f()
+    finally:
+        _active_restart_maps.pop()
+        _changed_paths.pop()
+    stale = [path for path in checksums
+             if not (path in changed and path in _tracked_paths)]
+    changed.update(path for path in stale
+                   if path_hash(path) != checksums[path])
     # create a list of lists of the services to restart
     restarts = [restart_map[path]
                 for path in restart_map
-                if path_hash(path) != checksums[path]]
+                if path in changed]
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
     if services_list:
-        actions = ('stop', 'start') if stopstart else ('restart',)
-        for service_name in services_list:
-            if service_name in restart_functions:
-                restart_functions[service_name](service_name)
-            else:
-                for action in actions:
-                    service(action, service_name)
+        if deferred:
+            defer_restarts(services_list, stopstart, restart_functions)
+        else:
+            _restart_services(services_list, stopstart, restart_functions)
     return r
 
 
+def _restart_map_covered(restart_map):
+    """Whether a restart_on_change() in progress covers all of restart_map"""
+    for active in _active_restart_maps:
+        if all(path in active and set(services) <= set(active[path])
+               for path, services in six.iteritems(restart_map)):
+            return True
+    return False
+
+
+def _restart_services(services_list, stopstart=False, restart_functions=None):
+    if restart_functions is None:
+        restart_functions = {}
+    actions = ('stop', 'start') if stopstart else ('restart',)
+    if any(service_name in _deferred_restarts
+           for service_name in services_list):
+        # Any deferred restart of the services is now redundant
+        for service_name in services_list:
+            _deferred_restarts.pop(service_name, None)
+        _save_deferred_restarts()
+    for service_name in services_list:
+        if service_name in restart_functions:
+            restart_functions[service_name](service_name)
+        else:
+            for action in actions:
+                service(action, service_name)
+
+
+def defer_restarts(services_list, stopstart=False, restart_functions=None):
+    """Restart services once at hook exit however often they are requested
+
+    The restarts run from a hookenv.atexit() callback, a service restarted
+    in the meantime by restart_on_change() is not restarted again.  Services
+    that can be reloaded are reloaded rather than restarted unless stopstart
+    or a restart function is requested for them.
+
+    The queued services are also saved in unitdata: should the hook fail,
+    the files they depend on are already written so nothing would restart
+    them, resume_deferred_restarts() queues them again in the next hook.
+    Restart functions are not saved, resumed services are restarted
+    normally.
+
+    @param services_list: services to restart
+    @param stopstart: whether to stop, start or restart the services
+    @param restart_functions: nonstandard functions to use to restart services
+                              {svc: func, ...}
+    """
+    if restart_functions is None:
+        restart_functions = {}
+    if not _deferred_restarts:
+        atexit(run_deferred_restarts)
+    saved = _saved_deferred_restarts()
+    for service_name in services_list:
+        pending_stopstart, func = _deferred_restarts.get(service_name,
+                                                         (False, None))
+        _deferred_restarts[service_name] = (
+            stopstart or pending_stopstart,
+            restart_functions.get(service_name, func))
+    if _saved_deferred_restarts() != saved:
+        _save_deferred_restarts()
+
+
+def _saved_deferred_restarts():
+    return [[service_name, stopstart] for service_name, (stopstart, _)
+            in six.iteritems(_deferred_restarts)]
+
+
+def _save_deferred_restarts():
+    """Commit the queued deferred restarts to unitdata"""
+    if not charm_dir():
+        return
+    from charmhelpers.core import unitdata
+    db = unitdata.kv()
+    if _deferred_restarts:
+        db.set(DEFERRED_RESTARTS_KEY, _saved_deferred_restarts())
+    else:
+        db.unset(DEFERRED_RESTARTS_KEY)
+    db.flush()
+
+
+def resume_deferred_restarts():
+    """Queue again the deferred restarts a failed hook did not run
+
+    Call at the start of every hook, see defer_restarts().
+    """
+    if not charm_dir():
+        return
+    from charmhelpers.core import unitdata
+    saved = unitdata.kv().get(DEFERRED_RESTARTS_KEY)
+    if not saved:
+        return
+    if not _deferred_restarts:
+        atexit(run_deferred_restarts)
+    for service_name, stopstart in saved:
+        log("Resuming deferred restart of {}".format(service_name),
+            level=DEBUG)
+        pending_stopstart, func = _deferred_restarts.get(service_name,
+                                                         (False, None))
+        _deferred_restarts[service_name] = (stopstart or pending_stopstart,
+                                            func)
+
+
+def set_deferred_restart_handler(handler):
+    """Hand the restarts queued by defer_restarts() to handler at hook exit
+
+    handler is called with {service: stopstart} instead of the services being
+    restarted here, e.g. to coordinate the restarts with peer units.  Pass
+    None to restart them here again.
+    """
+    _deferred_restart_handler[0] = handler
+
+
+def run_deferred_restarts():
+    """Run the restarts queued by defer_restarts()"""
+    if _deferred_restart_handler[0] and _deferred_restarts:
+        services = OrderedDict(
+            (service_name, stopstart) for service_name, (stopstart, _)
+            in six.iteritems(_deferred_restarts))
+        _deferred_restart_handler[0](services)
+        _deferred_restarts.clear()
+        _save_deferred_restarts()
+        return
+    while _deferred_restarts:
+        service_name, (stopstart, func) = next(
+            six.iteritems(_deferred_restarts))
+        log("Running deferred restart of {}".format(service_name),
+            level=DEBUG)
+        if func:
+            func(service_name)
+        elif stopstart:
+            service_stop(service_name)
+            service_start(service_name)
+        elif service_can_reload(service_name):
+            service_reload(service_name, restart_on_failure=True)
+        else:
+            service_restart(service_name)
+        _deferred_restarts.pop(service_name, None)
+        _save_deferred_restarts()
+
+
+def service_can_reload(service_name):
+    """Whether the init system can reload the service without a restart"""
+    if not init_is_systemd():
+        return False
+    try:
+        output = subprocess.check_output(
+            ['systemctl', 'show', '--property=CanReload', service_name])
+    except subprocess.CalledProcessError:
+        return False
+    return output.decode('UTF-8').strip() == 'CanReload=yes'
+
+
 def pwgen(length=None):
     """Generate a random pasword."""
     if length is None:
@@ -149,7 +149,6 @@ associated to the hookname.
 import collections
 import contextlib
 import datetime
-import itertools
 import json
 import os
 import pprint
@@ -159,6 +158,47 @@ import sys
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
 
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+def _prefix_range(prefix):
+    """Return the where clause and parameters selecting keys starting with
+    prefix, as a half-open key range that can use the primary key index"""
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode('utf-8')
+    upper = prefix
+    while upper and ord(upper[-1]) >= sys.maxunicode:
+        upper = upper[:-1]
+    if not upper:
+        return 'key >= ?', [prefix]
+    return 'key >= ? and key < ?', [
+        prefix, upper[:-1] + unichr(ord(upper[-1]) + 1)]
+
+
+def _upsert_statements(sqlite_version_info):
+    """Return the statements writing a key, skipping writes of the value it
+    already holds, and recording a key's revision"""
+    if sqlite_version_info >= (3, 24, 0):
+        return ("""
+            insert into kv (key, data) values (?, ?)
+            on conflict (key) do update set data = excluded.data
+            where data != excluded.data""", """
+            insert into kv_revisions (key, revision, data) values (?, ?, ?)
+            on conflict (key, revision) do update set data = excluded.data""")
+    # sqlite only has upsert from 3.24.  Neither table has columns beyond
+    # those written, so replacing the row is equivalent.
+    return ("""
+            insert or replace into kv (key, data)
+            select ?1, ?2
+            where not exists (
+                select 1 from kv where key = ?1 and data = ?2)""", """
+            insert or replace into kv_revisions (key, revision, data)
+            values (?, ?, ?)""")
+
+
 class Storage(object):
     """Simple key value database for local unit state within charms.
 
@@ -170,8 +210,26 @@ class Storage(object):
     Note: to facilitate unit testing, ':memory:' can be passed as the
     path parameter which causes sqlite3 to only build the db in memory.
     This should only be used for testing purposes.
+
+    The database is kept in WAL journal mode.  The synchronous level defaults
+    to the UNIT_STATE_DB_SYNCHRONOUS environment variable, or NORMAL, which
+    is safe from corruption in WAL mode but may lose the last commits on
+    power loss.  Use FULL where that matters.
+
+    With overlay set, or the UNIT_STATE_DB_OVERLAY environment variable set
+    to 1, values are read into memory the first time their key, or a prefix
+    of it, is read and are served from there afterwards.  Changes are kept
+    in memory too and written out by :meth:`flush` in a single transaction,
+    keeping the same revision history as without the overlay.
     """
-    def __init__(self, path=None):
+    # Keys per statement when reading many keys at once, under sqlite's
+    # default limit of 999 host parameters.
+    QUERY_CHUNK = 500
+    # Hook revisions dropped per call to prune
+    PRUNE_CHUNK = 100
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, path=None, synchronous=None, overlay=None):
         self.db_path = path
         if path is None:
             if 'UNIT_STATE_DB' in os.environ:
@@ -182,12 +240,83 @@ class Storage(object):
         if self.db_path != ':memory:':
             with open(self.db_path, 'a') as f:
                 os.fchmod(f.fileno(), 0o600)
+        if synchronous is None:
+            synchronous = os.environ.get('UNIT_STATE_DB_SYNCHRONOUS', 'NORMAL')
+        synchronous = synchronous.upper()
+        if synchronous not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError('Unknown synchronous level %s' % synchronous)
         self.conn = sqlite3.connect('%s' % self.db_path)
         self.cursor = self.conn.cursor()
+        self.cursor.execute('pragma journal_mode=wal')
+        self.cursor.execute('pragma synchronous=%s' % synchronous)
         self.revision = None
         self._closed = False
+        if overlay is None:
+            overlay = os.environ.get('UNIT_STATE_DB_OVERLAY') == '1'
+        # {key: serialized value, or None where the key is absent} when
+        # running with the overlay, None otherwise.
+        self._overlay = {} if overlay else None
+        self._reset_overlay()
         self._init()
 
+    def _reset_overlay(self):
+        if self._overlay is not None:
+            self._overlay = {}
+        # Prefixes whose keys are all in the overlay
+        self._loaded_prefixes = []
+        # Changes yet to be written, {key: serialized value or None} and
+        # {(key, revision): serialized value}
+        self._dirty = {}
+        self._dirty_revisions = {}
+
+    def _lookup(self, key):
+        """Return the serialized value of key from the overlay"""
+        try:
+            return self._overlay[key]
+        except KeyError:
+            pass
+        if any(key.startswith(p) for p in self._loaded_prefixes):
+            return None
+        self.cursor.execute('select data from kv where key=?', [key])
+        result = self.cursor.fetchone()
+        self._overlay[key] = result[0] if result else None
+        return self._overlay[key]
+
+    def _load_prefix(self, prefix):
+        """Read every key starting with prefix into the overlay"""
+        if any(prefix.startswith(p) for p in self._loaded_prefixes):
+            return
+        where, params = _prefix_range(prefix)
+        self.cursor.execute(
+            'select key, data from kv where %s' % where, params)
+        for key, data in self.cursor.fetchall():
+            self._overlay.setdefault(key, data)
+        self._loaded_prefixes.append(prefix)
+
+    def _overlay_write(self, key, serialized, revision_data=None):
+        self._overlay[key] = self._dirty[key] = serialized
+        if self.revision:
+            self._dirty_revisions[(key, self.revision)] = (
+                revision_data or serialized)
+
+    def _write_back(self):
+        """Write the changes held in the overlay, without committing"""
+        if self._dirty:
+            self.cursor.executemany(
+                'insert or replace into kv (key, data) values (?, ?)',
+                [(key, data) for key, data in self._dirty.items()
+                 if data is not None])
+            self.cursor.executemany(
+                'delete from kv where key=?',
+                [(key,) for key, data in self._dirty.items() if data is None])
+        if self._dirty_revisions:
+            self.cursor.executemany(
+                self._upsert_revision,
+                [(key, revision, data) for (key, revision), data
+                 in self._dirty_revisions.items()])
+        self._dirty = {}
+        self._dirty_revisions = {}
+
     def close(self):
         if self._closed:
             return
@@ -197,13 +326,17 @@ class Storage(object):
         self._closed = True
 
     def get(self, key, default=None, record=False):
-        self.cursor.execute('select data from kv where key=?', [key])
-        result = self.cursor.fetchone()
-        if not result:
+        if self._overlay is not None:
+            result = self._lookup(key)
+        else:
+            self.cursor.execute('select data from kv where key=?', [key])
+            result = self.cursor.fetchone()
+            result = result and result[0]
+        if result is None:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(json.loads(result))
+        return json.loads(result)
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -215,36 +348,89 @@ class Storage(object):
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
-        result = self.cursor.fetchall()
+        return dict(self.iterrange(key_prefix, strip))
 
-        if not result:
-            return {}
-        if not strip:
-            key_prefix = ''
-        return dict([
-            (k[len(key_prefix):], json.loads(v)) for k, v in result])
+    def iterrange(self, key_prefix, strip=False):
+        """
+        Iterate over the keys starting with a common prefix, in key order,
+        yielding (key, value) pairs as they are read.
+
+        :param str key_prefix: Common prefix among all keys
+        :param bool strip: Optionally strip the common prefix from the key
+            names
+        """
+        if self._overlay is not None:
+            self._load_prefix(key_prefix)
+            for k in sorted(k for k, v in self._overlay.items()
+                            if v is not None and k.startswith(key_prefix)):
+                v = self._overlay[k]
+                if strip:
+                    k = k[len(key_prefix):]
+                yield k, json.loads(v)
+            return
+        where, params = _prefix_range(key_prefix)
+        # A cursor of its own so that the caller may use the db meanwhile
+        cursor = self.conn.execute(
+            'select key, data from kv where %s order by key' % where, params)
+        try:
+            for k, v in cursor:
+                if strip:
+                    k = k[len(key_prefix):]
+                yield k, json.loads(v)
+        finally:
+            cursor.close()
 
     def update(self, mapping, prefix=""):
         """
         Set the values of multiple keys at once.
 
+        Only keys whose value changes are written, with one statement for
+        the lot rather than one per key.
+
         :param dict mapping: Mapping of keys to values
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        if self._overlay is not None:
+            if prefix:
+                self._load_prefix(prefix)
+            for k, v in mapping.items():
+                self.set("%s%s" % (prefix, k), v)
+            return
+        serialized = dict(("%s%s" % (prefix, k), json.dumps(v))
+                          for k, v in mapping.items())
+        if not self.revision:
+            self.cursor.executemany(self._upsert_kv, serialized.items())
+            return
+        # Only changed keys get a revision, so find out which those are
+        keys = list(serialized)
+        for i in range(0, len(keys), self.QUERY_CHUNK):
+            chunk = keys[i:i + self.QUERY_CHUNK]
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            for key, data in self.cursor.fetchall():
+                if serialized[key] == data:
+                    del serialized[key]
+        if not serialized:
+            return
+        self.cursor.executemany(self._upsert_kv, serialized.items())
+        self.cursor.executemany(
+            self._upsert_revision,
+            [(key, self.revision, data) for key, data in serialized.items()])
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
+        if self._overlay is not None:
+            if self._lookup(key) is not None:
+                self._overlay_write(key, None, json.dumps('DELETED'))
+            return
         self.cursor.execute('delete from kv where key=?', [key])
         if self.revision and self.cursor.rowcount:
             self.cursor.execute(
-                'insert into kv_revisions values (?, ?, ?)',
+                self._upsert_revision,
                 [key, self.revision, json.dumps('DELETED')])
 
     def unsetrange(self, keys=None, prefix=""):
@@ -256,19 +442,37 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in ``keys``
             before removing.
         """
+        if self._overlay is not None:
+            if keys is not None:
+                keys = ['%s%s' % (prefix, key) for key in keys]
+                present = [k for k in keys if self._lookup(k) is not None]
+                revision_keys = keys
+            else:
+                self._load_prefix(prefix)
+                present = [k for k, v in self._overlay.items()
+                           if v is not None and k.startswith(prefix)]
+                revision_keys = ['%s%%' % prefix]
+            for key in present:
+                self._overlay[key] = self._dirty[key] = None
+            if self.revision and present:
+                for key in revision_keys:
+                    self._dirty_revisions[(key, self.revision)] = json.dumps(
+                        'DELETED')
+            return
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
             if self.revision and self.cursor.rowcount:
-                self.cursor.execute(
-                    'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
-                    list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
+                self.cursor.executemany(
+                    self._upsert_revision,
+                    [(key, self.revision, json.dumps('DELETED'))
+                     for key in keys])
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            where, params = _prefix_range(prefix)
+            self.cursor.execute('delete from kv where %s' % where, params)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
-                    'insert into kv_revisions values (?, ?, ?)',
+                    self._upsert_revision,
                     ['%s%%' % prefix, self.revision, json.dumps('DELETED')])
 
     def set(self, key, value):
@@ -280,47 +484,18 @@ class Storage(object):
         """
         serialized = json.dumps(value)
 
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
-        # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
-
-        if not exists:
-            self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
-
-        # Save
-        if not self.revision:
+        if self._overlay is not None:
+            if self._lookup(key) != serialized:
+                self._overlay_write(key, serialized)
             return value
 
-        self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
-
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+        # Mutations to the same value are skipped, and leave rowcount at 0
+        self.cursor.execute(self._upsert_kv, (key, serialized))
+        if not self.cursor.rowcount or not self.revision:
+            return value
 
+        self.cursor.execute(self._upsert_revision,
+                            (key, self.revision, serialized))
         return value
 
     def delta(self, mapping, prefix):
@@ -374,11 +549,16 @@ class Storage(object):
 
     def flush(self, save=True):
         if save:
+            self._write_back()
             self.conn.commit()
         elif self._closed:
             return
         else:
             self.conn.rollback()
+            self._reset_overlay()
+
+    _upsert_kv, _upsert_revision = _upsert_statements(
+        sqlite3.sqlite_version_info)
 
     def _init(self):
         self.cursor.execute('''
@@ -402,7 +582,78 @@ class Storage(object):
                )''')
         self.conn.commit()
 
+    def prune(self, keep_revisions=None, keep_days=None, limit=PRUNE_CHUNK):
+        """
+        Drop the oldest hook revisions that fall outside the retention
+        window, along with the key history recorded in them.
+
+        A revision is kept while it is among the last `keep_revisions`
+        revisions or is less than `keep_days` days old.  At most `limit`
+        revisions are dropped per call so that pruning a large history can
+        be spread over many hooks.
+
+        :param int keep_revisions: Number of most recent revisions to keep
+        :param int keep_days: Age in days of the revisions to keep
+        :param int limit: Maximum number of revisions to drop
+        :return int: The number of revisions dropped
+        """
+        if not keep_revisions and not keep_days:
+            return 0
+        self._write_back()
+        where, params = ['version != ?'], [self.revision or 0]
+        if keep_revisions:
+            where.append(
+                'version <= (select max(version) from hooks) - ?')
+            params.append(keep_revisions)
+        if keep_days:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+                days=keep_days)
+            where.append('date < ?')
+            params.append(cutoff.isoformat())
+        self.cursor.execute(
+            'select version from hooks where %s order by version limit ?' %
+            ' and '.join(where), params + [limit])
+        versions = [row[0] for row in self.cursor.fetchall()]
+        if versions:
+            marks = ','.join(['?'] * len(versions))
+            self.cursor.execute(
+                'delete from kv_revisions where revision in (%s)' % marks,
+                versions)
+            self.cursor.execute(
+                'delete from hooks where version in (%s)' % marks, versions)
+        return len(versions)
+
+    def compact(self, keep_revisions=None, keep_days=None):
+        """
+        Prune all of the history outside the retention window, then commit
+        and rebuild the database file to return the space it held.
+        """
+        while self.prune(keep_revisions, keep_days):
+            pass
+        self.flush()
+        self.cursor.execute('pragma wal_checkpoint(truncate)')
+        self.cursor.execute('vacuum')
+
+    def stats(self):
+        """
+        Return the number of rows of each table and the size in bytes of
+        the database and its write-ahead log.
+        """
+        self._write_back()
+        stats = {}
+        for table in ('kv', 'kv_revisions', 'hooks'):
+            self.cursor.execute('select count(*) from %s' % table)
+            stats[table] = self.cursor.fetchone()[0]
+        self.cursor.execute('pragma page_count')
+        page_count = self.cursor.fetchone()[0]
+        self.cursor.execute('pragma page_size')
+        stats['size'] = page_count * self.cursor.fetchone()[0]
+        wal = '%s-wal' % self.db_path
+        stats['wal-size'] = os.path.getsize(wal) if os.path.exists(wal) else 0
+        return stats
+
     def gethistory(self, key, deserialize=False):
+        self._write_back()
         self.cursor.execute(
             '''
             select kv.revision, kv.key, kv.data, h.hook, h.date
@@ -416,6 +667,7 @@ class Storage(object):
         return map(_parse_history, self.cursor.fetchall())
 
     def debug(self, fh=sys.stderr):
+        self._write_back()
         self.cursor.execute('select * from kv')
         pprint.pprint(self.cursor.fetchall(), stream=fh)
         self.cursor.execute('select * from kv_revisions')
@@ -14,6 +14,7 @@
 
 import os
 import json
+import time
 
 from charmhelpers.contrib.openstack import context
 
@@ -256,16 +257,37 @@ class TokenFlushContext(context.OSContextGenerator):
         return ctxt
 
 
-class FernetCronContext(context.OSContextGenerator):
+class FernetRotationContext(context.OSContextGenerator):
 
     def __call__(self):
-        token_expiration = int(config('token-expiration'))
+        # late import to work around circular dependency
+        from keystone_utils import (
+            FERNET_ROTATION_DEADLINE_FILE,
+            FERNET_ROTATION_OVERDUE_DELAY,
+            FERNET_ROTATION_RETRY_INTERVAL,
+            fernet_rotation_deadline,
+        )
+
+        deadline = fernet_rotation_deadline()
+        # A calendar event in the past never fires, e.g. for a new leader
+        # or a unit that was down at the deadline, so an overdue rotation
+        # fires shortly after the timer starts instead.
+        soon = time.time() + FERNET_ROTATION_OVERDUE_DELAY
+        overdue = deadline is not None and deadline < soon
+        enabled = deadline is not None and is_elected_leader(DC_RESOURCE_NAME)
         ctxt = {
-            'enabled': (fernet_enabled() and
-                        is_elected_leader(DC_RESOURCE_NAME)),
+            'enabled': enabled,
             'unit_name': local_unit(),
             'charm_dir': charm_dir(),
-            'minute': ('*/5' if token_expiration > 300 else '*')
+            'deadline': deadline,
+            'deadline_file': FERNET_ROTATION_DEADLINE_FILE,
+            # systemd calendar events are in local time
+            'on_calendar': (time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(deadline))
+                            if deadline is not None and not overdue
+                            else None),
+            'on_active_sec': FERNET_ROTATION_OVERDUE_DELAY,
+            'on_unit_active_sec': FERNET_ROTATION_RETRY_INTERVAL,
         }
         return ctxt
 
@@ -25,6 +25,7 @@ from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     Hooks,
     UnregisteredHookError,
+    atexit,
     config,
     log,
     DEBUG,
@@ -38,6 +39,9 @@ from charmhelpers.core.hookenv import (
     open_port,
     is_leader,
     relation_id,
+    prefetch_relations,
+    batch_relation_set,
+    set_log_level,
 )
 
 from charmhelpers.core.host import (
@@ -45,6 +49,8 @@ from charmhelpers.core.host import (
     service_stop,
     service_start,
     service_restart,
+    resume_deferred_restarts,
+    set_deferred_restart_handler,
 )
 
 from charmhelpers.fetch import (
@@ -106,6 +112,18 @@ from keystone_utils import (
     key_leader_set,
     key_setup,
     key_write,
+    key_acknowledgements,
+    publish_key_acknowledgement,
+    fernet_keys_rotate_and_sync,
+    update_fernet_rotation_schedule,
+    keystone_snapshot,
+    invalidate_keystone_id_cache,
+    identity_relation_fingerprints,
+    changed_identity_relation_units,
+    store_identity_relation_fingerprints,
+    prune_unit_state,
+    reconcile_identity_relations,
+    restart_coordinator,
 )
 
 from charmhelpers.contrib.hahelpers.cluster import (
@@ -150,6 +168,15 @@ from charmhelpers.contrib.openstack.cert_utils import (
 hooks = Hooks()
 CONFIGS = register_configs()
 
+# Relations whose units update_all_identity_relation_units() looks at.
+RESYNC_RELATIONS = [
+    'identity-service',
+    'identity-credentials',
+    'identity-admin',
+    'cluster',
+    'shared-db',
+]
+
 
 @hooks.hook('install.real')
 @harden()
@@ -182,7 +209,8 @@ def install():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map(), restart_functions=restart_function_map())
+@restart_on_change(restart_map(), restart_functions=restart_function_map(),
+                   deferred=True)
 @harden()
 def config_changed():
     if config('prefer-ipv6'):
@@ -199,13 +227,19 @@ def config_changed():
     for r_id in relation_ids('cluster'):
         cluster_joined(rid=r_id)
 
-    config_changed_postupgrade()
+    _config_changed_postupgrade()
 
 
+# NOTE: the services run the upgraded packages once restarted, which the
+# rest of the hook relies on, so post-upgrade restarts are not deferred.
 @hooks.hook('config-changed-postupgrade')
 @restart_on_change(restart_map(), restart_functions=restart_function_map())
 @harden()
 def config_changed_postupgrade():
+    _config_changed_postupgrade()
+
+
+def _config_changed_postupgrade():
     save_script_rc()
     release = os_release('keystone')
     if run_in_apache(release=release):
@@ -237,6 +271,7 @@ def config_changed_postupgrade():
     update_nrpe_config()
 
     CONFIGS.write_all()
+    update_fernet_rotation_schedule()
 
     if snap_install_requested() and not is_unit_paused_set():
         service_restart('snap.keystone.*')
@@ -276,7 +311,15 @@ def db_joined():
                      hostname=host)
 
 
-def update_all_identity_relation_units(check_db_ready=True):
+def update_all_identity_relation_units(check_db_ready=True, force=False):
+    """Bring keystone and every identity relation unit up to date
+
+    On the leader units whose relation settings and published inputs are
+    unchanged since they were last handled are skipped.
+
+    :param check_db_ready: check the database is ready first
+    :param force: handle every unit even if it is unchanged
+    """
     if is_unit_paused_set():
         return
     if check_db_ready and not is_db_ready():
@@ -289,17 +332,58 @@ def update_all_identity_relation_units(check_db_ready=True):
             "updates", level=INFO)
         return
 
-    log('Firing identity_changed hook for all related services.')
-    for rid in relation_ids('identity-service'):
-        for unit in related_units(rid):
-            identity_changed(relation_id=rid, remote_unit=unit)
-    log('Firing admin_relation_changed hook for all related services.')
-    for rid in relation_ids('identity-admin'):
-        admin_relation_changed(rid)
-    log('Firing identity_credentials_changed hook for all related services.')
-    for rid in relation_ids('identity-credentials'):
-        for unit in related_units(rid):
-            identity_credentials_changed(relation_id=rid, remote_unit=unit)
+    # Share one indexed snapshot of the keystone catalog across every unit
+    # so each collection is only listed once for the whole resync.
+    with keystone_snapshot():
+        fingerprints = None
+        reconciled = set()
+        leader = is_elected_leader(CLUSTER_RES)
+        if leader and not (expect_ha() and not is_clustered()):
+            # Fetch the data of every unit the resync looks at up front
+            # rather than forking a relation-get per unit and attribute.
+            prefetch_relations(RESYNC_RELATIONS)
+            fingerprints = identity_relation_fingerprints()
+            if force:
+                changed = set(fingerprints)
+            else:
+                changed = changed_identity_relation_units(fingerprints)
+            # Bring keystone in line with all related units in one pass so
+            # the per unit updates below only have to publish relation data.
+            if changed:
+                reconciled = reconcile_identity_relations()
+
+        def _skip(rid, unit):
+            if fingerprints is None or (rid, unit) in changed:
+                return False
+            log('Skipping unchanged unit {} on {}'.format(unit, rid),
+                level=DEBUG)
+            return True
+
+        log('Firing identity_changed hook for all related services.')
+        for rid in relation_ids('identity-service'):
+            for unit in related_units(rid):
+                if _skip(rid, unit):
+                    continue
+                identity_changed(relation_id=rid, remote_unit=unit,
+                                 reconciled=(rid, unit) in reconciled)
+        log('Firing admin_relation_changed hook for all related services.')
+        for rid in relation_ids('identity-admin'):
+            admin_relation_changed(rid)
+        log('Firing identity_credentials_changed hook for all related '
+            'services.')
+        for rid in relation_ids('identity-credentials'):
+            for unit in related_units(rid):
+                if _skip(rid, unit):
+                    continue
+                identity_credentials_changed(
+                    relation_id=rid, remote_unit=unit,
+                    reconciled=(rid, unit) in reconciled)
+        if fingerprints is not None:
+            if changed:
+                # Handling the units may have created service passwords,
+                # which are part of the fingerprints
+                fingerprints = identity_relation_fingerprints()
+            store_identity_relation_fingerprints(fingerprints)
 
 
 def update_all_domain_backends():
@@ -349,7 +433,7 @@ def leader_init_db_if_ready(use_current_context=False):
         CONFIGS.write(POLICY_JSON)
     # Ensure any existing service entries are updated in the
     # new database backend. Also avoid duplicate db ready check.
-    update_all_identity_relation_units(check_db_ready=False)
+    update_all_identity_relation_units(check_db_ready=False, force=True)
     update_all_domain_backends()
 
 
@@ -360,16 +444,27 @@ def db_changed():
         log('shared-db relation incomplete. Peer not ready?')
     else:
         CONFIGS.write(KEYSTONE_CONF)
+        # Cached keystone IDs may belong to the previous database
+        invalidate_keystone_id_cache()
         leader_init_db_if_ready(use_current_context=True)
         if CompareOpenStackReleases(
                 os_release('keystone')) >= 'liberty':
             CONFIGS.write(POLICY_JSON)
-        update_all_identity_relation_units()
+        # The database may have changed under the existing units
+        update_all_identity_relation_units(force=True)
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map(), restart_functions=restart_function_map())
-def identity_changed(relation_id=None, remote_unit=None):
+@restart_on_change(restart_map(), restart_functions=restart_function_map(),
+                   deferred=True)
+def identity_changed(relation_id=None, remote_unit=None, reconciled=False):
+    """Register the remote service and publish its credentials
+
+    :param relation_id: Relation id of the relation
+    :param remote_unit: Related unit on the relation
+    :param reconciled: keystone already holds the unit's services, endpoints
+                       and users, only relation data needs publishing
+    """
     notifications = {}
     if is_elected_leader(CLUSTER_RES):
         if not is_db_ready():
@@ -386,8 +481,9 @@ def identity_changed(relation_id=None, remote_unit=None):
             log("Expected to be HA but no hacluster relation yet", level=INFO)
             return
 
-        add_service_to_keystone(relation_id, remote_unit)
-        if is_service_present('neutron', 'network'):
+        add_service_to_keystone(relation_id, remote_unit,
+                                publish_only=reconciled)
+        if not reconciled and is_service_present('neutron', 'network'):
             delete_service_entry('quantum', 'network')
         settings = relation_get(rid=relation_id, unit=remote_unit)
         service = settings.get('service', None)
@@ -420,13 +516,16 @@ def identity_changed(relation_id=None, remote_unit=None):
 
 @hooks.hook('identity-credentials-relation-joined',
             'identity-credentials-relation-changed')
-def identity_credentials_changed(relation_id=None, remote_unit=None):
+def identity_credentials_changed(relation_id=None, remote_unit=None,
+                                 reconciled=False):
     """Update the identity credentials relation on change
 
     Calls add_credentials_to_keystone
 
     :param relation_id: Relation id of the relation
     :param remote_unit: Related unit on the relation
+    :param reconciled: the credentials already exist in keystone, only
+                       relation data needs publishing
     """
     if is_elected_leader(CLUSTER_RES):
         if expect_ha() and not is_clustered():
@@ -443,7 +542,8 @@ def identity_credentials_changed(relation_id=None, remote_unit=None):
             return
 
         # Create the tenant user
-        add_credentials_to_keystone(relation_id, remote_unit)
+        add_credentials_to_keystone(relation_id, remote_unit,
+                                    publish_only=reconciled)
     else:
         log('Deferring identity_credentials_changed() to service leader.')
 
@@ -463,6 +563,9 @@ def cluster_joined(rid=None):
 
     relation_set(relation_id=rid, relation_settings=settings)
 
+    if fernet_enabled():
+        publish_key_acknowledgement()
+
 
 @hooks.hook('cluster-relation-changed')
 @restart_on_change(restart_map(), stopstart=True)
@@ -477,6 +580,12 @@ def cluster_changed():
 
     CONFIGS.write_all()
 
+    # Peer units acknowledge the Fernet keys they installed, which a pending
+    # rotation may be waiting for, the rotation then reschedules the timer
+    if is_leader() and fernet_enabled():
+        fernet_keys_rotate_and_sync(
+            acknowledgements=key_acknowledgements())
+
 
 @hooks.hook('leader-elected')
 @restart_on_change(restart_map(), stopstart=True)
@@ -485,8 +594,10 @@ def leader_elected():
     # When the local unit has been elected the leader, update the cron jobs
     # to ensure that the cron jobs are active on this unit.
     CONFIGS.write(TOKEN_FLUSH_CRON_FILE)
+    update_fernet_rotation_schedule()
 
-    update_all_identity_relation_units()
+    # Units handled under a previous leader may not be up to date
+    update_all_identity_relation_units(force=True)
 
 
 @hooks.hook('leader-settings-changed')
@@ -496,6 +607,7 @@ def leader_settings_changed():
     # leader-settings-changed hook, rewrite the token flush cron job to make
     # sure only the leader is running the cron job.
     CONFIGS.write(TOKEN_FLUSH_CRON_FILE)
+    update_fernet_rotation_schedule()
 
     # Make sure we keep domain and/or project ids used in templates up to date
     if CompareOpenStackReleases(
@@ -683,7 +795,7 @@ def upgrade_charm():
     if is_elected_leader(CLUSTER_RES):
         log('Cluster leader - ensuring endpoint configuration is up to '
             'date', level=DEBUG)
-        update_all_identity_relation_units()
+        update_all_identity_relation_units(force=True)
 
 
 @hooks.hook('update-status')
@@ -808,6 +920,17 @@ def certs_changed(relation_id=None, unit=None):
 
 
 def main():
+    set_log_level(config('charm-log-level'))
+    # Relation writes are merged per relation id and written at hook exit
+    batch_relation_set()
+    atexit(prune_unit_state)
+    # Deferred restarts wait for a slot granted by the leader, the others
+    # happen straight away, see restart_coordinator()
+    coordinator = restart_coordinator()
+    set_deferred_restart_handler(coordinator.request)
+    atexit(coordinator.process)
+    # Restarts deferred by a hook that then failed are run by this one
+    resume_deferred_restarts()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
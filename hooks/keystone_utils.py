@@ -14,10 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import json
+import math
 import os
 import shutil
 import subprocess
+import threading
 import time
 import urlparse
 import uuid
@@ -25,13 +28,16 @@ import sys
 
 from itertools import chain
 from collections import OrderedDict
+from contextlib import contextmanager
 from copy import deepcopy
+from functools import partial, wraps
 
 from charmhelpers.contrib.hahelpers.cluster import (
     is_elected_leader,
     determine_api_port,
     https,
     get_hacluster_config,
+    RestartCoordinator,
 )
 
 from charmhelpers.contrib.openstack import context, templating
@@ -66,13 +72,17 @@ from charmhelpers.contrib.openstack.utils import (
     is_unit_paused_set,
 )
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.decorators import (
     retry_on_exception,
 )
 
 from charmhelpers.core.hookenv import (
+    atexit,
     config,
+    flush_log,
     is_leader,
+    leader_commit,
     leader_get,
     leader_set,
     log,
@@ -95,6 +105,8 @@ from charmhelpers.fetch import (
     add_source,
 )
 
+from charmhelpers.core.templating import render
+
 from charmhelpers.core.host import (
     mkdir,
     service_restart,
@@ -196,7 +208,18 @@ TOKEN_FLUSH_CRON_FILE = '/etc/cron.d/keystone-token-flush'
 KEY_SETUP_FILE = '/etc/keystone/key-setup'
 CREDENTIAL_KEY_REPOSITORY = '/etc/keystone/credential-keys/'
 FERNET_KEY_REPOSITORY = '/etc/keystone/fernet-keys/'
+# Replaced by the systemd timer below, removed when found
 FERNET_KEY_ROTATE_SYNC_CRON_FILE = '/etc/cron.d/keystone-fernet-rotate-sync'
+FERNET_ROTATION_DEADLINE_FILE = '/etc/keystone/fernet-rotation-deadline'
+FERNET_ROTATE_SYNC_SERVICE = (
+    '/etc/systemd/system/keystone-fernet-rotate-sync.service')
+FERNET_ROTATE_SYNC_TIMER = (
+    '/etc/systemd/system/keystone-fernet-rotate-sync.timer')
+# Seconds after it starts that the timer fires when the rotation deadline
+# has already passed, or is about to
+FERNET_ROTATION_OVERDUE_DELAY = 60
+# Seconds after the last run that the timer fires again in any case
+FERNET_ROTATION_RETRY_INTERVAL = 3600
 WSGI_KEYSTONE_API_CONF = '/etc/apache2/sites-enabled/wsgi-openstack-api.conf'
 UNUSED_APACHE_SITE_FILES = ['/etc/apache2/sites-enabled/keystone.conf',
                             '/etc/apache2/sites-enabled/wsgi-keystone.conf']
@@ -260,11 +283,6 @@ BASE_RESOURCE_MAP = OrderedDict([
                      context.SyslogContext()],
         'services': [],
     }),
-    (FERNET_KEY_ROTATE_SYNC_CRON_FILE, {
-        'contexts': [keystone_context.FernetCronContext(),
-                     context.SyslogContext()],
-        'services': [],
-    }),
 ])
 
 valid_services = {
@@ -414,6 +432,36 @@ valid_services = {
     },
 }
 
+# unitdata key of the generation of the leader's key repositories last
+# written out, see key_write().
+KEY_GENERATION_KEY = 'keystone.key-repository-generation'
+
+# Cluster relation setting holding the digest of the Fernet keys installed
+# on the unit, see publish_key_acknowledgement().
+FERNET_KEY_DIGEST_KEY = 'fernet-key-digest'
+
+# unitdata key of the seconds the leader's current Fernet keys took to be
+# installed on each peer unit, see key_acknowledgements().
+FERNET_KEY_ACKS_KEY = 'keystone.fernet-key-acknowledgements'
+
+# unitdata key prefix for the fingerprints of the identity relation units
+# last handled, see identity_relation_fingerprints().
+FINGERPRINT_PREFIX = 'identity-relation-fingerprint:'
+
+# Charm options the data published to identity relation units depends on.
+FINGERPRINT_CONFIG = [
+    'admin-port',
+    'admin-role',
+    'region',
+    'service-admin-prefix',
+    'service-port',
+    'service-tenant',
+]
+
+# The minimum identity-service relation settings needed per endpoint
+ENDPOINT_SETTINGS = set(['service', 'region', 'public_url', 'admin_url',
+                         'internal_url'])
+
 # The interface is said to be satisfied if anyone of the interfaces in the
 # list has a complete context.
 REQUIRED_INTERFACES = {
@@ -614,6 +662,7 @@ def save_script_rc():
 def do_openstack_upgrade_reexec(configs):
     do_openstack_upgrade(configs)
     log("Re-execing hook to pickup upgraded packages", level=INFO)
+    flush_log()
     os.execl('./hooks/config-changed-postupgrade', '')
 
 
@@ -753,51 +802,130 @@ def set_admin_token(admin_token='None'):
     return(token)
 
 
+# (mtime, size) of KEYSTONE_CONF and the admin token last parsed from it.
+_admin_token_cache = {}
+
+
 def get_admin_token():
     """Temporary utility to grab the admin token as configured in
        keystone.conf
+
+    The file is only parsed again when its mtime or size changes.
     """
+    st = os.stat(KEYSTONE_CONF)
+    stamp = (st.st_mtime, st.st_size)
+    if _admin_token_cache.get('stamp') == stamp:
+        return _admin_token_cache['token']
     with open(KEYSTONE_CONF, 'r') as f:
         for l in f.readlines():
             if l.split(' ')[0] == 'admin_token':
                 try:
-                    return l.split('=')[1].strip()
+                    token = l.split('=')[1].strip()
                 except:
                     error_out('Could not parse admin_token line from %s' %
                               KEYSTONE_CONF)
+                _admin_token_cache.update(stamp=stamp, token=token)
+                return token
     error_out('Could not find admin_token line in %s' % KEYSTONE_CONF)
 
 
+# Persistent name to ID cache shared by every manager in this hook, see
+# keystone_id_cache().
+_keystone_id_cache = None
+
+# Tracks the outermost retry_on_stale_ids() call of each thread.
+_stale_ids_state = threading.local()
+
+
+def keystone_id_cache():
+    """Return the persistent keystone name to ID cache for this hook
+
+    The cache is kept in unitdata and is emptied whenever the db-initialised
+    leader setting changes.  Changes are written back when the hook exits.
+    """
+    global _keystone_id_cache
+    if _keystone_id_cache is None:
+        set_python_path()
+        from manager import KeystoneIdCache
+        _keystone_id_cache = KeystoneIdCache(
+            scope=leader_get('db-initialised'))
+        atexit(_keystone_id_cache.save)
+    return _keystone_id_cache
+
+
+def invalidate_keystone_id_cache():
+    """Forget every cached keystone ID, e.g. once the database changes"""
+    cache = keystone_id_cache()
+    cache.clear()
+    cache.save()
+
+
+def retry_on_stale_ids(f):
+    """Retry f once if keystone reports an ID served from the cache missing
+
+    The IDs served from keystone_id_cache() during the failed attempt are
+    dropped so that the retry resolves them again.  Only the outermost
+    decorated call retries, nested ones let the error propagate to it.
+    """
+    @wraps(f)
+    def _retry_on_stale_ids(*args, **kwargs):
+        if getattr(_stale_ids_state, 'active', False):
+            return f(*args, **kwargs)
+        cache = keystone_id_cache()
+        mark = cache.mark()
+        _stale_ids_state.active = True
+        try:
+            try:
+                return f(*args, **kwargs)
+            except Exception as e:
+                # NOTE: keystoneclient may not be importable yet so match the
+                # NotFound exception on its http status.
+                if getattr(e, 'http_status', None) != 404:
+                    raise
+                dropped = cache.drop_served(mark)
+                if not dropped:
+                    raise
+                log("Keystone IDs no longer valid, resolving them again: "
+                    "{}".format(', '.join(dropped)), level=WARNING)
+            return f(*args, **kwargs)
+        finally:
+            _stale_ids_state.active = False
+
+    return _retry_on_stale_ids
+
+
 def is_service_present(service_name, service_type):
     manager = get_manager()
     service_id = manager.resolve_service_id(service_name, service_type)
     return service_id is not None
 
 
+@retry_on_stale_ids
 def delete_service_entry(service_name, service_type):
     """ Delete a service from keystone"""
     manager = get_manager()
     service_id = manager.resolve_service_id(service_name, service_type)
     if service_id:
-        manager.api.services.delete(service_id)
+        manager.delete_service(service_id)
         log("Deleted service entry '%s'" % service_name, level=DEBUG)
 
 
 def create_service_entry(service_name, service_type, service_desc, owner=None):
     """ Add a new service entry to keystone if one does not already exist """
     manager = get_manager()
-    for service in [s._info for s in manager.api.services.list()]:
+    for service in [s._info for s in manager.services_list()]:
         if service['name'] == service_name:
             log("Service entry for '%s' already exists." % service_name,
                 level=DEBUG)
             return
 
-    manager.api.services.create(service_name,
-                                service_type,
-                                description=service_desc)
+    manager.create_service(service_name,
+                           service_type,
+                           description=service_desc)
     log("Created new service entry '%s'" % service_name, level=DEBUG)
 
 
+@retry_on_stale_ids
 def create_endpoint_template(region, service, publicurl, adminurl,
                              internalurl):
     manager = get_manager()
@@ -814,7 +942,7 @@ def create_endpoint_template_v2(manager, region, service, publicurl, adminurl,
     """ Create a new endpoint template for service if one does not already
         exist matching name *and* region """
     service_id = manager.resolve_service_id(service)
-    for ep in [e._info for e in manager.api.endpoints.list()]:
+    for ep in [e._info for e in manager.endpoints_list()]:
         if ep['service_id'] == service_id and ep['region'] == region:
             log("Endpoint template already exists for '%s' in '%s'"
                 % (service, region))
@@ -829,7 +957,7 @@ def create_endpoint_template_v2(manager, region, service, publicurl, adminurl,
             else:
                 # delete endpoint and recreate if endpoint urls need updating.
                 log("Updating endpoint template with new endpoint urls.")
-                manager.api.endpoints.delete(ep['id'])
+                manager.delete_endpoint(ep['id'])
 
     manager.create_endpoints(region=region,
                              service_id=service_id,
@@ -848,6 +976,7 @@ def create_endpoint_template_v3(manager, region, service, publicurl, adminurl,
         'admin': adminurl,
         'internal': internalurl,
     }
+    missing = []
     for ep_type in endpoints.keys():
         # Delete endpoint if its has changed
         ep_deleted = manager.delete_old_endpoint_v3(
@@ -862,18 +991,19 @@ def create_endpoint_template_v3(manager, region, service, publicurl, adminurl,
             region
         )
         if ep_deleted or not ep_exists:
-            manager.api.endpoints.create(
-                service_id,
-                endpoints[ep_type],
-                interface=ep_type,
-                region=region
-            )
+            missing.append(ep_type)
 
+    manager.batch([
+        partial(manager.create_endpoint, service_id, endpoints[ep_type],
+                interface=ep_type, region=region)
+        for ep_type in missing])
 
+
+@retry_on_stale_ids
 def create_tenant(name, domain):
     """Creates a tenant if it does not already exist"""
     manager = get_manager()
-    tenant = manager.resolve_tenant_id(name, domain=domain)
+    tenant = manager.resolve_tenant_id(name, domain=domain, verify=True)
     if not tenant:
         manager.create_tenant(tenant_name=name,
                               domain=domain,
@@ -888,7 +1018,7 @@ def create_tenant(name, domain):
 def create_or_show_domain(name):
     """Creates a domain if it does not already exist"""
     manager = get_manager()
-    domain_id = manager.resolve_domain_id(name)
+    domain_id = manager.resolve_domain_id(name, verify=True)
     if domain_id:
         log("Domain '%s' already exists." % name, level=DEBUG)
     else:
@@ -901,30 +1031,15 @@ def create_or_show_domain(name):
 
 def user_exists(name, domain=None):
     manager = get_manager()
-    domain_id = None
-    if domain:
-        domain_id = manager.resolve_domain_id(domain)
-        if not domain_id:
-            error_out('Could not resolve domain_id for {} when checking if '
-                      ' user {} exists'.format(domain, name))
-    if manager.resolve_user_id(name, user_domain=domain):
-        if manager.api_version == 2:
-            users = manager.api.users.list()
-        else:
-            users = manager.api.users.list(domain=domain_id)
-        for user in users:
-            if user.name.lower() == name.lower():
-                # In v3 Domains are seperate user namespaces so need to check
-                # that the domain matched if provided
-                if domain:
-                    if domain_id == user.domain_id:
-                        return True
-                else:
-                    return True
-
-    return False
+    if domain and not manager.resolve_domain_id(domain):
+        error_out('Could not resolve domain_id for {} when checking if '
+                  ' user {} exists'.format(domain, name))
+    # NOTE: resolve_user_id matches names case insensitively and, in v3 where
+    # domains are separate user namespaces, only within the given domain.
+    return manager.resolve_user_id(name, user_domain=domain) is not None
 
 
+@retry_on_stale_ids
 def create_user(name, password, tenant=None, domain=None):
     """Creates a user if it doesn't already exist, as a member of tenant"""
     manager = get_manager()
@@ -956,19 +1071,59 @@ def create_user(name, password, tenant=None, domain=None):
         domain_id), level=DEBUG)
 
 
+# Snapshot shared by every manager returned by get_manager() while a
+# keystone_snapshot() block is active.
+_keystone_snapshot = None
+
+
+@contextmanager
+def keystone_snapshot():
+    """Serve keystone lookups from one indexed snapshot within this block
+
+    Each collection is then listed at most once for the duration of the block
+    rather than on every resolve call.  Nested blocks share the outermost
+    snapshot.
+    """
+    global _keystone_snapshot
+    if _keystone_snapshot is not None:
+        yield _keystone_snapshot
+        return
+    set_python_path()
+    from manager import KeystoneSnapshot
+    _keystone_snapshot = KeystoneSnapshot()
+    try:
+        yield _keystone_snapshot
+    finally:
+        _keystone_snapshot = None
+
+
 def get_manager(api_version=None):
-    """Return a keystonemanager for the correct API version"""
+    """Return a keystonemanager for the correct API version
+
+    Managers, and their HTTP session, are reused for the rest of the hook
+    process so repeated calls do not rebuild the client.  Domain, project,
+    role and service IDs are resolved through the persistent
+    keystone_id_cache().
+    """
     set_python_path()
     from manager import get_keystone_manager
-    return get_keystone_manager(get_local_endpoint(), get_admin_token(),
-                                api_version)
+    manager = get_keystone_manager(get_local_endpoint(), get_admin_token(),
+                                   api_version)
+    manager.batch_workers = config('api-write-workers') or 1
+    if _keystone_snapshot is not None:
+        manager.enable_snapshot(_keystone_snapshot)
+    else:
+        manager.disable_snapshot()
+    manager.enable_id_cache(keystone_id_cache())
+    return manager
 
 
+@retry_on_stale_ids
 def create_role(name, user=None, tenant=None, domain=None):
     """Creates a role if it doesn't already exist. grants role to user"""
     manager = get_manager()
-    if not manager.resolve_role_id(name):
-        manager.api.roles.create(name=name)
+    if not manager.resolve_role_id(name, verify=True):
+        manager.create_role(name=name)
         log("Created new role '%s'" % name, level=DEBUG)
     else:
         log("A role named '%s' already exists" % name, level=DEBUG)
@@ -989,10 +1144,36 @@ def create_role(name, user=None, tenant=None, domain=None):
                project_domain=domain)
 
 
+@retry_on_stale_ids
 def grant_role(user, role, tenant=None, domain=None, user_domain=None,
                project_domain=None):
     """Grant user and tenant a specific role"""
+    grant_roles([dict(user=user, role=role, tenant=tenant, domain=domain,
+                      user_domain=user_domain,
+                      project_domain=project_domain)])
+
+
+def grant_roles(grants):
+    """Grant several roles, see grant_role()
+
+    The users, roles, tenants and domains are all resolved first and only
+    the keystone API calls checking and granting the roles are batched, as
+    the lookups use unitdata and hook tools that must not be used from the
+    batch() threads.
+
+    @param grants: list of dicts of grant_role() keyword arguments
+    """
     manager = get_manager()
+    resolved = [_resolve_role_grant(manager, **grant) for grant in grants]
+    granted = manager.batch([partial(_add_role_grant, manager, *ids)
+                             for ids in resolved])
+    for grant, done in zip(grants, granted):
+        _log_role_grant(done, **grant)
+
+
+def _resolve_role_grant(manager, user, role, tenant=None, domain=None,
+                        user_domain=None, project_domain=None):
+    """Return the (user_id, role_id, tenant_id, domain_id) of a grant"""
     if domain:
         log("Granting user '%s' role '%s' in domain '%s'" %
             (user, role, domain))
@@ -1018,22 +1199,38 @@ def grant_role(user, role, tenant=None, domain=None, user_domain=None,
         domain_id = manager.resolve_domain_id(domain)
         if not domain_id:
             error_out('Could not resolve domain_id for domain %s' % domain)
+    return user_id, role_id, tenant_id, domain_id
+
 
+def _add_role_grant(manager, user_id, role_id, tenant_id, domain_id):
+    """Grant a role unless the user already has it
+
+    Only calls the keystone API so that it can run from batch().
+
+    @returns whether the role was granted
+    """
     cur_roles = manager.roles_for_user(user_id, tenant_id=tenant_id,
                                        domain_id=domain_id)
-    if not cur_roles or role_id not in [r.id for r in cur_roles]:
-        manager.add_user_role(user=user_id,
-                              role=role_id,
-                              tenant=tenant_id,
-                              domain=domain_id)
-        if domain_id is None:
+    if cur_roles and role_id in [r.id for r in cur_roles]:
+        return False
+    manager.add_user_role(user=user_id,
+                          role=role_id,
+                          tenant=tenant_id,
+                          domain=domain_id)
+    return True
+
+
+def _log_role_grant(granted, user, role, tenant=None, domain=None,
+                    user_domain=None, project_domain=None):
+    if granted:
+        if not domain:
             log("Granted user '%s' role '%s' on tenant '%s' in domain '%s'" %
                 (user, role, tenant, project_domain), level=DEBUG)
         else:
             log("Granted user '%s' role '%s' in domain '%s'" %
                 (user, role, domain), level=DEBUG)
     else:
-        if domain_id is None:
+        if not domain:
             log("User '%s' already has role '%s' on tenant '%s' in domain '%s'"
                 % (user, role, tenant, project_domain), level=DEBUG)
         else:
@@ -1152,21 +1349,23 @@ def ensure_initial_admin(config):
                                                  domain=ADMIN_DOMAIN)
                 if passwd:
                     create_role('Member')
-                    # Grant 'Member' role to user ADMIN_DOMAIN/admin-user in
-                    # project ADMIN_DOMAIN/'admin'
-                    # ADMIN_DOMAIN
-                    grant_role(admin_username, 'Member', tenant='admin',
-                               user_domain=ADMIN_DOMAIN,
-                               project_domain=ADMIN_DOMAIN)
                     create_role(config('admin-role'))
-                    # Grant admin-role to user ADMIN_DOMAIN/admin-user in
-                    # project ADMIN_DOMAIN/admin
-                    grant_role(admin_username, config('admin-role'),
-                               tenant='admin', user_domain=ADMIN_DOMAIN,
-                               project_domain=ADMIN_DOMAIN)
-                    # Grant domain level admin-role to ADMIN_DOMAIN/admin-user
-                    grant_role(admin_username, config('admin-role'),
-                               domain=ADMIN_DOMAIN, user_domain=ADMIN_DOMAIN)
+                    grant_roles([
+                        # Grant 'Member' role to user ADMIN_DOMAIN/admin-user
+                        # in project ADMIN_DOMAIN/'admin'
+                        dict(user=admin_username, role='Member',
+                             tenant='admin', user_domain=ADMIN_DOMAIN,
+                             project_domain=ADMIN_DOMAIN),
+                        # Grant admin-role to user ADMIN_DOMAIN/admin-user in
+                        # project ADMIN_DOMAIN/admin
+                        dict(user=admin_username, role=config('admin-role'),
+                             tenant='admin', user_domain=ADMIN_DOMAIN,
+                             project_domain=ADMIN_DOMAIN),
+                        # Grant domain level admin-role to
+                        # ADMIN_DOMAIN/admin-user
+                        dict(user=admin_username, role=config('admin-role'),
+                             domain=ADMIN_DOMAIN, user_domain=ADMIN_DOMAIN),
+                    ])
             else:
                 create_user_credentials(admin_username, get_admin_passwd,
                                         set_admin_passwd, tenant='admin',
@@ -1175,6 +1374,7 @@ def ensure_initial_admin(config):
         create_service_entry("keystone", "identity",
                              "Keystone Identity Service")
 
+        # The endpoint API calls of each region are batched
         for region in config('region').split():
             create_keystone_endpoint(public_ip=resolve_address(PUBLIC),
                                      service_port=config("service-port"),
@@ -1363,12 +1563,20 @@ def create_service_credentials(user, new_roles=None):
     return passwd
 
 
-def add_service_to_keystone(relation_id=None, remote_unit=None):
+def add_service_to_keystone(relation_id=None, remote_unit=None,
+                            publish_only=False):
+    """Register the services of an identity-service unit and publish auth data
+
+    :param relation_id: Relation id of the relation
+    :param remote_unit: Related unit on the relation
+    :param publish_only: keystone has already been brought in line with this
+                         unit by reconcile_identity_relations(), only publish
+                         the relation data.
+    """
     manager = get_manager()
     settings = relation_get(rid=relation_id, unit=remote_unit)
     # the minimum settings needed per endpoint
-    single = set(['service', 'region', 'public_url', 'admin_url',
-                  'internal_url'])
+    single = ENDPOINT_SETTINGS
     https_cns = []
 
     protocol = get_protocol()
@@ -1394,26 +1602,23 @@ def add_service_to_keystone(relation_id=None, remote_unit=None):
 
             # Allow the remote service to request creation of any additional
             # roles. Currently used by Horizon
-            for role in get_requested_roles(settings):
-                log("Creating requested role: %s" % role)
-                create_role(role)
+            if not publish_only:
+                for role in get_requested_roles(settings):
+                    log("Creating requested role: %s" % role)
+                    create_role(role)
 
             peer_store_and_set(relation_id=relation_id, **relation_data)
             return
         else:
             ensure_valid_service(settings['service'])
-            add_endpoint(region=settings['region'],
-                         service=settings['service'],
-                         publicurl=settings['public_url'],
-                         adminurl=settings['admin_url'],
-                         internalurl=settings['internal_url'])
-
-            # If an admin username prefix is provided, ensure all services use
-            # it.
-            service_username = settings['service']
-            prefix = config('service-admin-prefix')
-            if prefix:
-                service_username = "%s%s" % (prefix, service_username)
+            if not publish_only:
+                add_endpoint(region=settings['region'],
+                             service=settings['service'],
+                             publicurl=settings['public_url'],
+                             adminurl=settings['admin_url'],
+                             internalurl=settings['internal_url'])
+
+            service_username = get_service_username(settings)
 
             # NOTE(jamespage) internal IP for backwards compat for SSL certs
             internal_cn = urlparse.urlparse(settings['internal_url']).hostname
@@ -1422,56 +1627,21 @@ def add_service_to_keystone(relation_id=None, remote_unit=None):
             https_cns.append(public_cn)
             https_cns.append(urlparse.urlparse(settings['admin_url']).hostname)
     else:
-        # assemble multiple endpoints from relation data. service name
-        # should be prepended to setting name, ie:
-        #  realtion-set ec2_service=$foo ec2_region=$foo ec2_public_url=$foo
-        #  relation-set nova_service=$foo nova_region=$foo nova_public_url=$foo
-        # Results in a dict that looks like:
-        # { 'ec2': {
-        #       'service': $foo
-        #       'region': $foo
-        #       'public_url': $foo
-        #   }
-        #   'nova': {
-        #       'service': $foo
-        #       'region': $foo
-        #       'public_url': $foo
-        #   }
-        # }
-        endpoints = {}
-        for k, v in settings.iteritems():
-            ep = k.split('_')[0]
-            x = '_'.join(k.split('_')[1:])
-            if ep not in endpoints:
-                endpoints[ep] = {}
-            endpoints[ep][x] = v
-
-        services = []
-        for ep in endpoints:
-            # weed out any unrelated relation stuff Juju might have added
-            # by ensuring each possible endpiont has appropriate fields
-            #  ['service', 'region', 'public_url', 'admin_url', 'internal_url']
-            if single.issubset(endpoints[ep]):
-                ep = endpoints[ep]
-                ensure_valid_service(ep['service'])
+        for ep in get_requested_endpoints(settings):
+            ensure_valid_service(ep['service'])
+            if not publish_only:
                 add_endpoint(region=ep['region'], service=ep['service'],
                              publicurl=ep['public_url'],
                              adminurl=ep['admin_url'],
                              internalurl=ep['internal_url'])
-                services.append(ep['service'])
-                # NOTE(jamespage) internal IP for backwards compat for
-                # SSL certs
-                internal_cn = urlparse.urlparse(ep['internal_url']).hostname
-                https_cns.append(internal_cn)
-                https_cns.append(urlparse.urlparse(ep['public_url']).hostname)
-                https_cns.append(urlparse.urlparse(ep['admin_url']).hostname)
-
-        service_username = '_'.join(sorted(services))
+            # NOTE(jamespage) internal IP for backwards compat for
+            # SSL certs
+            internal_cn = urlparse.urlparse(ep['internal_url']).hostname
+            https_cns.append(internal_cn)
+            https_cns.append(urlparse.urlparse(ep['public_url']).hostname)
+            https_cns.append(urlparse.urlparse(ep['admin_url']).hostname)
 
-        # If an admin username prefix is provided, ensure all services use it.
-        prefix = config('service-admin-prefix')
-        if service_username and prefix:
-            service_username = "%s%s" % (prefix, service_username)
+        service_username = get_service_username(settings)
 
     if 'None' in settings.itervalues():
         return
@@ -1480,9 +1650,13 @@ def add_service_to_keystone(relation_id=None, remote_unit=None):
         return
 
     token = get_admin_token()
-    roles = get_requested_roles(settings)
-    service_password = create_service_credentials(service_username,
-                                                  new_roles=roles)
+    if publish_only:
+        service_password = leader_get(
+            '{}_passwd'.format(service_username))
+    else:
+        roles = get_requested_roles(settings)
+        service_password = create_service_credentials(service_username,
+                                                      new_roles=roles)
     service_domain = None
     service_domain_id = None
     if get_api_version() > 2:
@@ -1523,13 +1697,16 @@ def add_service_to_keystone(relation_id=None, remote_unit=None):
     relation_set(relation_id=relation_id, **filtered)
 
 
-def add_credentials_to_keystone(relation_id=None, remote_unit=None):
+def add_credentials_to_keystone(relation_id=None, remote_unit=None,
+                                publish_only=False):
     """Add authentication credentials without a service endpoint
 
     Creates credentials and then peer stores and relation sets them
 
     :param relation_id: Relation id of the relation
     :param remote_unit: Related unit on the relation
+    :param publish_only: the credentials have already been created by
+                         reconcile_identity_relations(), only publish them.
     """
     manager = get_manager()
     settings = relation_get(rid=relation_id, unit=remote_unit)
@@ -1546,21 +1723,27 @@ def add_credentials_to_keystone(relation_id=None, remote_unit=None):
 
     # Use passed project or the service project
     credentials_project = settings.get('project') or config('service-tenant')
-    create_tenant(credentials_project, domain)
-
-    # Use passed grants or default grants
-    credentials_grants = (get_requested_grants(settings) or
-                          [config('admin-role')])
-
-    # Create the user
-    credentials_password = create_user_credentials(
-        credentials_username,
-        get_service_password,
-        set_service_password,
-        tenant=credentials_project,
-        new_roles=get_requested_roles(settings),
-        grants=credentials_grants,
-        domain=domain)
+
+    if publish_only:
+        credentials_password = leader_get(
+            '{}_passwd'.format(credentials_username))
+    else:
+        create_tenant(credentials_project, domain)
+
+        # Use passed grants or default grants
+        credentials_grants = get_requested_grants(settings)
+        if not credentials_grants:
+            credentials_grants = [config('admin-role')]
+
+        # Create the user
+        credentials_password = create_user_credentials(
+            credentials_username,
+            get_service_password,
+            set_service_password,
+            tenant=credentials_project,
+            new_roles=get_requested_roles(settings),
+            grants=credentials_grants,
+            domain=domain)
 
     protocol = get_protocol()
 
@@ -1585,6 +1768,380 @@ def add_credentials_to_keystone(relation_id=None, remote_unit=None):
     peer_store_and_set(relation_id=relation_id, **relation_data)
 
 
+def get_requested_endpoints(settings):
+    """Return the endpoints advertised in identity-service relation settings
+
+    A remote service either advertises a single endpoint or several, in
+    which case the service name is prepended to each setting name, ie:
+     relation-set ec2_service=$foo ec2_region=$foo ec2_public_url=$foo
+     relation-set nova_service=$foo nova_region=$foo nova_public_url=$foo
+
+    :param settings: identity-service relation settings of a remote unit
+    :returns: list of dicts holding the ENDPOINT_SETTINGS keys
+    """
+    if ENDPOINT_SETTINGS.issubset(settings):
+        return [dict((k, settings[k]) for k in ENDPOINT_SETTINGS)]
+    endpoints = {}
+    for k, v in settings.iteritems():
+        ep = k.split('_')[0]
+        x = '_'.join(k.split('_')[1:])
+        if ep not in endpoints:
+            endpoints[ep] = {}
+        endpoints[ep][x] = v
+    # weed out any unrelated relation stuff Juju might have added by ensuring
+    # each possible endpoint has appropriate fields
+    return [ep for ep in endpoints.values()
+            if ENDPOINT_SETTINGS.issubset(ep)]
+
+
+def get_service_username(settings):
+    """Return the service user to create for identity-service settings
+
+    :param settings: identity-service relation settings of a remote unit
+    :returns: user name, or None if the remote unit does not need a user
+    """
+    if 'None' in settings.itervalues():
+        return None
+    services = sorted(ep['service'] for ep in
+                      get_requested_endpoints(settings))
+    service_username = '_'.join(services)
+    # If an admin username prefix is provided, ensure all services use it.
+    prefix = config('service-admin-prefix')
+    if service_username and prefix:
+        service_username = "%s%s" % (prefix, service_username)
+    return service_username or None
+
+
+def collect_desired_identity_state():
+    """Collect the keystone state requested over every identity relation
+
+    Phase one of reconcile_identity_relations().  Units advertising an
+    unknown service are left out and handled by the per unit path.
+
+    :returns: (state, units) where state is a dict describing the services,
+              endpoints, roles, projects and users wanted and units is the
+              set of (relation_id, unit) covered by it.
+    """
+    state = {
+        'services': OrderedDict(),
+        'endpoints': OrderedDict(),
+        'roles': [],
+        'projects': [],
+        'service_users': OrderedDict(),
+        'credentials_users': OrderedDict(),
+    }
+    units = set()
+
+    def _add_role(role):
+        if role not in state['roles']:
+            state['roles'].append(role)
+
+    for rid in relation_ids('identity-service'):
+        for unit in related_units(rid):
+            settings = relation_get(rid=rid, unit=unit) or {}
+            unset = 'None' in settings.itervalues()
+            if ENDPOINT_SETTINGS.issubset(settings) and unset:
+                # Service advertises no endpoint, only roles
+                endpoints = []
+            else:
+                endpoints = get_requested_endpoints(settings)
+            if any(ep['service'] not in valid_services for ep in endpoints):
+                continue
+            units.add((rid, unit))
+            roles = get_requested_roles(settings)
+            for role in roles:
+                _add_role(role)
+            for ep in endpoints:
+                service = ep['service']
+                state['services'][service] = valid_services[service]
+                state['endpoints'][(service, ep['region'])] = {
+                    'public': ep['public_url'],
+                    'admin': ep['admin_url'],
+                    'internal': ep['internal_url'],
+                }
+            username = get_service_username(settings)
+            if username:
+                new_roles = state['service_users'].setdefault(username, [])
+                new_roles.extend(r for r in roles if r not in new_roles)
+
+    for rid in relation_ids('identity-credentials'):
+        for unit in related_units(rid):
+            settings = relation_get(rid=rid, unit=unit) or {}
+            username = settings.get('username')
+            if not username:
+                continue
+            units.add((rid, unit))
+            if get_api_version() == 2:
+                domain = None
+            else:
+                domain = settings.get('domain') or SERVICE_DOMAIN
+            project = settings.get('project') or config('service-tenant')
+            if (project, domain) not in state['projects']:
+                state['projects'].append((project, domain))
+            roles = get_requested_roles(settings)
+            for role in roles:
+                _add_role(role)
+            user = state['credentials_users'].setdefault(
+                (username, domain),
+                {'tenant': project, 'grants': [], 'new_roles': []})
+            grants = get_requested_grants(settings) or [config('admin-role')]
+            user['grants'].extend(g for g in grants
+                                  if g not in user['grants'])
+            user['new_roles'].extend(r for r in roles
+                                     if r not in user['new_roles'])
+
+    return state, units
+
+
+def diff_identity_state(manager, state):
+    """Compute the keystone changes needed to reach the desired state
+
+    Phase two of reconcile_identity_relations().  The services and endpoints
+    are listed once and compared with the desired catalog.
+
+    :param manager: KeystoneManager to read the current state from
+    :param state: desired state from collect_desired_identity_state()
+    :returns: ordered list of change tuples for apply_identity_changes()
+    """
+    changes = []
+    services = OrderedDict()
+    for s in manager.services_list():
+        services.setdefault(s._info['name'], s._info)
+
+    for name, svc in state['services'].items():
+        if name not in services:
+            changes.append(('create_service', name, svc['type'],
+                            svc['desc']))
+
+    # NOTE: quantum was renamed neutron, drop the stale entry
+    quantum = services.get('quantum')
+    if quantum and quantum['type'] == 'network':
+        if 'neutron' in state['services'] or manager.resolve_service_id(
+                'neutron', 'network'):
+            changes.append(('delete_service', quantum['id'], 'quantum'))
+
+    endpoints = [e._info for e in manager.endpoints_list()]
+    for (service, region), urls in state['endpoints'].items():
+        service_id = services.get(service, {}).get('id')
+        key = (service_id, region)
+        existing = [e for e in endpoints
+                    if service_id and (e['service_id'], e['region']) == key]
+        if manager.api_version == 2:
+            up_to_date = False
+            for ep in existing:
+                if all(ep.get('{}url'.format(i)) == urls[i] for i in urls):
+                    up_to_date = True
+                else:
+                    changes.append(('delete_endpoint', ep['id']))
+            if not up_to_date:
+                changes.append(('create_endpoints', service, region, urls))
+        else:
+            for interface in ('public', 'admin', 'internal'):
+                up_to_date = False
+                for ep in existing:
+                    if ep['interface'] != interface:
+                        continue
+                    if ep['url'] == urls[interface]:
+                        up_to_date = True
+                    else:
+                        changes.append(('delete_endpoint', ep['id']))
+                if not up_to_date:
+                    changes.append(('create_endpoint', service, region,
+                                    interface, urls[interface]))
+
+    for role in state['roles']:
+        if not manager.resolve_role_id(role, verify=True):
+            changes.append(('create_role', role))
+
+    for project, domain in state['projects']:
+        if not manager.resolve_tenant_id(project, domain=domain,
+                                         verify=True):
+            changes.append(('create_project', project, domain))
+
+    return changes
+
+
+def apply_identity_changes(manager, changes):
+    """Apply the changes computed by diff_identity_state()
+
+    Phase three of reconcile_identity_relations().
+
+    :param manager: KeystoneManager to apply the changes with
+    :param changes: list of change tuples
+    """
+    for change in changes:
+        op = change[0]
+        log("Applying keystone change: {}".format(change), level=DEBUG)
+        if op == 'create_service':
+            _, name, service_type, desc = change
+            manager.create_service(name, service_type, description=desc)
+        elif op == 'delete_service':
+            manager.delete_service(change[1])
+        elif op == 'delete_endpoint':
+            manager.delete_endpoint(change[1])
+        elif op == 'create_endpoints':
+            _, service, region, urls = change
+            manager.create_endpoints(
+                region=region,
+                service_id=manager.resolve_service_id(service),
+                publicurl=urls['public'],
+                adminurl=urls['admin'],
+                internalurl=urls['internal'])
+        elif op == 'create_endpoint':
+            _, service, region, interface, url = change
+            manager.create_endpoint(manager.resolve_service_id(service), url,
+                                    interface=interface, region=region)
+        elif op == 'create_role':
+            manager.create_role(name=change[1])
+        elif op == 'create_project':
+            _, project, domain = change
+            manager.create_tenant(tenant_name=project, domain=domain,
+                                  description='Created by Juju')
+        else:
+            raise ValueError('Unknown keystone change {}'.format(op))
+
+
+@retry_on_stale_ids
+def reconcile_identity_relations():
+    """Bring keystone in line with every identity-service and
+    identity-credentials relation at once.
+
+    The desired services, endpoints, roles, projects and users are collected
+    from all related units, compared with keystone's current state and only
+    the missing or stale objects are written.  Each user is then ensured once
+    rather than once per related unit.
+
+    :returns: set of (relation_id, unit) that now only need their relation
+              data publishing.
+    """
+    state, units = collect_desired_identity_state()
+    manager = get_manager()
+    changes = diff_identity_state(manager, state)
+    log("Reconciling keystone with identity relations: {} change(s)"
+        .format(len(changes)), level=INFO)
+    apply_identity_changes(manager, changes)
+
+    for username, new_roles in state['service_users'].items():
+        create_service_credentials(username, new_roles=new_roles)
+    for (username, domain), user in state['credentials_users'].items():
+        create_user_credentials(username,
+                                get_service_password,
+                                set_service_password,
+                                tenant=user['tenant'],
+                                new_roles=user['new_roles'],
+                                grants=user['grants'],
+                                domain=domain)
+    return units
+
+
+def identity_relation_fingerprints():
+    """Fingerprint the inputs of every identity-service and -credentials unit
+
+    A fingerprint hashes the unit's relation settings together with what we
+    publish back to it: addresses, ports, protocol, API version, admin domain,
+    admin token, the service and credentials passwords held by the leader
+    and the relevant charm options.
+
+    :returns: dict of fingerprints keyed on (relation_id, unit)
+    """
+    published = {
+        'addresses': [resolve_address(ADMIN), resolve_address(PUBLIC),
+                      resolve_address(INTERNAL)],
+        'protocol': get_protocol(),
+        'api_version': get_api_version(),
+        'admin_domain_id': leader_get(attribute='admin_domain_id'),
+        'admin_token': get_admin_token(),
+        'passwords': dict((k, v) for k, v in (leader_get() or {}).items()
+                          if k.endswith('_passwd')),
+        'config': dict((k, config(k)) for k in FINGERPRINT_CONFIG),
+    }
+    fingerprints = {}
+    for relation in ('identity-service', 'identity-credentials'):
+        for rid in relation_ids(relation):
+            for unit in related_units(rid):
+                inputs = dict(published,
+                              settings=relation_get(rid=rid, unit=unit))
+                fingerprints[(rid, unit)] = hashlib.sha256(
+                    json.dumps(inputs, sort_keys=True)).hexdigest()
+    return fingerprints
+
+
+def changed_identity_relation_units(fingerprints):
+    """Return the (relation_id, unit) whose fingerprint changed since stored
+
+    :param fingerprints: dict from identity_relation_fingerprints()
+    """
+    stored = unitdata.kv().getrange(FINGERPRINT_PREFIX, strip=True)
+    return set(key for key, fingerprint in fingerprints.items()
+               if stored.get('{}:{}'.format(*key)) != fingerprint)
+
+
+def store_identity_relation_fingerprints(fingerprints):
+    """Record the fingerprints of the units handled, forgetting departed ones
+
+    :param fingerprints: dict from identity_relation_fingerprints()
+    """
+    db = unitdata.kv()
+    db.unsetrange(prefix=FINGERPRINT_PREFIX)
+    db.update(dict(('{}:{}'.format(*key), fingerprint)
+                   for key, fingerprint in fingerprints.items()),
+              prefix=FINGERPRINT_PREFIX)
+    db.flush()
+
+
+def _unit_state_retention():
+    return {'keep_revisions': config('unit-state-keep-revisions'),
+            'keep_days': config('unit-state-keep-days')}
+
+
+def prune_unit_state():
+    """Drop a chunk of the unit state history outside the retention window
+
+    Run at the end of every hook so that the history is trimmed a little at
+    a time rather than all at once.
+    """
+    db = unitdata.kv()
+    pruned = db.prune(**_unit_state_retention())
+    if pruned:
+        db.flush()
+        log("Pruned {} hook revisions from the unit state".format(pruned),
+            level=DEBUG)
+
+
+def compact_unit_state():
+    """Drop all unit state history outside the retention window and shrink
+    the database file
+
+    :returns: (stats before, stats after) as returned by Storage.stats()
+    """
+    db = unitdata.kv()
+    before = db.stats()
+    db.compact(**_unit_state_retention())
+    after = db.stats()
+    log("Compacted the unit state from {} to {} bytes".format(
+        before['size'] + before['wal-size'],
+        after['size'] + after['wal-size']), level=INFO)
+    return before, after
+
+
+def restart_coordinator():
+    """Return the RestartCoordinator rolling the restarts of the peer units
+
+    Only rolling-restart-slots units restart their services at the same time
+    so that the cluster keeps serving requests throughout.
+
+    It handles the restarts deferred to hook exit, i.e. those of the
+    config-changed and identity-service hooks.  The other hooks restart
+    straight away: they go on to call the keystone API, or leave the unit
+    unusable, with the new configuration until the services restart.
+    """
+    return RestartCoordinator(
+        peer_relation='cluster',
+        slots=config('rolling-restart-slots'),
+        timeout=config('rolling-restart-timeout'),
+        restart_functions=restart_function_map())
+
+
 def get_protocol():
     """Determine the http protocol
 
@@ -1974,48 +2531,134 @@ def fernet_rotate():
     subprocess.check_call(cmd)
 
 
+def _key_digest(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _key_file_digest(path):
+    try:
+        with open(path, 'r') as f:
+            return _key_digest(f.read())
+    except (IOError, OSError):
+        return None
+
+
+def _key_repositories(value):
+    """Parse the "key_repository" leader setting
+
+    The setting is {'generation': n, 'keys': {repository: {key number: key}},
+    'digests': {repository: {key number: sha256 of key}}}.  Settings written
+    by earlier charm versions only hold the keys, they get digests and no
+    generation.  Since then, 'published' holds the time of publication.
+
+    :returns: the parsed setting or None if it is not set
+    """
+    if not value:
+        return None
+    value = json.loads(value)
+    if 'generation' not in value:
+        value = {'generation': None,
+                 'keys': value,
+                 'digests': dict(
+                     (key_repository, dict((key_number, _key_digest(key))
+                                           for key_number, key
+                                           in keys.items()))
+                     for key_repository, keys in value.items())}
+    return value
+
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def key_leader_set():
     """Read current key sets and update leader storage
 
     The keys are read from the `FERNET_KEY_REPOSITORY` and
-    `CREDENTIAL_KEY_REPOSITORY` directories.  Note that this function will fail
-    if it is called on the unit that is not the leader.
+    `CREDENTIAL_KEY_REPOSITORY` directories and published along with their
+    digests.  The generation of the repositories is bumped whenever a key
+    changes and nothing is written when none did.  Note that this function
+    will fail if it is called on the unit that is not the leader.
+
+    The settings are committed straight away as this also runs from the
+    rotation script, outside of any hook.
 
     :raises: :class:`subprocess.CalledProcessError` if the leader_set fails.
     """
     disk_keys = {}
+    digests = {}
     for key_repository in [FERNET_KEY_REPOSITORY, CREDENTIAL_KEY_REPOSITORY]:
         disk_keys[key_repository] = {}
         for key_number in os.listdir(key_repository):
             with open(os.path.join(key_repository, key_number),
                       'r') as f:
                 disk_keys[key_repository][key_number] = f.read()
-    leader_set({'key_repository': json.dumps(disk_keys)})
+        digests[key_repository] = dict(
+            (key_number, _key_digest(key))
+            for key_number, key in disk_keys[key_repository].items())
+    current = _key_repositories(leader_get('key_repository'))
+    if current and current['digests'] == digests:
+        log("Key repositories unchanged at generation {}".format(
+            current['generation']), level=DEBUG)
+        return
+    generation = ((current or {}).get('generation') or 0) + 1
+    leader_set({'key_repository': json.dumps(
+        {'generation': generation, 'keys': disk_keys, 'digests': digests,
+         'published': time.time()},
+        sort_keys=True)})
+    leader_commit()
 
 
 def key_write():
     """Get keys from leader storage and write out to disk
 
     The keys are written to the `FERNET_KEY_REPOSITORY` and
-    `CREDENTIAL_KEY_REPOSITORY` directories.  Note that the keys are first
-    written to a tmp file and then moved to the key to avoid any races.  Any
-    'excess' keys are deleted, which may occur if the "number of keys" has been
-    reduced on the leader.
+    `CREDENTIAL_KEY_REPOSITORY` directories.  Only the keys whose digest
+    differs from the one of the key file on disk are written, first to a tmp
+    file and then moved to the key to avoid any races.  Any 'excess' keys are
+    deleted, which may occur if the "number of keys" has been reduced on the
+    leader.  Nothing is done when the generation of the leader's repositories
+    has already been written out, and nothing is written at all if a key
+    does not match its digest.
     """
-    leader_keys = leader_get('key_repository')
-    if not leader_keys:
+    repositories = _key_repositories(leader_get('key_repository'))
+    if not repositories:
         log('"key_repository" not in leader settings yet...', level=DEBUG)
         return
-    leader_keys = json.loads(leader_keys)
+    generation = repositories['generation']
+    db = unitdata.kv()
+    written = generation is not None and os.path.exists(KEY_SETUP_FILE)
+    if written and db.get(KEY_GENERATION_KEY) == generation:
+        log("Key repositories already at generation {}".format(generation),
+            level=DEBUG)
+        publish_key_acknowledgement()
+        return
+    for key_repository, keys in repositories['keys'].items():
+        digests = repositories['digests'].get(key_repository, {})
+        for key_number, key in keys.items():
+            if _key_digest(key) != digests.get(key_number):
+                log("Key {} of {} does not match its digest, not writing "
+                    "generation {} of the key repositories".format(
+                        key_number, key_repository, generation), level=ERROR)
+                return
     for key_repository in [FERNET_KEY_REPOSITORY, CREDENTIAL_KEY_REPOSITORY]:
         mkdir(key_repository,
               owner=KEYSTONE_USER,
               group=KEYSTONE_USER,
               perms=0o700)
-        for key_number, key in leader_keys[key_repository].items():
+        keys = repositories['keys'].get(key_repository, {})
+        digests = repositories['digests'].get(key_repository, {})
+        changed = False
+        for key_number, key in keys.items():
+            key_filename = os.path.join(key_repository, key_number)
+            if _key_file_digest(key_filename) == digests[key_number]:
+                continue
             tmp_filename = os.path.join(key_repository,
                                         ".{}".format(key_number))
-            key_filename = os.path.join(key_repository, key_number)
             # write to tmp file first, move the key into place in an atomic
             # operation avoiding any races with consumers of the key files
             write_file(tmp_filename,
@@ -2024,15 +2667,131 @@ def key_write():
                        group=KEYSTONE_USER,
                        perms=0o600)
             os.rename(tmp_filename, key_filename)
+            changed = True
         # now delete any keys that shouldn't be there
         for key_number in os.listdir(key_repository):
-            if key_number not in leader_keys[key_repository].keys():
+            if key_number not in keys:
                 os.remove(os.path.join(key_repository, key_number))
-        # also say that keys have been setup for this system.
-        open(KEY_SETUP_FILE, "w").close()
+                changed = True
+        if changed:
+            _fsync_directory(key_repository)
+    # also say that keys have been setup for this system.
+    open(KEY_SETUP_FILE, "w").close()
+    if generation is not None:
+        db.set(KEY_GENERATION_KEY, generation)
+        db.flush()
+    publish_key_acknowledgement()
+
+
+def _key_set_digest(digests):
+    return hashlib.sha256(
+        json.dumps(digests, sort_keys=True).encode('utf-8')).hexdigest()
+
 
+def publish_key_acknowledgement():
+    """Publish the digest of the Fernet keys installed on this unit
 
-def fernet_keys_rotate_and_sync(log_func=log):
+    The digest is published on the cluster relation, the leader waits for
+    its peer units to have installed its keys before rotating them again,
+    see fernet_rotation_acknowledged().
+    """
+    if not os.path.isdir(FERNET_KEY_REPOSITORY):
+        return
+    digests = dict(
+        (key_number, _key_file_digest(
+            os.path.join(FERNET_KEY_REPOSITORY, key_number)))
+        for key_number in os.listdir(FERNET_KEY_REPOSITORY)
+        if not key_number.startswith('.'))
+    digest = _key_set_digest(digests)
+    for rid in relation_ids('cluster'):
+        relation_set(relation_id=rid,
+                     relation_settings={FERNET_KEY_DIGEST_KEY: digest})
+
+
+def key_acknowledgements():
+    """Return which peer units have installed the leader's Fernet keys
+
+    The number of seconds it took each unit to install the current keys,
+    from their publication until the leader saw the unit's digest, is
+    logged and kept in unitdata under `FERNET_KEY_ACKS_KEY` as
+    {'generation': n, 'latency': {unit: seconds}}.
+
+    :returns: (set of the units that installed the keys, number of peers)
+    """
+    repositories = _key_repositories(leader_get('key_repository'))
+    peers = [(rid, unit) for rid in relation_ids('cluster')
+             for unit in related_units(rid)]
+    if not repositories:
+        return set(), len(peers)
+    expected = _key_set_digest(
+        repositories['digests'].get(FERNET_KEY_REPOSITORY, {}))
+    acked = set(unit for rid, unit in peers
+                if relation_get(FERNET_KEY_DIGEST_KEY, rid=rid,
+                                unit=unit) == expected)
+    db = unitdata.kv()
+    metrics = db.get(FERNET_KEY_ACKS_KEY) or {}
+    if metrics.get('generation') != repositories['generation']:
+        metrics = {'generation': repositories['generation'], 'latency': {}}
+    published = repositories.get('published')
+    new = sorted(acked - set(metrics['latency']))
+    for unit in new:
+        latency = time.time() - published if published else None
+        metrics['latency'][unit] = latency
+        log("Fernet keys generation {} installed on {} after {}".format(
+            repositories['generation'], unit,
+            '{:.1f}s'.format(latency) if latency is not None else 'unknown'),
+            level=INFO)
+    if new:
+        db.set(FERNET_KEY_ACKS_KEY, metrics)
+        db.flush()
+    return acked, len(peers)
+
+
+def _fernet_rotation_quorum(acknowledgements=None):
+    """Return how many peer units installed the leader's Fernet keys
+
+    :param acknowledgements: result of key_acknowledgements(), read if None
+    :returns: (units that installed the keys, units required to rotate them,
+               peer units)
+    :rtype: (int, int, int)
+    """
+    if acknowledgements is None:
+        acknowledgements = key_acknowledgements()
+    acked, peers = acknowledgements
+    required = min(config('fernet-rotation-quorum') or peers, peers)
+    return len(acked), required, peers
+
+
+def fernet_rotation_acknowledged(due_since, log_func=log,
+                                 acknowledgements=None):
+    """Whether enough peer units installed the Fernet keys to rotate them
+
+    Rotating promotes the staging key to primary key, units that have not
+    installed it yet would fail to validate the tokens it signs.  The
+    rotation waits for `fernet-rotation-quorum` peer units, all of them by
+    default, or until `fernet-rotation-ack-timeout` seconds past due_since.
+
+    :param due_since: time at which the rotation became due
+    :type due_since: float
+    :param log_func: Function to use for logging
+    :type log_func: func
+    :param acknowledgements: result of key_acknowledgements(), read if None
+    :type acknowledgements: Option[(set, int)]
+    :rtype: bool
+    """
+    acked, required, peers = _fernet_rotation_quorum(acknowledgements)
+    if acked >= required:
+        return True
+    if time.time() - due_since >= config('fernet-rotation-ack-timeout'):
+        log_func("Rotating fernet keys installed on only {} of {} peer units"
+                 .format(acked, peers), level=WARNING)
+        return True
+    log_func("Fernet key rotation waiting for {} more peer units to install "
+             "the keys".format(required - acked), level=INFO)
+    return False
+
+
+def fernet_keys_rotate_and_sync(log_func=log, acknowledgements=None):
     """Rotate and sync the keys if the unit is the leader and the primary key
     has expired.
 
@@ -2049,14 +2808,20 @@ def fernet_keys_rotate_and_sync(log_func=log):
 
     where max-active-keys has a minumum of 3.
 
+    The rotation is put off until the peer units have installed the current
+    keys, see fernet_rotation_acknowledged().
+
     :param log_func: Function to use for logging
     :type log_func: func
+    :param acknowledgements: result of key_acknowledgements(), read if None
+    :type acknowledgements: Option[(set, int)]
     """
     if not keystone_context.fernet_enabled() or not is_leader():
         return
     if is_unit_paused_set():
         log_func("Fernet key rotation requested but unit is paused",
                  level=INFO)
+        update_fernet_rotation_schedule()
         return
     # now see if the keys need to be rotated
     try:
@@ -2065,10 +2830,9 @@ def fernet_keys_rotate_and_sync(log_func=log):
     except OSError:
         log_func("Fernet key rotation requested but key repository not "
                  "initialized yet", level=WARNING)
+        update_fernet_rotation_schedule()
         return
-    max_keys = max(config('fernet-max-active-keys'), 3)
-    expiration = config('token-expiration')
-    rotation_time = expiration // (max_keys - 2)
+    rotation_time = fernet_rotation_interval()
     now = time.time()
     if last_rotation + rotation_time > now:
         # Nothing to do as not reached rotation time
@@ -2076,9 +2840,107 @@ def fernet_keys_rotate_and_sync(log_func=log):
                  .format(
                      time.asctime(time.gmtime(last_rotation + rotation_time))),
                  level=DEBUG)
+        update_fernet_rotation_schedule()
+        return
+    if not fernet_rotation_acknowledged(last_rotation + rotation_time,
+                                        log_func=log_func,
+                                        acknowledgements=acknowledgements):
+        update_fernet_rotation_schedule()
         return
     # now rotate the keys and sync them
     fernet_rotate()
     key_leader_set()
     log_func("Rotated and started sync (via leader settings) of fernet keys",
              level=INFO)
+    update_fernet_rotation_schedule()
+
+
+def fernet_rotation_interval():
+    """Return the number of seconds between two Fernet key rotations
+
+    The rotation time = token-expiration / (max-active-keys - 2)
+
+    where max-active-keys has a minumum of 3.
+    """
+    max_keys = max(config('fernet-max-active-keys'), 3)
+    return config('token-expiration') // (max_keys - 2)
+
+
+def fernet_rotation_deadline():
+    """Return when this unit is next due to rotate the Fernet keys
+
+    A rotation that is due while too few peer units have installed the
+    current keys waits until `fernet-rotation-ack-timeout` seconds past its
+    time, cluster-relation-changed rotates the keys as soon as enough peer
+    units have installed them.
+
+    :returns: seconds since the epoch, or None if this unit does not rotate
+              the keys
+    :rtype: Option[int]
+    """
+    if not keystone_context.fernet_enabled() or not is_leader():
+        return None
+    try:
+        last_rotation = os.stat(
+            os.path.join(FERNET_KEY_REPOSITORY, '0')).st_mtime
+    except OSError:
+        return None
+    deadline = last_rotation + fernet_rotation_interval()
+    if deadline <= time.time():
+        acked, required, peers = _fernet_rotation_quorum()
+        if acked < required:
+            deadline += config('fernet-rotation-ack-timeout')
+    return int(math.ceil(deadline))
+
+
+def _write_if_changed(path, content, perms=0o644):
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    write_file(path, content, perms=perms)
+    return True
+
+
+def update_fernet_rotation_schedule():
+    """Schedule the next Fernet key rotation on the leader
+
+    The rotation deadline is written to `FERNET_ROTATION_DEADLINE_FILE` and a
+    systemd timer fires at the deadline, or shortly after it is started if
+    the deadline has already passed.  It runs
+    scripts/fernet_rotation_due.py, which only reads the deadline file and
+    runs scripts/fernet_rotate_and_sync.py through juju-run if the rotation
+    is due, the rotation then schedules the next one.  The timer also fires
+    `FERNET_ROTATION_RETRY_INTERVAL` seconds after each run in case that run
+    could not rotate the keys.  The timer is removed from units that do not
+    rotate the keys.
+    """
+    if os.path.exists(FERNET_KEY_ROTATE_SYNC_CRON_FILE):
+        os.remove(FERNET_KEY_ROTATE_SYNC_CRON_FILE)
+    timer = os.path.basename(FERNET_ROTATE_SYNC_TIMER)
+    ctxt = keystone_context.FernetRotationContext()()
+    if not ctxt['enabled']:
+        if os.path.exists(FERNET_ROTATE_SYNC_TIMER):
+            log("Removing the Fernet key rotation timer", level=DEBUG)
+            subprocess.check_call(['systemctl', 'disable', '--now', timer])
+            for path in (FERNET_ROTATE_SYNC_TIMER, FERNET_ROTATE_SYNC_SERVICE):
+                os.remove(path)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        if os.path.exists(FERNET_ROTATION_DEADLINE_FILE):
+            os.remove(FERNET_ROTATION_DEADLINE_FILE)
+        return
+    _write_if_changed(FERNET_ROTATION_DEADLINE_FILE,
+                      '{}\n'.format(ctxt['deadline']))
+    changed = False
+    for path in (FERNET_ROTATE_SYNC_SERVICE, FERNET_ROTATE_SYNC_TIMER):
+        content = render(os.path.basename(path), None, ctxt)
+        changed = _write_if_changed(path, content) or changed
+    if changed:
+        when = ctxt['on_calendar'] or 'in {} seconds'.format(
+            ctxt['on_active_sec'])
+        log("Next Fernet key rotation at {}".format(when), level=DEBUG)
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+        subprocess.check_call(['systemctl', 'enable', timer])
+        subprocess.check_call(['systemctl', 'restart', timer])
@@ -14,10 +14,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import requests
+import six
+
 from keystoneclient.v2_0 import client
 from keystoneclient.v3 import client as keystoneclient_v3
 from keystoneclient.auth import token_endpoint
 from keystoneclient import session, exceptions
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import log, ERROR
 from charmhelpers.core.decorators import retry_on_exception
 
 # Early versions of keystoneclient lib do not have an explicit
@@ -27,19 +38,107 @@ if hasattr(exceptions, 'ConnectionRefused'):
 else:
     econnrefused = exceptions.ConnectionError
 
+# unitdata key holding {endpoint: api_version} for endpoints whose API version
+# has been confirmed against the catalog.
+API_VERSION_KEY = 'keystone-manager-api-versions'
+
+# unitdata key holding the persistent KeystoneIdCache.
+ID_CACHE_KEY = 'keystone-manager-ids'
+
+# Maximum number of keep-alive connections pooled per host.
+HTTP_POOL_SIZE = 8
+
+# Default number of API calls KeystoneManager.batch() runs at once.
+BATCH_WORKERS = 4
+
+# Managers built by this process keyed on (endpoint, api_version) and the
+# pooled HTTP session they share.
+_managers = {}
+_http_session = None
+
+# In memory copy of the API_VERSION_KEY unitdata entry, unitdata can only be
+# used from the thread that opened it.
+_api_versions = None
+
+# Marks threads currently running a batched call.
+_batch_state = threading.local()
+
+
+def _get_http_session():
+    """Return the requests session shared by every manager in this process
+
+    Connections to keystone are kept alive and pooled so that successive API
+    calls do not each pay for a new TCP connection.
+    """
+    global _http_session
+    if _http_session is None:
+        _http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=HTTP_POOL_SIZE)
+        _http_session.mount('http://', adapter)
+        _http_session.mount('https://', adapter)
+    return _http_session
+
+
+def _get_session(endpoint, token):
+    """Return a keystoneclient session authenticated with the admin token"""
+    auth = token_endpoint.Token(endpoint=endpoint, token=token)
+    return session.Session(auth=auth, session=_get_http_session())
+
+
+def _run_batch_call(call):
+    """Run one batched call returning (result, exc_info)"""
+    nested = getattr(_batch_state, 'active', False)
+    _batch_state.active = True
+    try:
+        return call(), None
+    except BaseException:
+        # NOTE: error_out() exits, catch that too so the pool is not wedged
+        return None, sys.exc_info()
+    finally:
+        _batch_state.active = nested
+
+
+def reset_keystone_managers():
+    """Forget every manager built so far, e.g. after keystone restarts"""
+    global _http_session, _api_versions
+    _managers.clear()
+    _api_versions = None
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+
 
 def _get_keystone_manager_class(endpoint, token, api_version):
     """Return KeystoneManager class for the given API version
+
+    Managers are reused for the life of the process, one per endpoint and API
+    version, unless the admin token has changed.
+
     @param endpoint: the keystone endpoint to point client at
     @param token: the keystone admin_token
     @param api_version: version of the keystone api the client should use
     @returns keystonemanager class used for interrogating keystone
     """
+    manager = _managers.get((endpoint, api_version))
+    if manager is not None and manager.token == token:
+        return manager
     if api_version == 2:
-        return KeystoneManager2(endpoint, token)
-    if api_version == 3:
-        return KeystoneManager3(endpoint, token)
-    raise ValueError('No manager found for api version {}'.format(api_version))
+        manager = KeystoneManager2(endpoint, token)
+    elif api_version == 3:
+        manager = KeystoneManager3(endpoint, token)
+    else:
+        raise ValueError(
+            'No manager found for api version {}'.format(api_version))
+    _managers[(endpoint, api_version)] = manager
+    return manager
+
+
+def _endpoint_api_version(endpoint):
+    """Return the API version implied by the endpoint suffix"""
+    if 'v2.0' in endpoint.split('/'):
+        return 2
+    return 3
 
 
 @retry_on_exception(5, base_delay=3, exc_type=econnrefused)
@@ -55,6 +154,9 @@ def get_keystone_manager(endpoint, token, api_version=None):
         detection automatically so the code below could be greatly
         simplified
 
+    Once the catalogue confirms the version implied by the endpoint it is
+    remembered in unitdata so later hooks skip the discovery altogether.
+
     @param endpoint: the keystone endpoint to point client at
     @param token: the keystone admin_token
     @param api_version: version of the keystone api the client should use
@@ -63,10 +165,16 @@ def get_keystone_manager(endpoint, token, api_version=None):
     if api_version:
         return _get_keystone_manager_class(endpoint, token, api_version)
     else:
-        if 'v2.0' in endpoint.split('/'):
-            manager = _get_keystone_manager_class(endpoint, token, 2)
-        else:
-            manager = _get_keystone_manager_class(endpoint, token, 3)
+        global _api_versions
+        if _api_versions is None:
+            _api_versions = unitdata.kv().get(API_VERSION_KEY, {})
+        known_versions = _api_versions
+        if endpoint in known_versions:
+            return _get_keystone_manager_class(endpoint, token,
+                                               known_versions[endpoint])
+        endpoint_version = _endpoint_api_version(endpoint)
+        manager = _get_keystone_manager_class(endpoint, token,
+                                              endpoint_version)
         if endpoint.endswith('/'):
             base_ep = endpoint.rsplit('/', 2)[0]
         else:
@@ -81,88 +189,502 @@ def get_keystone_manager(endpoint, token, api_version=None):
                 version = ep.adminurl.split('/')[-1]
         if version and version == 'v2.0':
             new_ep = base_ep + "/" + 'v2.0'
-            return _get_keystone_manager_class(new_ep, token, 2)
+            manager = _get_keystone_manager_class(new_ep, token, 2)
         elif version and version == 'v3':
             new_ep = base_ep + "/" + 'v3'
-            return _get_keystone_manager_class(new_ep, token, 3)
+            manager = _get_keystone_manager_class(new_ep, token, 3)
+        # NOTE: only remember a version the catalogue agrees with, a
+        # redirect to another version may be transient while the identity
+        # endpoint is being migrated.
+        if manager.api_version == endpoint_version:
+            known_versions[endpoint] = endpoint_version
+            db = unitdata.kv()
+            db.set(API_VERSION_KEY, known_versions)
+            db.flush()
+        return manager
+
+
+class KeystoneSnapshot(object):
+    """Indexed, per-hook view of the Keystone catalog and identity objects.
+
+    Each collection (roles, services, endpoints, domains, projects and users)
+    is listed from the API at most once and indexed by lowercased name and by
+    (lowercased name, domain_id).  Collections that are looked up with server
+    side filters instead are never listed in full, the result of each filtered
+    lookup is remembered instead.  The manager owning the snapshot records the
+    objects it creates and deletes so that the indexes stay accurate for the
+    rest of the hook.
+    """
+
+    def __init__(self):
+        # Managers may update the snapshot from batch() worker threads
+        self._lock = threading.RLock()
+        self._objects = {}
+        self._by_name = {}
+        self._by_name_domain = {}
+        self._lookups = {}
+
+    def is_loaded(self, kind):
+        return kind in self._objects
+
+    def load(self, kind, objects):
+        """Replace the contents of a collection with the listed objects"""
+        with self._lock:
+            self._objects[kind] = OrderedDict()
+            self._by_name[kind] = {}
+            self._by_name_domain[kind] = {}
+            for obj in objects:
+                self.add(kind, obj)
+
+    @staticmethod
+    def _matches(key, obj):
+        name, domain_id, any_domain = key
+        info = obj._info
+        if info.get('name') is None or info['name'].lower() != name.lower():
+            return False
+        if domain_id is None and any_domain:
+            return True
+        return info.get('domain_id') == domain_id
+
+    def add(self, kind, obj):
+        """Record an object in its collection and matching lookups
+
+        Objects are only added to a collection once it has been loaded.
+        """
+        with self._lock:
+            info = obj._info
+            self.remove(kind, info['id'])
+            for key, found in self._lookups.get(kind, {}).items():
+                if self._matches(key, obj):
+                    found.append(obj)
+            if not self.is_loaded(kind):
+                return
+            self._objects[kind][info['id']] = obj
+            name = info.get('name')
+            if name is not None:
+                self._by_name[kind].setdefault(name.lower(), []).append(obj)
+                key = (name.lower(), info.get('domain_id'))
+                self._by_name_domain[kind].setdefault(key, []).append(obj)
+
+    def remove(self, kind, obj_id):
+        """Drop an object from a collection, its indexes and lookups"""
+        with self._lock:
+            for key, found in self._lookups.get(kind, {}).items():
+                found[:] = [o for o in found if o._info['id'] != obj_id]
+            if not self.is_loaded(kind):
+                return
+            obj = self._objects[kind].pop(obj_id, None)
+            if obj is None:
+                return
+            name = obj._info.get('name')
+            if name is not None:
+                self._by_name[kind][name.lower()].remove(obj)
+                key = (name.lower(), obj._info.get('domain_id'))
+                self._by_name_domain[kind][key].remove(obj)
+
+    def remember(self, kind, name, domain_id, any_domain, objects):
+        """Record the result of a server side filtered lookup
+
+        Lookups that matched nothing are recorded too, objects created later
+        are added to the lookups they match.  Results are keyed on the
+        lowercased name like the collection indexes.
+        """
+        with self._lock:
+            key = (name.lower(), domain_id, any_domain)
+            self._lookups.setdefault(kind, {})[key] = list(objects)
+
+    def recall(self, kind, name, domain_id=None, any_domain=True):
+        """Return a remembered lookup result, or None if there is none"""
+        with self._lock:
+            found = self._lookups.get(kind, {}).get(
+                (name.lower(), domain_id, any_domain))
+            if found is None:
+                return None
+            return list(found)
+
+    def invalidate(self, kind=None):
+        """Forget one collection, or all of them, so they are listed again"""
+        with self._lock:
+            kinds = [kind] if kind else list(
+                set(self._objects.keys()) | set(self._lookups.keys()))
+            for k in kinds:
+                self._objects.pop(k, None)
+                self._by_name.pop(k, None)
+                self._by_name_domain.pop(k, None)
+                self._lookups.pop(k, None)
+
+    def all(self, kind):
+        with self._lock:
+            return list(self._objects[kind].values())
+
+    def find(self, kind, name, domain_id=None, any_domain=True):
+        """Return the objects of kind called name (case insensitive)
+
+        @param domain_id: only return objects owned by this domain
+        @param any_domain: when False a domain_id of None is matched literally
+                           rather than meaning any domain
+        """
+        with self._lock:
+            if domain_id is None and any_domain:
+                return list(self._by_name[kind].get(name.lower(), []))
+            return list(self._by_name_domain[kind].get(
+                (name.lower(), domain_id), []))
+
+
+class KeystoneIdCache(object):
+    """Persistent cache of Keystone object IDs keyed on kind, name and domain
+
+    Domain, project, role and service IDs practically never change once
+    created so they are remembered in unitdata across hooks rather than looked
+    up by name every time.  Entries are not checked up front, callers drop the
+    ones served to them once keystone reports an ID as not found (see
+    mark() and drop_served()).  The cache is tied to a scope, such as the
+    database in use, and starts out empty whenever the scope changes.
+
+    Entries are kept in memory and only written back by save(), which must run
+    in the thread that opened unitdata.
+    """
+
+    def __init__(self, scope=None):
+        self._lock = threading.RLock()
+        # IDs served to each thread, see mark()
+        self._local = threading.local()
+        stored = unitdata.kv().get(ID_CACHE_KEY) or {}
+        self.scope = scope
+        if stored.get('scope') == scope:
+            self._ids = stored.get('ids', {})
+            self._dirty = False
         else:
-            return manager
+            self._ids = {}
+            self._dirty = bool(stored)
+
+    @staticmethod
+    def _key(kind, name, domain=None):
+        return '{}/{}/{}'.format(kind, domain or '', name)
+
+    def _served(self):
+        if not hasattr(self._local, 'served'):
+            self._local.served = []
+        return self._local.served
+
+    def get(self, kind, name, domain=None):
+        """Return the cached ID or None"""
+        key = self._key(kind, name, domain)
+        with self._lock:
+            obj_id = self._ids.get(key)
+        if obj_id is not None:
+            self._served().append(key)
+        return obj_id
+
+    def set(self, kind, name, domain, obj_id):
+        with self._lock:
+            key = self._key(kind, name, domain)
+            if self._ids.get(key) != obj_id:
+                self._ids[key] = obj_id
+                self._dirty = True
+
+    def discard_id(self, obj_id):
+        """Drop every entry resolving to obj_id, e.g. once it is deleted"""
+        with self._lock:
+            for key, value in list(self._ids.items()):
+                if value == obj_id:
+                    del self._ids[key]
+                    self._dirty = True
+
+    def mark(self):
+        """Return a marker for the IDs served to this thread so far"""
+        return len(self._served())
+
+    def drop_served(self, mark):
+        """Drop the entries served to this thread since mark
+
+        @returns the list of dropped entries
+        """
+        served = self._served()
+        dropped = sorted(set(served[mark:]))
+        del served[mark:]
+        with self._lock:
+            for key in dropped:
+                if self._ids.pop(key, None) is not None:
+                    self._dirty = True
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            if self._ids:
+                self._ids = {}
+                self._dirty = True
+
+    def save(self):
+        """Write the cache back to unitdata if it has changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            db = unitdata.kv()
+            db.set(ID_CACHE_KEY, {'scope': self.scope, 'ids': self._ids})
+            db.flush()
+            self._dirty = False
 
 
 class KeystoneManager(object):
 
-    def resolve_domain_id(self, name):
+    # Maps snapshot collection names to the keystoneclient API attribute that
+    # lists them.
+    collections = {
+        'roles': 'roles',
+        'services': 'services',
+        'endpoints': 'endpoints',
+        'users': 'users',
+    }
+
+    snapshot = None
+    id_cache = None
+
+    # Maximum number of calls batch() runs at once
+    batch_workers = BATCH_WORKERS
+
+    def enable_snapshot(self, snapshot=None):
+        """Serve lookups from an indexed snapshot of the Keystone objects
+
+        @param snapshot: KeystoneSnapshot to share with other managers, a new
+                         one is created if not provided
+        @returns the snapshot in use
+        """
+        if snapshot is None:
+            snapshot = KeystoneSnapshot()
+        self.snapshot = snapshot
+        return snapshot
+
+    def disable_snapshot(self):
+        self.snapshot = None
+
+    def enable_id_cache(self, id_cache):
+        """Resolve domain, project, role and service IDs through id_cache"""
+        self.id_cache = id_cache
+
+    def disable_id_cache(self):
+        self.id_cache = None
+
+    def _cached_id(self, kind, name, domain, resolve, verify=False):
+        """Return the ID of an object from the ID cache or resolve()
+
+        With verify a cached ID is only trusted once keystone confirms that
+        the object still exists, for callers creating the object when it is
+        missing.
+        """
+        if self.id_cache is None:
+            return resolve()
+        obj_id = self.id_cache.get(kind, name, domain)
+        if obj_id is not None and verify and not self._exists(kind, obj_id):
+            self._deleted(kind, obj_id)
+            obj_id = None
+        if obj_id is None:
+            obj_id = resolve()
+            if obj_id is not None:
+                self.id_cache.set(kind, name, domain, obj_id)
+        return obj_id
+
+    def _exists(self, kind, obj_id):
+        """Whether keystone still has the object of kind with ID obj_id"""
+        api = getattr(self.api, self.collections[kind])
+        try:
+            api.get(obj_id)
+        except exceptions.NotFound:
+            return False
+        return True
+
+    def _list(self, kind, **filters):
+        """List the objects of kind, from the snapshot when enabled
+
+        Filters are passed to the API when no snapshot is in use.  A snapshot
+        always holds the complete collection, the filters are applied to it
+        instead, domain matching the objects' domain_id.
+        """
+        api = getattr(self.api, self.collections[kind])
+        if self.snapshot is None:
+            return list(api.list(**filters))
+        if not self.snapshot.is_loaded(kind):
+            self.snapshot.load(kind, api.list())
+        objects = self.snapshot.all(kind)
+        for key, value in filters.items():
+            if value is None:
+                continue
+            attr = 'domain_id' if key == 'domain' else key
+            objects = [o for o in objects if o._info.get(attr) == value]
+        return objects
+
+    def _find(self, kind, name, domain_id=None, any_domain=True, **filters):
+        """Find objects of kind by name and, optionally, owning domain"""
+        if self.snapshot is not None:
+            self._list(kind)
+            return self.snapshot.find(kind, name, domain_id=domain_id,
+                                      any_domain=any_domain)
+        found = []
+        for obj in self._list(kind, **filters):
+            info = obj._info
+            if name.lower() != info['name'].lower():
+                continue
+            if domain_id is not None or not any_domain:
+                if info.get('domain_id') != domain_id:
+                    continue
+            found.append(obj)
+        return found
+
+    def _created(self, kind, obj):
+        if self.snapshot is not None:
+            self.snapshot.add(kind, obj)
+        return obj
+
+    def _deleted(self, kind, obj_id):
+        if self.snapshot is not None:
+            self.snapshot.remove(kind, obj_id)
+        if self.id_cache is not None:
+            self.id_cache.discard_id(obj_id)
+
+    def batch(self, calls, workers=None):
+        """Run independent API calls concurrently
+
+        At most workers calls, and never more than the HTTP connection pool
+        holds, are in flight at once.  A batch started from within a batched
+        call runs inline so that nesting does not multiply the parallelism.
+        Every call is run even if some fail, the failures are then logged in
+        call order and the first one is re-raised.
+
+        @param calls: list of callables taking no arguments
+        @param workers: maximum number of concurrent calls, defaults to
+                        batch_workers
+        @returns list of the call results in call order
+        """
+        workers = min(workers or self.batch_workers, HTTP_POOL_SIZE,
+                      len(calls))
+        if workers <= 1 or getattr(_batch_state, 'active', False):
+            outcomes = [_run_batch_call(call) for call in calls]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                outcomes = pool.map(_run_batch_call, calls)
+            finally:
+                pool.close()
+                pool.join()
+        errors = [exc_info for _, exc_info in outcomes if exc_info]
+        for exc_info in errors:
+            log('Batched keystone call failed: {!r}'.format(exc_info[1]),
+                level=ERROR)
+        if errors:
+            six.reraise(*errors[0])
+        return [result for result, _ in outcomes]
+
+    def resolve_domain_id(self, name, verify=False):
         pass
 
-    def resolve_role_id(self, name):
-        """Find the role_id of a given role"""
-        roles = [r._info for r in self.api.roles.list()]
-        for r in roles:
-            if name.lower() == r['name'].lower():
-                return r['id']
+    def resolve_role_id(self, name, verify=False):
+        """Find the role_id of a given role
+
+        @param verify: check a cached ID against keystone before returning it
+        """
+        return self._cached_id('roles', name, None,
+                               lambda: self._resolve_role_id(name),
+                               verify=verify)
+
+    def _resolve_role_id(self, name):
+        for r in self._find('roles', name):
+            return r._info['id']
 
-    def resolve_service_id(self, name, service_type=None):
+    def resolve_service_id(self, name, service_type=None, verify=False):
         """Find the service_id of a given service"""
-        services = [s._info for s in self.api.services.list()]
-        for s in services:
-            if service_type:
-                if (name.lower() == s['name'].lower() and
-                        service_type == s['type']):
-                    return s['id']
-            else:
-                if name.lower() == s['name'].lower():
-                    return s['id']
+        return self._cached_id(
+            'services', name, service_type,
+            lambda: self._resolve_service_id(name, service_type),
+            verify=verify)
+
+    def _resolve_service_id(self, name, service_type=None):
+        for s in self._find('services', name):
+            if not service_type or service_type == s._info['type']:
+                return s._info['id']
 
     def resolve_service_id_by_type(self, type):
         """Find the service_id of a given service"""
-        services = [s._info for s in self.api.services.list()]
-        for s in services:
-            if type == s['type']:
-                return s['id']
+        for s in self._list('services'):
+            if type == s._info['type']:
+                return s._info['id']
+
+    def services_list(self):
+        return self._list('services')
+
+    def endpoints_list(self):
+        return self._list('endpoints')
+
+    def create_role(self, name):
+        return self._created('roles', self.api.roles.create(name=name))
+
+    def create_service(self, name, service_type, description):
+        return self._created('services',
+                             self.api.services.create(
+                                 name, service_type,
+                                 description=description))
+
+    def delete_service(self, service_id):
+        self.api.services.delete(service_id)
+        self._deleted('services', service_id)
+
+    def delete_endpoint(self, endpoint_id):
+        self.api.endpoints.delete(endpoint_id)
+        self._deleted('endpoints', endpoint_id)
 
 
 class KeystoneManager2(KeystoneManager):
 
+    collections = dict(KeystoneManager.collections, projects='tenants')
+
     def __init__(self, endpoint, token):
         self.api_version = 2
-        self.api = client.Client(endpoint=endpoint, token=token)
+        self.endpoint = endpoint
+        self.token = token
+        self.api = client.Client(session=_get_session(endpoint, token))
 
     def resolve_user_id(self, name, user_domain=None):
         """Find the user_id of a given user"""
-        users = [u._info for u in self.api.users.list()]
-        for u in users:
-            if name.lower() == u['name'].lower():
-                return u['id']
+        for u in self._find('users', name):
+            return u._info['id']
 
     def create_endpoints(self, region, service_id, publicurl, adminurl,
                          internalurl):
-        self.api.endpoints.create(region=region, service_id=service_id,
-                                  publicurl=publicurl, adminurl=adminurl,
-                                  internalurl=internalurl)
+        self._created('endpoints',
+                      self.api.endpoints.create(region=region,
+                                                service_id=service_id,
+                                                publicurl=publicurl,
+                                                adminurl=adminurl,
+                                                internalurl=internalurl))
 
     def tenants_list(self):
-        return self.api.tenants.list()
+        return self._list('projects')
 
-    def resolve_tenant_id(self, name, domain=None):
+    def resolve_tenant_id(self, name, domain=None, verify=False):
         """Find the tenant_id of a given tenant"""
-        tenants = [t._info for t in self.api.tenants.list()]
-        for t in tenants:
-            if name.lower() == t['name'].lower():
-                return t['id']
+        return self._cached_id('projects', name, None,
+                               lambda: self._resolve_tenant_id(name),
+                               verify=verify)
+
+    def _resolve_tenant_id(self, name):
+        for t in self._find('projects', name):
+            return t._info['id']
 
     def create_tenant(self, tenant_name, description, domain='default'):
-        self.api.tenants.create(tenant_name=tenant_name,
-                                description=description)
+        self._created('projects',
+                      self.api.tenants.create(tenant_name=tenant_name,
+                                              description=description))
 
     def delete_tenant(self, tenant_id):
         self.api.tenants.delete(tenant_id)
+        self._deleted('projects', tenant_id)
 
     def create_user(self, name, password, email, tenant_id=None,
                     domain_id=None):
-        self.api.users.create(name=name,
-                              password=password,
-                              email=email,
-                              tenant_id=tenant_id)
+        self._created('users',
+                      self.api.users.create(name=name,
+                                            password=password,
+                                            email=email,
+                                            tenant_id=tenant_id))
 
     def update_password(self, user, password):
         self.api.users.update_password(user=user, password=password)
@@ -176,80 +698,146 @@ class KeystoneManager2(KeystoneManager):
 
 class KeystoneManager3(KeystoneManager):
 
+    collections = dict(KeystoneManager.collections, projects='projects',
+                       domains='domains')
+
+    # Collections keystone can filter by name and owning domain itself.
+    filtered_collections = ('domains', 'projects', 'roles', 'users')
+
     def __init__(self, endpoint, token):
         self.api_version = 3
-        keystone_auth_v3 = token_endpoint.Token(endpoint=endpoint, token=token)
-        keystone_session_v3 = session.Session(auth=keystone_auth_v3)
-        self.api = keystoneclient_v3.Client(session=keystone_session_v3)
-
-    def resolve_tenant_id(self, name, domain=None):
+        self.endpoint = endpoint
+        self.token = token
+        self.api = keystoneclient_v3.Client(
+            session=_get_session(endpoint, token))
+        # Collections whose backend has rejected the query filters
+        self.unfiltered_collections = set()
+
+    def _find(self, kind, name, domain_id=None, any_domain=True, **filters):
+        """Find objects using keystone's name and domain_id query filters
+
+        Only matching objects are returned by keystone so the lookup cost does
+        not grow with the size of the collection, which matters with large
+        LDAP identity backends.  An object the filters do not match is
+        absent, the whole collection is only listed when the backend rejects
+        the filters or when a snapshot already holds it.
+        """
+        loaded = self.snapshot is not None and self.snapshot.is_loaded(kind)
+        if any((kind not in self.filtered_collections,
+                kind in self.unfiltered_collections,
+                loaded)):
+            return super(KeystoneManager3, self)._find(
+                kind, name, domain_id=domain_id, any_domain=any_domain,
+                **filters)
+        if self.snapshot is not None:
+            found = self.snapshot.recall(kind, name, domain_id=domain_id,
+                                         any_domain=any_domain)
+            if found is not None:
+                return found
+        query = {'name': name}
+        if domain_id is not None:
+            query['domain'] = domain_id
+        api = getattr(self.api, self.collections[kind])
+        try:
+            objects = api.list(**query)
+        except (exceptions.BadRequest, exceptions.HttpNotImplemented):
+            self.unfiltered_collections.add(kind)
+            return super(KeystoneManager3, self)._find(
+                kind, name, domain_id=domain_id, any_domain=any_domain,
+                **filters)
+        # NOTE: keystone may ignore the domain filter, so apply the same
+        # checks as a full listing would.
+        key = (name, domain_id, any_domain)
+        found = [o for o in objects if KeystoneSnapshot._matches(key, o)]
+        if self.snapshot is not None:
+            self.snapshot.remember(kind, name, domain_id, any_domain, found)
+        return found
+
+    def resolve_tenant_id(self, name, domain=None, verify=False):
         """Find the tenant_id of a given tenant"""
+        return self._cached_id('projects', name, domain,
+                               lambda: self._resolve_tenant_id(name, domain),
+                               verify=verify)
+
+    def _resolve_tenant_id(self, name, domain=None):
+        domain_id = None
         if domain:
             domain_id = self.resolve_domain_id(domain)
-        tenants = [t._info for t in self.api.projects.list()]
-        for t in tenants:
-            if name.lower() == t['name'].lower() and \
-               (domain is None or t['domain_id'] == domain_id):
-                return t['id']
+        for t in self._find('projects', name, domain_id=domain_id,
+                            any_domain=domain is None):
+            return t._info['id']
 
-    def resolve_domain_id(self, name):
+    def resolve_domain_id(self, name, verify=False):
         """Find the domain_id of a given domain"""
-        domains = [d._info for d in self.api.domains.list()]
-        for d in domains:
-            if name.lower() == d['name'].lower():
-                return d['id']
+        return self._cached_id('domains', name, None,
+                               lambda: self._resolve_domain_id(name),
+                               verify=verify)
+
+    def _resolve_domain_id(self, name):
+        for d in self._find('domains', name):
+            return d._info['id']
 
     def resolve_user_id(self, name, user_domain=None):
         """Find the user_id of a given user"""
         domain_id = None
         if user_domain:
             domain_id = self.resolve_domain_id(user_domain)
-        for user in self.api.users.list(domain=domain_id):
-            if name.lower() == user.name.lower():
-                if user_domain:
-                    if domain_id == user.domain_id:
-                        return user.id
-                else:
-                    return user.id
+        for user in self._find('users', name, domain_id=domain_id,
+                               any_domain=user_domain is None,
+                               domain=domain_id):
+            return user.id
+
+    def create_endpoint(self, service_id, url, interface, region):
+        return self._created('endpoints',
+                             self.api.endpoints.create(service_id, url,
+                                                       interface=interface,
+                                                       region=region))
 
     def create_endpoints(self, region, service_id, publicurl, adminurl,
                          internalurl):
-        self.api.endpoints.create(service_id, publicurl, interface='public',
-                                  region=region)
-        self.api.endpoints.create(service_id, adminurl, interface='admin',
-                                  region=region)
-        self.api.endpoints.create(service_id, internalurl,
-                                  interface='internal', region=region)
+        self.batch([
+            lambda: self.create_endpoint(service_id, publicurl, 'public',
+                                         region),
+            lambda: self.create_endpoint(service_id, adminurl, 'admin',
+                                         region),
+            lambda: self.create_endpoint(service_id, internalurl, 'internal',
+                                         region),
+        ])
 
     def tenants_list(self):
-        return self.api.projects.list()
+        return self._list('projects')
 
     def create_domain(self, domain_name, description):
-        self.api.domains.create(domain_name, description=description)
+        self._created('domains',
+                      self.api.domains.create(domain_name,
+                                              description=description))
 
     def create_tenant(self, tenant_name, description, domain='default'):
         domain_id = self.resolve_domain_id(domain)
-        self.api.projects.create(tenant_name, domain_id,
-                                 description=description)
+        self._created('projects',
+                      self.api.projects.create(tenant_name, domain_id,
+                                               description=description))
 
     def delete_tenant(self, tenant_id):
         self.api.projects.delete(tenant_id)
+        self._deleted('projects', tenant_id)
 
     def create_user(self, name, password, email, tenant_id=None,
                     domain_id=None):
         if not domain_id:
             domain_id = self.resolve_domain_id('default')
         if tenant_id:
-            self.api.users.create(name,
-                                  domain=domain_id,
-                                  password=password,
-                                  email=email,
-                                  project=tenant_id)
+            user = self.api.users.create(name,
+                                         domain=domain_id,
+                                         password=password,
+                                         email=email,
+                                         project=tenant_id)
         else:
-            self.api.users.create(name,
-                                  domain=domain_id,
-                                  password=password,
-                                  email=email)
+            user = self.api.users.create(name,
+                                         domain=domain_id,
+                                         password=password,
+                                         email=email)
+        self._created('users', user)
 
     def update_password(self, user, password):
         self.api.users.update(user, password=password)
@@ -270,7 +858,7 @@ class KeystoneManager3(KeystoneManager):
 
     def find_endpoint_v3(self, interface, service_id, region):
         found_eps = []
-        for ep in self.api.endpoints.list():
+        for ep in self._list('endpoints'):
             if ep.service_id == service_id and ep.region == region and \
                     ep.interface == interface:
                 found_eps.append(ep)
@@ -280,6 +868,6 @@ class KeystoneManager3(KeystoneManager):
         eps = self.find_endpoint_v3(interface, service_id, region)
         for ep in eps:
             if getattr(ep, 'url') != url:
-                self.api.endpoints.delete(ep.id)
+                self.delete_endpoint(ep.id)
                 return True
         return False
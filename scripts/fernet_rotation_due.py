@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Copyright 2018 Canonical Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run the Fernet key rotation through juju-run once it is due
+
+Usage: fernet_rotation_due.py DEADLINE_FILE UNIT_NAME ROTATE_SCRIPT
+
+The deadline file holds the time of the next rotation, in seconds since the
+epoch, as written by keystone_utils.update_fernet_rotation_schedule().  Only
+the standard library is imported so that checking is cheap, nothing is done
+if the file is missing or the deadline has not been reached yet.
+"""
+import os
+import sys
+import time
+
+JUJU_RUN = '/usr/bin/juju-run'
+
+
+def main(deadline_file, unit_name, rotate_script):
+    try:
+        with open(deadline_file, 'r') as f:
+            deadline = float(f.read())
+    except (IOError, OSError, ValueError):
+        return 0
+    if time.time() < deadline:
+        return 0
+    os.execv(JUJU_RUN, [JUJU_RUN, unit_name, rotate_script])
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
@@ -0,0 +1,104 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark of unitdata.Storage.update
+
+Times updating 10k keys inside a hook scope, first written and then
+rewritten with half of the values changed, using the statement-per-key write
+path unitdata used to have and the current one.  Run with:
+
+    python unit_tests/bench_unitdata.py [keys]
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from charmhelpers.core import unitdata  # noqa: E402
+
+
+class LegacyStorage(unitdata.Storage):
+    """Storage with the select then insert or update write path"""
+
+    def update(self, mapping, prefix=""):
+        for k, v in mapping.items():
+            self.set("%s%s" % (prefix, k), v)
+
+    def set(self, key, value):
+        serialized = json.dumps(value)
+        self.cursor.execute('select data from kv where key=?', [key])
+        exists = self.cursor.fetchone()
+        if exists and exists[0] == serialized:
+            return value
+        if not exists:
+            self.cursor.execute(
+                'insert into kv (key, data) values (?, ?)', (key, serialized))
+        else:
+            self.cursor.execute(
+                'update kv set data = ? where key = ?', [serialized, key])
+        if not self.revision:
+            return value
+        self.cursor.execute(
+            'select 1 from kv_revisions where key=? and revision=?',
+            [key, self.revision])
+        if not self.cursor.fetchone():
+            self.cursor.execute(
+                'insert into kv_revisions (revision, key, data) '
+                'values (?, ?, ?)', (self.revision, key, serialized))
+        else:
+            self.cursor.execute(
+                'update kv_revisions set data = ? '
+                'where key = ? and revision = ?',
+                [serialized, key, self.revision])
+        return value
+
+
+def bench(storage_class, path, keys):
+    db = storage_class(path, synchronous='FULL' if storage_class is
+                       LegacyStorage else None)
+    if storage_class is LegacyStorage:
+        db.cursor.execute('pragma journal_mode=delete')
+    first = dict(('key-%d' % i, {'value': i}) for i in range(keys))
+    second = dict((k, {'value': v['value'] + (v['value'] % 2)})
+                  for k, v in first.items())
+    rates = []
+    for mapping in (first, second):
+        start = time.time()
+        with db.hook_scope('bench'):
+            db.update(mapping, prefix='bench.')
+        rates.append(keys / (time.time() - start))
+    db.close()
+    return rates
+
+
+def main(keys=10000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, storage_class in (('before', LegacyStorage),
+                                    ('after', unitdata.Storage)):
+            path = os.path.join(tmpdir, '%s.db' % name)
+            written, rewritten = bench(storage_class, path, keys)
+            print('%-6s %8d keys/sec written, %8d keys/sec rewritten' %
+                  (name, written, rewritten))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -47,6 +47,26 @@ class ResumeTestCase(CharmTestCase):
         self.resume_unit_helper.assert_called_once_with('test-config')
 
 
+class CompactUnitStateTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(CompactUnitStateTestCase, self).setUp(
+            actions.actions, ["compact_unit_state", "action_set"])
+
+    def test_reports_stats(self):
+        self.compact_unit_state.return_value = (
+            {'kv': 10, 'kv_revisions': 500, 'hooks': 100, 'size': 4096,
+             'wal-size': 1024},
+            {'kv': 10, 'kv_revisions': 50, 'hooks': 10, 'size': 2048,
+             'wal-size': 0})
+        actions.actions.compact_unit_state_action([])
+        self.action_set.assert_called_once_with({
+            'before.kv': 10, 'before.kv-revisions': 500, 'before.hooks': 100,
+            'before.size': 4096, 'before.wal-size': 1024,
+            'after.kv': 10, 'after.kv-revisions': 50, 'after.hooks': 10,
+            'after.size': 2048, 'after.wal-size': 0})
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
@@ -0,0 +1,183 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from mock import patch
+from charmhelpers.contrib.hahelpers import cluster
+from charmhelpers.core import unitdata
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'juju_is_leader',
+    'leader_commit',
+    'leader_get',
+    'leader_set',
+    'local_unit',
+    'log',
+    'relation_get',
+    'relation_ids',
+    'relation_list',
+    'relation_set',
+    'service_restart',
+    'service_running',
+    'service_start',
+    'service_stop',
+    'time',
+]
+
+Coordinator = cluster.RestartCoordinator
+
+
+class TestRestartCoordinator(CharmTestCase):
+
+    def setUp(self):
+        super(TestRestartCoordinator, self).setUp(cluster, TO_PATCH)
+        self.kv = unitdata.Storage(':memory:')
+        _kv = patch.object(unitdata, 'kv', return_value=self.kv)
+        _kv.start()
+        self.addCleanup(_kv.stop)
+        self.now = 1000.0
+        self.time.time.side_effect = lambda: self.now
+        self.local_unit.return_value = 'keystone/0'
+        self.juju_is_leader.return_value = True
+        self.leader_settings = {}
+        self.leader_get.side_effect = self.leader_settings.get
+        self.leader_set.side_effect = self.leader_settings.update
+        self.relation_ids.return_value = ['cluster:1']
+        # {unit: settings} of the peer units and of the local unit
+        self.peers = {'keystone/1': {}, 'keystone/2': {}}
+        self.local = {}
+        self.relation_list.side_effect = lambda rid: sorted(self.peers)
+        self.relation_get.side_effect = (
+            lambda attribute, unit, rid: self.peers[unit].get(attribute))
+        self.relation_set.side_effect = (
+            lambda relation_id, relation_settings:
+            self.local.update(relation_settings))
+        self.service_running.return_value = True
+
+    def leases(self):
+        leases = self.leader_settings.get(Coordinator.LEASES_KEY)
+        return json.loads(leases or '{}')
+
+    def test_grant_oldest_first(self):
+        self.peers['keystone/1'][Coordinator.REQUEST_KEY] = '200.0'
+        self.peers['keystone/2'][Coordinator.REQUEST_KEY] = '100.0'
+        Coordinator(slots=1).process()
+        self.assertEqual(self.leases(), {'keystone/2': ['100.0', 1000.0]})
+        # written out straight away, process() runs at hook exit
+        self.leader_commit.assert_called_once_with()
+
+        self.leader_commit.reset_mock()
+        Coordinator(slots=2).process()
+        self.assertEqual(self.leases(), {'keystone/1': ['200.0', 1000.0],
+                                         'keystone/2': ['100.0', 1000.0]})
+        self.assertTrue(self.leader_commit.called)
+
+    def test_unchanged_leases_not_written(self):
+        self.peers['keystone/1'][Coordinator.REQUEST_KEY] = '200.0'
+        Coordinator().process()
+        self.leader_set.reset_mock()
+        self.leader_commit.reset_mock()
+        Coordinator().process()
+        self.assertFalse(self.leader_set.called)
+        self.assertFalse(self.leader_commit.called)
+
+    def test_release_grants_next(self):
+        self.peers['keystone/1'][Coordinator.REQUEST_KEY] = '100.0'
+        self.peers['keystone/2'][Coordinator.REQUEST_KEY] = '200.0'
+        Coordinator().process()
+        self.assertEqual(list(self.leases()), ['keystone/1'])
+        self.peers['keystone/1'][Coordinator.DONE_KEY] = '100.0'
+        self.now = 1010.0
+        Coordinator().process()
+        self.assertEqual(self.leases(), {'keystone/2': ['200.0', 1010.0]})
+
+    def test_expired_lease_requeued(self):
+        self.peers['keystone/1'][Coordinator.REQUEST_KEY] = '100.0'
+        self.peers['keystone/2'][Coordinator.REQUEST_KEY] = '200.0'
+        Coordinator(timeout=600).process()
+        self.now = 1599.0
+        Coordinator(timeout=600).process()
+        self.assertEqual(list(self.leases()), ['keystone/1'])
+
+        self.now = 1600.0
+        Coordinator(timeout=600).process()
+        self.assertEqual(self.leases(), {'keystone/2': ['200.0', 1600.0]})
+        self.assertEqual(
+            json.loads(self.leader_settings[Coordinator.EXPIRED_KEY]),
+            {'keystone/1': '100.0'})
+
+        # the reclaimed unit queues behind the other requests, even newer
+        # ones
+        self.peers['keystone/2'][Coordinator.DONE_KEY] = '200.0'
+        self.peers['keystone/3'] = {Coordinator.REQUEST_KEY: '1650.0'}
+        self.now = 1700.0
+        Coordinator(timeout=600).process()
+        self.assertEqual(self.leases(), {'keystone/3': ['1650.0', 1700.0]})
+        self.peers['keystone/3'][Coordinator.DONE_KEY] = '1650.0'
+        self.now = 1710.0
+        Coordinator(timeout=600).process()
+        self.assertEqual(self.leases(), {'keystone/1': ['100.0', 1710.0]})
+        self.assertEqual(
+            json.loads(self.leader_settings[Coordinator.EXPIRED_KEY]),
+            {'keystone/1': '100.0'})
+
+    def test_local_restart_and_release(self):
+        coordinator = Coordinator()
+        coordinator.request({'apache2': False, 'haproxy': True})
+        self.assertEqual(self.local[Coordinator.DONE_KEY], '1000.000000')
+        self.assertEqual(self.local[Coordinator.REQUEST_KEY], None)
+        self.service_restart.assert_called_once_with('apache2')
+        self.service_stop.assert_called_once_with('haproxy')
+        self.service_start.assert_called_once_with('haproxy')
+        self.assertEqual(self.leases(), {})
+        self.assertEqual(self.kv.get(Coordinator.STATE_KEY), {})
+
+    def test_waits_for_slot(self):
+        self.juju_is_leader.return_value = False
+        self.leader_settings[Coordinator.LEASES_KEY] = json.dumps(
+            {'keystone/1': ['100.0', 1000.0]})
+        Coordinator().request({'apache2': False})
+        self.assertEqual(self.local[Coordinator.REQUEST_KEY], '1000.000000')
+        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.leader_set.called)
+
+        # granted by the leader in a later hook
+        self.leader_settings[Coordinator.LEASES_KEY] = json.dumps(
+            {'keystone/0': ['1000.000000', 1010.0]})
+        Coordinator().process()
+        self.service_restart.assert_called_once_with('apache2')
+        self.assertEqual(self.local[Coordinator.DONE_KEY], '1000.000000')
+
+    def test_unhealthy_keeps_slot(self):
+        healthy = [False]
+        coordinator = Coordinator(health_check=lambda services: healthy[0])
+        coordinator.request({'apache2': False})
+        self.assertEqual(list(self.leases()), ['keystone/0'])
+        self.assertNotIn(Coordinator.DONE_KEY, self.local)
+        # checked again in later hooks without restarting again
+        coordinator.process()
+        healthy[0] = True
+        coordinator.process()
+        self.service_restart.assert_called_once_with('apache2')
+        self.assertEqual(self.local[Coordinator.DONE_KEY], '1000.000000')
+        self.assertEqual(self.leases(), {})
+
+    def test_no_peers_restarts_at_once(self):
+        self.peers = {}
+        Coordinator().request({'apache2': False})
+        self.service_restart.assert_called_once_with('apache2')
+        self.assertEqual(self.local, {})
+        self.assertFalse(self.leader_set.called)
@@ -0,0 +1,412 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import unittest
+
+from mock import MagicMock, patch
+from charmhelpers.core import hookenv
+
+
+class TestHookenvBase(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHookenvBase, self).setUp()
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(hookenv._atexit.__delitem__, slice(None))
+        _env = patch.dict(os.environ, {'JUJU_UNIT_NAME': 'keystone/0'})
+        _env.start()
+        self.addCleanup(_env.stop)
+        # {(rid, unit): settings} served by relation-get
+        self.relation_data = {}
+        _check_output = patch.object(hookenv.subprocess, 'check_output',
+                                     side_effect=self._check_output)
+        self.check_output = _check_output.start()
+        self.addCleanup(_check_output.stop)
+        _check_call = patch.object(hookenv.subprocess, 'check_call')
+        self.check_call = _check_call.start()
+        self.addCleanup(_check_call.stop)
+
+    def _check_output(self, args, **kwargs):
+        if args[0] == 'relation-set':
+            return 'usage: relation-set [options] --file <path>'
+        self.assertEqual(args[:2], ['relation-get', '--format=json'])
+        rid, attribute, unit = args[3], args[4], args[5]
+        settings = self.relation_data.get((rid, unit), {})
+        if attribute != '-':
+            settings = settings.get(attribute)
+        return json.dumps(settings).encode('UTF-8')
+
+    def relation_get_calls(self):
+        return [c for c in self.check_output.call_args_list
+                if c[0][0][0] == 'relation-get']
+
+
+class TestFunctionCache(TestHookenvBase):
+
+    def test_key_on_bound_arguments(self):
+        func = MagicMock(return_value='value')
+
+        @hookenv.cached
+        def lookup(attribute=None, unit=None, rid=None):
+            return func(attribute, unit, rid)
+
+        self.assertEqual(lookup('a', 'nova/0', 'identity-service:1'),
+                         'value')
+        self.assertEqual(lookup(attribute='a', rid='identity-service:1',
+                                unit='nova/0'), 'value')
+        self.assertEqual(lookup('a', unit='nova/0',
+                                rid='identity-service:1'), 'value')
+        func.assert_called_once_with('a', 'nova/0', 'identity-service:1')
+        self.assertEqual(hookenv.cache.stats()['lookup'],
+                         {'hits': 2, 'misses': 1, 'entries': 1})
+
+    def test_flush_indexed_entries(self):
+        cache = hookenv.FunctionCache()
+        cache.set('relation_get', ('a', 'nova/0', 'rid:1'), 1,
+                  tags=('nova/0', 'rid:1'))
+        cache.set('relation_get', ('a', 'glance/0', 'rid:1'), 2,
+                  tags=('glance/0', 'rid:1'))
+        cache.set('relation_get', ('a', 'nova/0', 'rid:2'), 3,
+                  tags=('nova/0', 'rid:2'))
+        cache.flush('nova/0')
+        self.assertEqual(cache.tables['relation_get'],
+                         {('a', 'glance/0', 'rid:1'): 2})
+        cache.flush('rid:1')
+        self.assertEqual(cache.tables['relation_get'], {})
+        # flushing an unknown tag is harmless
+        cache.flush('nova/0')
+
+    def test_relation_set_flushes_local_unit(self):
+        self.relation_data = {
+            ('identity-service:1', 'keystone/0'): {'admin_token': 'a'},
+            ('identity-service:1', 'nova/0'): {'service': 'nova'},
+        }
+        self.assertEqual(hookenv.relation_get(
+            'admin_token', unit='keystone/0', rid='identity-service:1'),
+            'a')
+        self.assertEqual(hookenv.relation_get(
+            'service', unit='nova/0', rid='identity-service:1'), 'nova')
+        self.assertEqual(len(self.relation_get_calls()), 2)
+
+        generation = hookenv.settings_generation()
+        self.relation_data[('identity-service:1', 'keystone/0')] = {
+            'admin_token': 'b'}
+        hookenv.relation_set(relation_id='identity-service:1',
+                             admin_token='b')
+        self.assertNotEqual(hookenv.settings_generation(), generation)
+        self.assertEqual(hookenv.relation_get(
+            'admin_token', unit='keystone/0', rid='identity-service:1'),
+            'b')
+        # the remote unit's settings are still cached
+        self.assertEqual(hookenv.relation_get(
+            'service', unit='nova/0', rid='identity-service:1'), 'nova')
+        self.assertEqual(len(self.relation_get_calls()), 3)
+
+
+class TestPrefetchRelations(TestHookenvBase):
+
+    def setUp(self):
+        super(TestPrefetchRelations, self).setUp()
+        self.relations = {'identity-service': ['identity-service:1'],
+                          'identity-credentials': []}
+        self.units = {'identity-service:1': ['nova/0', 'glance/0']}
+        self.relation_data = {
+            ('identity-service:1', 'nova/0'): {'service': 'nova'},
+            ('identity-service:1', 'glance/0'): {'service': 'glance'},
+            ('identity-service:1', 'keystone/0'): {'admin_token': 'a'},
+        }
+
+    def _check_output(self, args, **kwargs):
+        if args[0] == 'relation-ids':
+            return json.dumps(self.relations[args[2]]).encode('UTF-8')
+        if args[0] == 'relation-list':
+            return json.dumps(self.units[args[3]]).encode('UTF-8')
+        return super(TestPrefetchRelations, self)._check_output(args,
+                                                                **kwargs)
+
+    def test_served_without_hook_tools(self):
+        hookenv.prefetch_relations(['identity-service',
+                                    'identity-credentials'])
+        # the remote units and the local unit
+        self.assertEqual(len(self.relation_get_calls()), 3)
+        self.check_output.reset_mock()
+        self.assertEqual(hookenv.relation_ids('identity-service'),
+                         ['identity-service:1'])
+        self.assertEqual(hookenv.relation_ids('identity-credentials'), [])
+        self.assertEqual(hookenv.related_units('identity-service:1'),
+                         ['nova/0', 'glance/0'])
+        self.assertEqual(hookenv.relation_get(
+            'service', unit='glance/0', rid='identity-service:1'), 'glance')
+        self.assertEqual(hookenv.relation_get(
+            'missing', unit='nova/0', rid='identity-service:1'), None)
+        self.assertEqual(hookenv.relation_get(
+            unit='keystone/0', rid='identity-service:1'),
+            {'admin_token': 'a'})
+        self.assertFalse(self.check_output.called)
+
+    def test_local_write_fetched_again(self):
+        hookenv.prefetch_relations(['identity-service'])
+        self.relation_data[('identity-service:1', 'keystone/0')] = {
+            'admin_token': 'b'}
+        hookenv.relation_set(relation_id='identity-service:1',
+                             admin_token='b')
+        self.check_output.reset_mock()
+        self.assertEqual(hookenv.relation_get(
+            'admin_token', unit='keystone/0', rid='identity-service:1'),
+            'b')
+        self.assertEqual(len(self.relation_get_calls()), 1)
+        self.assertEqual(hookenv.relation_get(
+            'service', unit='nova/0', rid='identity-service:1'), 'nova')
+        self.assertEqual(len(self.relation_get_calls()), 1)
+
+
+class TestRelationSetBatch(TestHookenvBase):
+
+    def setUp(self):
+        super(TestRelationSetBatch, self).setUp()
+        # [(relation id, settings)] written by relation-set
+        self.written = []
+        self.check_call.side_effect = self._check_call
+        self.addCleanup(setattr, hookenv, '_relation_set_queue', None)
+
+    def _check_call(self, args):
+        self.assertEqual(args[:3], ['relation-set', '-r', args[2]])
+        self.assertEqual(args[3], '--file')
+        with open(args[4]) as f:
+            self.written.append((args[2], hookenv.yaml.safe_load(f)))
+
+    def test_flush_drops_unchanged_settings(self):
+        self.relation_data = {
+            ('identity-service:1', 'keystone/0'): {'admin_token': 'a',
+                                                   'service_port': '5000'},
+            ('identity-service:2', 'keystone/0'): {'admin_token': 'a'},
+        }
+        hookenv.batch_relation_set()
+        hookenv.relation_set(relation_id='identity-service:2',
+                             admin_token='a')
+        hookenv.relation_set(relation_id='identity-service:1',
+                             admin_token='b', service_port=5000)
+        hookenv.relation_set(relation_id='identity-service:1',
+                             auth_port=35357)
+        self.assertEqual(self.written, [])
+        # the local unit sees its queued settings
+        self.assertEqual(hookenv.relation_get(
+            'admin_token', unit='keystone/0', rid='identity-service:1'),
+            'b')
+        hookenv._run_atexit()
+        # identity-service:2 already publishes everything queued for it
+        self.assertEqual(self.written, [
+            ('identity-service:1', {'admin_token': 'b',
+                                    'auth_port': '35357'})])
+        self.assertEqual(hookenv._relation_set_queue, None)
+
+    def test_flush_in_first_write_order(self):
+        hookenv.batch_relation_set()
+        hookenv.relation_set(relation_id='cluster:3', a=1)
+        hookenv.relation_set(relation_id='identity-service:1', b=2)
+        hookenv.relation_set(relation_id='cluster:3', c=3)
+        hookenv.flush_relation_set()
+        self.assertEqual(self.written, [
+            ('cluster:3', {'a': '1', 'c': '3'}),
+            ('identity-service:1', {'b': '2'})])
+        # writes after a flush are still batched
+        hookenv.relation_set(relation_id='cluster:3', a=4)
+        self.assertEqual(len(self.written), 2)
+        hookenv._run_atexit()
+        self.assertEqual(self.written[2:], [('cluster:3', {'a': '4'})])
+
+    def test_unbatched_writes(self):
+        hookenv.relation_set(relation_id='cluster:3', a=1)
+        self.assertEqual(self.written, [('cluster:3', {'a': '1'})])
+
+
+class TestRelationSetAcceptsFile(TestHookenvBase):
+
+    def setUp(self):
+        super(TestRelationSetAcceptsFile, self).setUp()
+        kv = MagicMock()
+        self.stored = {}
+        kv.get.side_effect = self.stored.get
+        kv.set.side_effect = self.stored.__setitem__
+        _kv = patch('charmhelpers.core.unitdata.kv', return_value=kv)
+        _kv.start()
+        self.addCleanup(_kv.stop)
+
+    def probes(self):
+        return [c for c in self.check_output.call_args_list
+                if c[0][0][0] == 'relation-set']
+
+    def test_probed_once_per_juju_version(self):
+        with patch.dict(os.environ, {'JUJU_VERSION': '2.4.3'}):
+            self.assertTrue(hookenv._relation_set_accepts_file())
+            self.assertTrue(hookenv._relation_set_accepts_file())
+            self.assertEqual(len(self.probes()), 1)
+            # the next hook reads the stored result
+            hookenv.cache.clear()
+            self.assertTrue(hookenv._relation_set_accepts_file())
+            self.assertEqual(len(self.probes()), 1)
+        self.assertEqual(self.stored[hookenv.RELATION_SET_FILE_KEY],
+                         {'version': '2.4.3', 'accepts-file': True})
+
+        hookenv.cache.clear()
+        with patch.dict(os.environ, {'JUJU_VERSION': '2.5.0'}):
+            self.assertTrue(hookenv._relation_set_accepts_file())
+        self.assertEqual(len(self.probes()), 2)
+        self.assertEqual(self.stored[hookenv.RELATION_SET_FILE_KEY],
+                         {'version': '2.5.0', 'accepts-file': True})
+
+    def test_probed_per_hook_without_juju_version(self):
+        with patch.dict(os.environ):
+            os.environ.pop('JUJU_VERSION', None)
+            self.assertTrue(hookenv._relation_set_accepts_file())
+            hookenv.cache.clear()
+            self.assertTrue(hookenv._relation_set_accepts_file())
+        self.assertEqual(len(self.probes()), 2)
+        self.assertEqual(self.stored, {})
+
+
+class TestLeaderSettings(TestHookenvBase):
+
+    def setUp(self):
+        super(TestLeaderSettings, self).setUp()
+        hookenv.leader_settings.clear()
+        self.addCleanup(hookenv.leader_settings.clear)
+        self.leader = True
+        self.stored = {'admin_passwd': 'a'}
+        self.check_call.side_effect = self._check_call
+
+    def _check_output(self, args, **kwargs):
+        if args[0] == 'is-leader':
+            return json.dumps(self.leader).encode('UTF-8')
+        self.assertEqual(args, ['leader-get', '--format=json', '-'])
+        return json.dumps(self.stored).encode('UTF-8')
+
+    def _check_call(self, args):
+        self.assertEqual(args[0], 'leader-set')
+        for arg in args[1:]:
+            key, value = arg.split('=', 1)
+            self.stored[key] = value
+
+    def calls(self, command):
+        calls = list(self.check_output.call_args_list)
+        calls.extend(self.check_call.call_args_list)
+        return [c[0][0] for c in calls if c[0][0][0] == command]
+
+    def test_loaded_once_per_hook(self):
+        self.assertEqual(hookenv.leader_get('admin_passwd'), 'a')
+        self.assertEqual(hookenv.leader_get('missing'), None)
+        self.assertEqual(hookenv.leader_get(), {'admin_passwd': 'a'})
+        self.assertEqual(len(self.calls('leader-get')), 1)
+
+    def test_writes_coalesced_at_hook_exit(self):
+        hookenv.leader_set({'admin_passwd': 'b'})
+        hookenv.leader_set(token='t', ttl=60)
+        hookenv.leader_set(token=None)
+        # visible straight away, written at hook exit
+        self.assertEqual(hookenv.leader_get('admin_passwd'), 'b')
+        self.assertEqual(hookenv.leader_get('ttl'), '60')
+        self.assertEqual(hookenv.leader_get('token'), None)
+        self.assertEqual(self.calls('leader-set'), [])
+        hookenv._run_atexit()
+        leader_set = self.calls('leader-set')
+        self.assertEqual(len(leader_set), 1)
+        self.assertEqual(sorted(leader_set[0][1:]),
+                         ['admin_passwd=b', 'token=', 'ttl=60'])
+        self.assertEqual(len(self.calls('leader-get')), 1)
+        self.assertEqual(len(self.calls('is-leader')), 1)
+
+    def test_commit_runs_once(self):
+        hookenv.leader_set(admin_passwd='b')
+        hookenv.leader_commit()
+        # the hook and interpreter exit commits have nothing left to write
+        hookenv._run_atexit()
+        hookenv.leader_settings.commit()
+        self.assertEqual(len(self.calls('leader-set')), 1)
+        # a later write is queued again
+        hookenv.leader_set(admin_passwd='c')
+        hookenv._run_atexit()
+        self.assertEqual(len(self.calls('leader-set')), 2)
+        self.assertEqual(self.stored['admin_passwd'], 'c')
+
+    def test_non_leader_writes_through(self):
+        self.leader = False
+        self.assertEqual(hookenv.leader_get('admin_passwd'), 'a')
+        hookenv.leader_set(admin_passwd='b')
+        self.assertEqual(self.calls('leader-set'),
+                         [['leader-set', 'admin_passwd=b']])
+        # read again from juju, which has the final say
+        self.assertEqual(hookenv.leader_get('admin_passwd'), 'b')
+        self.assertEqual(len(self.calls('leader-get')), 2)
+        hookenv._run_atexit()
+        self.assertEqual(len(self.calls('leader-set')), 1)
+
+
+class TestLog(unittest.TestCase):
+
+    def setUp(self):
+        super(TestLog, self).setUp()
+        hookenv.flush_log()
+        _juju_log = patch.object(hookenv, '_juju_log')
+        self.juju_log = _juju_log.start()
+        self.addCleanup(_juju_log.stop)
+        self.addCleanup(hookenv.set_log_level, None)
+        self.addCleanup(hookenv.flush_log)
+        self.addCleanup(hookenv._atexit.__delitem__, slice(None))
+
+    def test_level_filter(self):
+        hookenv.set_log_level('info')
+        hookenv.log('trace', level=hookenv.TRACE)
+        hookenv.log('debug', level=hookenv.DEBUG)
+        hookenv.log('info')
+        hookenv.log('info again')
+        hookenv.flush_log()
+        self.juju_log.assert_called_once_with('info\ninfo again', None)
+
+    def test_default_level(self):
+        hookenv.set_log_level(hookenv.ERROR)
+        hookenv.set_log_level(None)
+        hookenv.log('trace', level=hookenv.TRACE)
+        hookenv.flush_log()
+        self.juju_log.assert_called_once_with('trace', hookenv.TRACE)
+
+    def test_buffered_until_hook_exit(self):
+        hookenv.log('one', level=hookenv.DEBUG)
+        hookenv.log('two', level=hookenv.DEBUG)
+        hookenv.log('three', level=hookenv.INFO)
+        self.assertFalse(self.juju_log.called)
+        hookenv._run_atexit()
+        self.assertEqual(self.juju_log.call_args_list, [
+            (('one\ntwo', hookenv.DEBUG),),
+            (('three', hookenv.INFO),)])
+
+    def test_warning_flushed_immediately(self):
+        hookenv.log('one', level=hookenv.DEBUG)
+        hookenv.log('careful', level=hookenv.WARNING)
+        # written out in order, before the hook could be killed
+        self.assertEqual(self.juju_log.call_args_list, [
+            (('one', hookenv.DEBUG),),
+            (('careful', hookenv.WARNING),)])
+        hookenv.log('broken', level='error')
+        self.assertEqual(self.juju_log.call_args_list[-1],
+                         (('broken', 'error'),))
+
+    def test_flushed_when_full(self):
+        with patch.object(hookenv, 'LOG_BUFFER_SIZE', 10):
+            hookenv.log('12345', level=hookenv.DEBUG)
+            self.assertFalse(self.juju_log.called)
+            hookenv.log('67890', level=hookenv.DEBUG)
+        self.juju_log.assert_called_once_with('12345\n67890', hookenv.DEBUG)
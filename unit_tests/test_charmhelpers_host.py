@@ -0,0 +1,246 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+from mock import MagicMock, patch
+from charmhelpers.core import hookenv, host, unitdata
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'charm_dir',
+    'log',
+    'service',
+    'service_can_reload',
+    'service_reload',
+    'service_restart',
+]
+
+
+class TestHostBase(CharmTestCase):
+
+    def setUp(self):
+        super(TestHostBase, self).setUp(host, TO_PATCH)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm_dir.return_value = self.tmpdir
+        self.service_can_reload.return_value = False
+        self.kv = unitdata.Storage(':memory:')
+        _kv = patch.object(unitdata, 'kv', return_value=self.kv)
+        _kv.start()
+        self.addCleanup(_kv.stop)
+        self.new_hook()
+        self.addCleanup(self.new_hook)
+
+    def new_hook(self):
+        """Drop the state a new hook process would not have"""
+        del hookenv._atexit[:]
+        host._deferred_restarts.clear()
+        host._deferred_restart_handler[0] = None
+        host._path_hashes.clear()
+        host._path_hashes_state.update(loaded=False, dirty=False)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def skip_race_window(self):
+        """Hash files as if they had been left alone since written"""
+        _time = patch.object(host, 'time')
+        mock_time = _time.start()
+        self.addCleanup(_time.stop)
+        mock_time.time.return_value = (
+            time.time() + 2 * host.PATH_HASH_RACE_WINDOW)
+
+
+class TestDeferredRestarts(TestHostBase):
+
+    def setUp(self):
+        super(TestDeferredRestarts, self).setUp()
+        self.conf = os.path.join(self.tmpdir, 'keystone.conf')
+        self.write(self.conf, 'old')
+
+        @host.restart_on_change({self.conf: ['apache2']}, deferred=True)
+        def render(content):
+            self.write(self.conf, content)
+
+        self.render = render
+
+    def test_deferred_restart_at_exit(self):
+        self.render('new')
+        self.render('newer')
+        self.assertFalse(self.service_restart.called)
+        self.assertEqual(self.kv.get(host.DEFERRED_RESTARTS_KEY),
+                         [['apache2', False]])
+        hookenv._run_atexit()
+        self.service_restart.assert_called_once_with('apache2')
+        self.assertEqual(self.kv.get(host.DEFERRED_RESTARTS_KEY), None)
+
+    def test_failed_hook_restart_resumed(self):
+        def hook():
+            self.render('new')
+            raise ValueError('hook failed')
+
+        self.assertRaises(ValueError, hook)
+        # a failed hook does not run its atexit callbacks
+        self.new_hook()
+        host.resume_deferred_restarts()
+        self.render('new')
+        hookenv._run_atexit()
+        self.service_restart.assert_called_once_with('apache2')
+        self.assertEqual(self.kv.get(host.DEFERRED_RESTARTS_KEY), None)
+
+        self.service_restart.reset_mock()
+        self.new_hook()
+        host.resume_deferred_restarts()
+        hookenv._run_atexit()
+        self.assertFalse(self.service_restart.called)
+
+    def test_resumed_restart_handed_to_handler(self):
+        self.render('new')
+        self.new_hook()
+        handler = MagicMock()
+        host.set_deferred_restart_handler(handler)
+        host.resume_deferred_restarts()
+        hookenv._run_atexit()
+        handler.assert_called_once_with({'apache2': False})
+        self.assertFalse(self.service_restart.called)
+        self.assertEqual(self.kv.get(host.DEFERRED_RESTARTS_KEY), None)
+
+    def test_immediate_restart_drops_deferred(self):
+        self.render('new')
+
+        @host.restart_on_change({self.conf: ['apache2']})
+        def render_now(content):
+            self.write(self.conf, content)
+
+        render_now('newer')
+        self.assertEqual(self.kv.get(host.DEFERRED_RESTARTS_KEY), None)
+        hookenv._run_atexit()
+        self.service.assert_called_once_with('restart', 'apache2')
+        self.assertFalse(self.service_restart.called)
+
+
+class TestTrackedPaths(TestHostBase):
+
+    def setUp(self):
+        super(TestTrackedPaths, self).setUp()
+        self.conf = os.path.join(self.tmpdir, 'keystone.conf')
+        self.write(self.conf, 'old')
+        self.skip_race_window()
+        host.track_path_changes([self.conf])
+        self.addCleanup(host._tracked_paths.discard, self.conf)
+        _file_hash = patch.object(host, 'file_hash',
+                                  side_effect=host.file_hash)
+        self.file_hash = _file_hash.start()
+        self.addCleanup(_file_hash.stop)
+
+    def restart_on_change(self, func):
+        host.restart_on_change_helper(func, {self.conf: ['apache2']})
+
+    def test_unreported_write_restarts(self):
+        # e.g. a package conffile or a manual edit
+        self.restart_on_change(lambda: self.write(self.conf, 'new'))
+        self.service.assert_called_once_with('restart', 'apache2')
+
+    def test_reported_write_not_rehashed(self):
+        def render():
+            self.write(self.conf, 'new')
+            host.record_changed_paths([self.conf])
+
+        self.restart_on_change(render)
+        self.service.assert_called_once_with('restart', 'apache2')
+        self.file_hash.assert_called_once_with(self.conf)
+
+    def test_unchanged_file_read_once(self):
+        self.restart_on_change(lambda: None)
+        self.restart_on_change(lambda: None)
+        self.assertFalse(self.service.called)
+        self.file_hash.assert_called_once_with(self.conf)
+        hookenv._run_atexit()
+        # the next hook trusts the stored hash
+        self.new_hook()
+        self.restart_on_change(lambda: None)
+        self.file_hash.assert_called_once_with(self.conf)
+        self.assertEqual(list(self.kv.get(host.PATH_HASHES_KEY)),
+                         [self.conf])
+
+
+class TestStatFileHash(TestHostBase):
+
+    def setUp(self):
+        super(TestStatFileHash, self).setUp()
+        self.conf = os.path.join(self.tmpdir, 'keystone.conf')
+        self.write(self.conf, 'aaa')
+        os.utime(self.conf, (1000000000, 1000000000))
+        self.digest = host.file_hash(self.conf)
+
+    def test_recent_file_not_kept(self):
+        self.assertEqual(host.stat_file_hash(self.conf), self.digest)
+        self.assertEqual(host._path_hashes, {})
+        # same size, and the mtime reads the same at a coarse granularity
+        self.write(self.conf, 'bbb')
+        os.utime(self.conf, (1000000000, 1000000000))
+        self.assertNotEqual(host.stat_file_hash(self.conf), self.digest)
+
+    def test_restored_mtime_detected(self):
+        self.skip_race_window()
+        self.assertEqual(host.stat_file_hash(self.conf), self.digest)
+        self.assertEqual(list(host._path_hashes), [self.conf])
+        hookenv._run_atexit()
+        self.new_hook()
+        # cp -p rewrites the file in place and restores its mtime
+        time.sleep(0.01)
+        self.write(self.conf, 'bbb')
+        os.utime(self.conf, (1000000000, 1000000000))
+        self.assertEqual(host.stat_file_hash(self.conf),
+                         host.file_hash(self.conf))
+        self.assertNotEqual(host.file_hash(self.conf), self.digest)
+
+    def test_missing_file_forgotten(self):
+        self.skip_race_window()
+        host.stat_file_hash(self.conf)
+        os.unlink(self.conf)
+        self.assertEqual(host.stat_file_hash(self.conf), None)
+        self.assertEqual(host._path_hashes, {})
+
+
+class TestDeferredRestartHandler(TestHostBase):
+
+    def setUp(self):
+        super(TestDeferredRestartHandler, self).setUp()
+        self.conf = os.path.join(self.tmpdir, 'keystone.conf')
+        self.write(self.conf, 'old')
+        self.handler = MagicMock()
+        host.set_deferred_restart_handler(self.handler)
+
+    def test_deferred_restarts_handed_over(self):
+        host.restart_on_change_helper(
+            lambda: self.write(self.conf, 'new'), {self.conf: ['apache2']},
+            stopstart=True, deferred=True)
+        self.assertFalse(self.handler.called)
+        hookenv._run_atexit()
+        self.handler.assert_called_once_with({'apache2': True})
+        self.assertFalse(self.service.called)
+
+    def test_immediate_restarts_not_handed_over(self):
+        # hooks that use the restarted services go on to do so
+        host.restart_on_change_helper(
+            lambda: self.write(self.conf, 'new'), {self.conf: ['apache2']})
+        self.service.assert_called_once_with('restart', 'apache2')
+        hookenv._run_atexit()
+        self.assertFalse(self.handler.called)
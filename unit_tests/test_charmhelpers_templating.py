@@ -0,0 +1,198 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from charmhelpers.core import hookenv
+from charmhelpers.contrib.openstack import templating
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'charm_dir',
+    'log',
+]
+
+
+class FakeContext(object):
+    """Context generator counting its runs"""
+
+    interfaces = []
+
+    def __init__(self, **ctxt):
+        self.ctxt = ctxt
+        self.runs = 0
+
+    def __call__(self):
+        self.runs += 1
+        return dict(self.ctxt)
+
+
+class TestTemplatingBase(CharmTestCase):
+
+    def setUp(self):
+        super(TestTemplatingBase, self).setUp(templating, TO_PATCH)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm_dir.return_value = None
+        self.templates_dir = os.path.join(self.tmpdir, 'templates')
+        os.mkdir(self.templates_dir)
+        templating.flush_context_cache()
+        self.reset_template_caches()
+        self.addCleanup(self.reset_template_caches)
+
+    def reset_template_caches(self):
+        del templating._bytecode_cache[:]
+        templating._loaders.clear()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+
+class TestContextCache(TestTemplatingBase):
+
+    def setUp(self):
+        super(TestContextCache, self).setUp()
+        self.shared = FakeContext(token='a')
+        self.configs = templating.OSConfigRenderer(self.templates_dir,
+                                                   'queens')
+        self.configs.register(self.path('keystone.conf'), [self.shared],
+                              config_template='token={{ token }}')
+        self.configs.register(self.path('policy.json'), [self.shared],
+                              config_template='{{ token }}')
+
+    def test_shared_context_runs_once_per_write_all(self):
+        self.assertEqual(self.configs.write_all(),
+                         set([self.path('keystone.conf'),
+                              self.path('policy.json')]))
+        self.assertEqual(self.shared.runs, 1)
+        self.assertEqual(templating._context_cache, {})
+        # on-disk state read by a context may have changed since
+        self.shared.ctxt['token'] = 'b'
+        self.assertEqual(self.configs.write_all(),
+                         set([self.path('keystone.conf'),
+                              self.path('policy.json')]))
+        self.assertEqual(self.shared.runs, 2)
+        self.assertEqual(self.read('keystone.conf'), 'token=b')
+
+    def test_not_cached_outside_write_all(self):
+        self.configs.write(self.path('keystone.conf'))
+        self.configs.write(self.path('policy.json'))
+        self.assertEqual(self.shared.runs, 2)
+        # complete_contexts() is a pass of its own
+        self.configs.complete_contexts()
+        self.assertEqual(self.shared.runs, 3)
+
+    def test_settings_change_within_write_all(self):
+        other = FakeContext(port=5000)
+
+        def write_settings():
+            hookenv._settings_changed()
+            return {}
+
+        write_settings.interfaces = []
+        self.configs.register(self.path('a.conf'), [self.shared, other],
+                              config_template='{{ port }}')
+        self.configs.register(self.path('b.conf'), [write_settings])
+        self.configs.register(self.path('c.conf'), [self.shared, other],
+                              config_template='{{ port }}')
+        with templating.context_cache():
+            for name in ('a.conf', 'b.conf', 'c.conf'):
+                self.configs.templates[self.path(name)].context()
+        self.assertEqual(self.shared.runs, 2)
+        self.assertEqual(other.runs, 2)
+
+    def test_nested_blocks_flush_at_outermost(self):
+        with templating.context_cache():
+            templating.generate_context(self.shared)
+            with templating.context_cache():
+                templating.generate_context(self.shared)
+            templating.generate_context(self.shared)
+        self.assertEqual(self.shared.runs, 1)
+        self.assertEqual(templating._context_cache, {})
+        templating.generate_context(self.shared)
+        self.assertEqual(self.shared.runs, 2)
+
+
+class TestTemplateBytecodeCache(TestTemplatingBase):
+
+    def setUp(self):
+        super(TestTemplateBytecodeCache, self).setUp()
+        self.charm = os.path.join(self.tmpdir, 'charm')
+        os.mkdir(self.charm)
+        self.charm_dir.return_value = self.charm
+        self.base = os.path.join(self.charm, templating.BYTECODE_CACHE_DIR)
+
+    def write_charm_file(self, name, content):
+        with open(os.path.join(self.charm, name), 'w') as f:
+            f.write(content)
+
+    def test_revision_file(self):
+        self.write_charm_file('revision', '42\n')
+        os.makedirs(os.path.join(self.base, '41'))
+        cache = templating.get_bytecode_cache()
+        self.assertEqual(cache.directory, os.path.join(self.base, '42'))
+        self.assertEqual(os.listdir(self.base), ['42'])
+        self.assertIs(templating.get_bytecode_cache(), cache)
+
+    def test_charm_url_revision(self):
+        self.write_charm_file('.juju-charm', 'cs:xenial/keystone-281\n')
+        revision = templating.charm_revision(self.charm)
+        self.assertNotEqual(revision, '0')
+        self.assertEqual(templating.get_bytecode_cache().directory,
+                         os.path.join(self.base, revision))
+        # an upgraded charm gets a fresh directory
+        self.write_charm_file('.juju-charm', 'cs:xenial/keystone-282\n')
+        self.reset_template_caches()
+        upgraded = templating.charm_revision(self.charm)
+        self.assertNotEqual(upgraded, revision)
+        templating.get_bytecode_cache()
+        self.assertEqual(os.listdir(self.base), [upgraded])
+
+    def test_unknown_revision(self):
+        self.assertEqual(templating.charm_revision(self.charm), '0')
+        self.write_charm_file('revision', '')
+        self.assertEqual(templating.charm_revision(self.charm), '0')
+
+    def test_outside_charm(self):
+        self.charm_dir.return_value = None
+        self.assertEqual(templating.get_bytecode_cache(), None)
+
+    def test_compiled_template_reused(self):
+        self.write_charm_file('revision', '42')
+        with open(os.path.join(self.templates_dir, 'keystone.conf'),
+                  'w') as f:
+            f.write('token={{ token }}')
+        configs = templating.OSConfigRenderer(self.templates_dir, 'queens')
+        configs.register(self.path('keystone.conf'),
+                         [FakeContext(token='a')])
+        configs.write_all()
+        directory = os.path.join(self.base, '42')
+        self.assertEqual(len(os.listdir(directory)), 1)
+        # a later hook loads the compiled template
+        self.reset_template_caches()
+        configs = templating.OSConfigRenderer(self.templates_dir, 'queens')
+        configs.register(self.path('keystone.conf'),
+                         [FakeContext(token='b')])
+        with patch.object(templating.Environment, 'compile') as compile:
+            configs.write_all()
+        self.assertFalse(compile.called)
+        self.assertEqual(self.read('keystone.conf'), 'token=b')
+        self.assertEqual(len(os.listdir(directory)), 1)
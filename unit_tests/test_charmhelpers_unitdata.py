@@ -0,0 +1,266 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import six
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+from charmhelpers.core import unitdata
+
+# Keys around the 'ab' prefix, including LIKE wildcards and the characters
+# closest to the range bounds.
+KEYS = [u'a', u'aa', u'ab', u'ab%', u'ab_', u'ab\xff', u'ab\U0001f600',
+        u'abc', u'ac', u'a_', u'a%b', u'b']
+
+
+class TestPrefixRange(unittest.TestCase):
+
+    def test_bounds(self):
+        self.assertEqual(unitdata._prefix_range('ab'),
+                         ('key >= ? and key < ?', [u'ab', u'ac']))
+        self.assertEqual(unitdata._prefix_range(b'ab'),
+                         ('key >= ? and key < ?', [u'ab', u'ac']))
+        self.assertEqual(unitdata._prefix_range(''), ('key >= ?', [u'']))
+
+    def test_max_character(self):
+        top = six.unichr(sys.maxunicode)
+        self.assertEqual(unitdata._prefix_range(u'ab' + top),
+                         ('key >= ? and key < ?', [u'ab' + top, u'ac']))
+        self.assertEqual(unitdata._prefix_range(top), ('key >= ?', [top]))
+
+
+class TestIterrange(unittest.TestCase):
+
+    overlay = False
+
+    def setUp(self):
+        self.kv = unitdata.Storage(':memory:', overlay=self.overlay)
+        self.kv.update(dict((key, key) for key in KEYS))
+        self.kv.flush()
+
+    def expected(self, prefix):
+        return sorted(key for key in KEYS if key.startswith(prefix))
+
+    def test_prefix_bounds(self):
+        for prefix in (u'ab', u'a_', u'a%', u'ab\xff', u'', u'zz'):
+            self.assertEqual(
+                [k for k, v in self.kv.iterrange(prefix)],
+                self.expected(prefix), prefix)
+
+    def test_strip(self):
+        self.assertEqual(list(self.kv.iterrange(u'ab', strip=True)),
+                         [(key[2:], key) for key in self.expected(u'ab')])
+        self.assertEqual(self.kv.getrange(u'a%', strip=True), {u'b': u'a%b'})
+
+    def test_unsetrange_prefix(self):
+        self.kv.unsetrange(prefix=u'ab')
+        self.assertEqual(sorted(self.kv.getrange(u'')),
+                         sorted(key for key in KEYS
+                                if not key.startswith(u'ab')))
+
+    def test_use_db_while_iterating(self):
+        for key, value in self.kv.iterrange(u'ab'):
+            self.kv.set(u'seen:' + key, value)
+        self.assertEqual(sorted(self.kv.getrange(u'seen:', strip=True)),
+                         self.expected(u'ab'))
+
+
+class TestIterrangeOverlay(TestIterrange):
+
+    overlay = True
+
+
+class TestOverlay(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'unit-state.db')
+        db = unitdata.Storage(self.path)
+        db.update({'a': 1, 'b': 2, 'p:x': 3})
+        db.flush()
+        db.close()
+        self.kv = unitdata.Storage(self.path, overlay=True)
+        self.addCleanup(self.kv.close)
+
+    def stored(self):
+        """Return the committed keys and values"""
+        db = unitdata.Storage(self.path)
+        try:
+            return db.getrange('')
+        finally:
+            db.close()
+
+    def history(self, db, key):
+        return [(revision, k, data) for revision, k, data, hook, date
+                in db.gethistory(key)]
+
+    def test_commit(self):
+        self.kv.set('a', 10)
+        self.kv.unset('b')
+        self.kv.update({'y': 4}, prefix='p:')
+        self.kv.unsetrange(prefix='p:x')
+        self.assertEqual(self.kv.get('a'), 10)
+        self.assertEqual(self.kv.get('b'), None)
+        self.assertEqual(self.kv.getrange('p:', strip=True), {'y': 4})
+        # nothing is written until flushed
+        self.assertEqual(self.stored(), {'a': 1, 'b': 2, 'p:x': 3})
+        self.kv.flush()
+        self.assertEqual(self.stored(), {'a': 10, 'p:y': 4})
+
+    def test_discard(self):
+        self.kv.set('a', 10)
+        self.kv.unsetrange(prefix='p:')
+        self.kv.flush(False)
+        self.assertEqual(self.kv.get('a'), 1)
+        self.assertEqual(self.kv.getrange('p:'), {'p:x': 3})
+        self.kv.flush()
+        self.assertEqual(self.stored(), {'a': 1, 'b': 2, 'p:x': 3})
+
+    def test_reads_served_from_memory(self):
+        self.assertEqual(self.kv.getrange('p:'), {'p:x': 3})
+        self.assertEqual(self.kv.get('a'), 1)
+        db = unitdata.Storage(self.path)
+        db.update({'a': 5, 'p:z': 6})
+        db.flush()
+        db.close()
+        self.assertEqual(self.kv.get('a'), 1)
+        self.assertEqual(self.kv.get('p:z'), None)
+        # a discarded overlay reads the db again
+        self.kv.flush(False)
+        self.assertEqual(self.kv.get('a'), 5)
+
+    def test_revisions_match_direct_writes(self):
+        direct = unitdata.Storage(':memory:')
+        for db in (self.kv, direct):
+            with db.hook_scope('config-changed'):
+                db.set('a', 10)
+                db.set('c', 1)
+                db.unset('c')
+        self.assertEqual(self.history(self.kv, 'a'),
+                         self.history(direct, 'a'))
+        self.assertEqual(self.history(self.kv, 'c'),
+                         self.history(direct, 'c'))
+        self.assertEqual(self.stored()['a'], 10)
+
+    def test_failed_hook_scope_discarded(self):
+        def hook():
+            with self.kv.hook_scope('config-changed'):
+                self.kv.set('a', 10)
+                raise ValueError('hook failed')
+
+        self.assertRaises(ValueError, hook)
+        self.assertEqual(self.kv.get('a'), 1)
+        self.assertEqual(self.history(self.kv, 'a'), [])
+
+
+class TestWrites(unittest.TestCase):
+
+    # sqlite version to write with, the one installed if None
+    sqlite_version = None
+
+    def setUp(self):
+        if self.sqlite_version is not None:
+            kv, revision = unitdata._upsert_statements(self.sqlite_version)
+            _upsert = patch.multiple(unitdata.Storage, _upsert_kv=kv,
+                                     _upsert_revision=revision)
+            _upsert.start()
+            self.addCleanup(_upsert.stop)
+        self.kv = unitdata.Storage(':memory:')
+
+    def history(self, key):
+        return [(k, data) for revision, k, data, hook, date
+                in self.kv.gethistory(key)]
+
+    def test_overwrite(self):
+        self.kv.set('a', 1)
+        self.kv.set('a', {'b': 2})
+        self.kv.update({'a': 3, 'c': 4})
+        self.kv.update({'c': 5}, prefix='p:')
+        self.kv.flush()
+        self.assertEqual(self.kv.getrange(''), {'a': 3, 'c': 4, 'p:c': 5})
+        self.kv.cursor.execute('select count(*) from kv')
+        self.assertEqual(self.kv.cursor.fetchone()[0], 3)
+
+    def test_revisions(self):
+        self.kv.update({'a': 1, 'b': 2})
+        self.kv.flush()
+        with self.kv.hook_scope('config-changed'):
+            # unchanged values get no revision
+            self.kv.set('a', 1)
+            self.kv.update({'b': 2, 'c': 3})
+            # a key written twice keeps its last value for the revision
+            self.kv.set('d', 4)
+            self.kv.update({'d': 5})
+            self.kv.set('b', 6)
+        self.assertEqual(self.history('a'), [])
+        self.assertEqual(self.history('b'), [('b', '6')])
+        self.assertEqual(self.history('c'), [('c', '3')])
+        self.assertEqual(self.history('d'), [('d', '5')])
+        with self.kv.hook_scope('config-changed'):
+            self.kv.set('b', 7)
+        self.assertEqual(self.history('b'), [('b', '6'), ('b', '7')])
+
+
+class TestWritesWithoutUpsert(TestWrites):
+
+    sqlite_version = (3, 23, 0)
+
+    def test_statements(self):
+        self.assertNotIn('on conflict', self.kv._upsert_kv)
+        self.assertNotIn('on conflict', self.kv._upsert_revision)
+
+
+class TestPragmas(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'unit-state.db')
+
+    def pragmas(self, db):
+        values = []
+        for name in ('journal_mode', 'synchronous'):
+            db.cursor.execute('pragma %s' % name)
+            values.append(db.cursor.fetchone()[0])
+        return values
+
+    def open(self, **kwargs):
+        db = unitdata.Storage(self.path, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    def test_reopen(self):
+        db = self.open(synchronous='full')
+        self.assertEqual(self.pragmas(db), ['wal', 2])
+        db.set('a', 1)
+        db.flush()
+        db.close()
+        # the journal mode is kept in the file, the synchronous level is set
+        # again on every connection
+        db = self.open()
+        self.assertEqual(self.pragmas(db), ['wal', 1])
+        self.assertEqual(db.get('a'), 1)
+        db.close()
+        with patch.dict(os.environ, {'UNIT_STATE_DB_SYNCHRONOUS': 'full'}):
+            db = self.open()
+        self.assertEqual(self.pragmas(db), ['wal', 2])
+
+    def test_unknown_level(self):
+        self.assertRaises(ValueError, unitdata.Storage, self.path,
+                          synchronous='fast')
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+import time
 
 from mock import patch, MagicMock
 with patch('charmhelpers.contrib.openstack.'
@@ -169,14 +170,14 @@ class TestKeystoneContexts(CharmTestCase):
         mock_fernet_enabled.return_value = True
         self.assertEqual({'token_flush': False}, ctxt())
 
+    @patch('keystone_utils.fernet_rotation_deadline')
     @patch.object(context, 'charm_dir')
     @patch.object(context, 'local_unit')
     @patch.object(context, 'is_elected_leader')
-    @patch.object(context, 'fernet_enabled')
-    def test_fernet_cron_context(
-            self, mock_fernet_enabled, mock_is_elected_leader, mock_local_unit,
-            mock_charm_dir):
-        ctxt = context.FernetCronContext()
+    def test_fernet_rotation_context(
+            self, mock_is_elected_leader, mock_local_unit, mock_charm_dir,
+            mock_fernet_rotation_deadline):
+        ctxt = context.FernetRotationContext()
 
         mock_charm_dir.return_value = "my-dir"
         mock_local_unit.return_value = "the-local-unit"
@@ -185,18 +186,33 @@ class TestKeystoneContexts(CharmTestCase):
             'enabled': False,
             'unit_name': 'the-local-unit',
             'charm_dir': 'my-dir',
-            'minute': '*/5',
+            'deadline': None,
+            'deadline_file': '/etc/keystone/fernet-rotation-deadline',
+            'on_calendar': None,
+            'on_active_sec': 60,
+            'on_unit_active_sec': 3600,
         }
 
-        mock_fernet_enabled.return_value = False
+        mock_fernet_rotation_deadline.return_value = None
+        mock_is_elected_leader.return_value = True
+        self.assertEqual(expected, ctxt())
+
+        deadline = int(time.time()) + 3600
+        mock_fernet_rotation_deadline.return_value = deadline
         mock_is_elected_leader.return_value = False
+        expected['deadline'] = deadline
+        expected['on_calendar'] = time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(deadline))
         self.assertEqual(expected, ctxt())
 
         mock_is_elected_leader.return_value = True
+        expected['enabled'] = True
         self.assertEqual(expected, ctxt())
 
-        mock_fernet_enabled.return_value = True
-        expected['enabled'] = True
+        # a past deadline would never fire as a calendar event
+        mock_fernet_rotation_deadline.return_value = 86400
+        expected['deadline'] = 86400
+        expected['on_calendar'] = None
         self.assertEqual(expected, ctxt())
 
     def test_fernet_enabled_no_config(self):
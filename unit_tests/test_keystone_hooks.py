@@ -58,6 +58,7 @@ TO_PATCH = [
     'peer_echo',
     'get_relation_ip',
     'open_port',
+    'prefetch_relations',
     'is_leader',
     # charmhelpers.core.host
     'apt_install',
@@ -85,6 +86,11 @@ TO_PATCH = [
     'migrate_database',
     'ensure_initial_admin',
     'add_service_to_keystone',
+    'reconcile_identity_relations',
+    'invalidate_keystone_id_cache',
+    'identity_relation_fingerprints',
+    'changed_identity_relation_units',
+    'store_identity_relation_fingerprints',
     'update_nrpe_config',
     'is_db_ready',
     'create_or_show_domain',
@@ -93,6 +99,10 @@ TO_PATCH = [
     'key_leader_set',
     'key_setup',
     'key_write',
+    'update_fernet_rotation_schedule',
+    'key_acknowledgements',
+    'publish_key_acknowledgement',
+    'fernet_keys_rotate_and_sync',
     # other
     'check_call',
     'execd_preinstall',
@@ -118,6 +128,20 @@ class KeystoneRelationTests(CharmTestCase):
         self.ssh_user = 'juju_keystone'
         self.snap_install_requested.return_value = False
 
+    @patch.object(hooks, 'assess_status')
+    @patch.object(hooks, 'resume_deferred_restarts')
+    @patch.object(hooks, 'set_deferred_restart_handler')
+    @patch.object(hooks, 'restart_coordinator')
+    @patch.object(hooks, 'atexit')
+    @patch.object(hooks, 'batch_relation_set')
+    @patch.object(hooks, 'set_log_level')
+    @patch.object(hooks, 'hooks')
+    def test_main(self, _hooks, set_log_level, *args):
+        self.test_config.set('charm-log-level', 'INFO')
+        hooks.main()
+        set_log_level.assert_called_once_with('INFO')
+        self.assertTrue(_hooks.execute.called)
+
     @patch.object(utils, 'os_release')
     @patch.object(hooks, 'service_stop', lambda *args: None)
     @patch.object(hooks, 'service_start', lambda *args: None)
@@ -213,6 +237,7 @@ class KeystoneRelationTests(CharmTestCase):
         self.assertEqual([call('/etc/keystone/keystone.conf')],
                          configs.write.call_args_list)
         self.assertTrue(leader_init.called)
+        self.invalidate_keystone_id_cache.assert_called_once_with()
 
     @patch.object(hooks, 'update_all_domain_backends')
     @patch.object(hooks, 'update_all_identity_relation_units')
@@ -366,6 +391,23 @@ class KeystoneRelationTests(CharmTestCase):
 
         self.assertFalse(self.do_openstack_upgrade_reexec.called)
 
+    @patch.object(hooks, '_config_changed_postupgrade')
+    @patch('charmhelpers.contrib.openstack.utils.is_unit_paused_set')
+    @patch('charmhelpers.contrib.openstack.utils.restart_on_change_helper')
+    def test_config_changed_postupgrade_restarts_at_once(
+            self, restart_on_change_helper, is_unit_paused_set,
+            _config_changed_postupgrade):
+        is_unit_paused_set.return_value = False
+        restart_on_change_helper.side_effect = (
+            lambda f, restart_map, stopstart, restart_functions, deferred:
+            f())
+        hooks.config_changed_postupgrade()
+        _config_changed_postupgrade.assert_called_once_with()
+        # the rest of the hook uses the upgraded services, the restarts do
+        # not wait for the coordinator
+        self.assertEqual(restart_on_change_helper.call_count, 1)
+        self.assertFalse(restart_on_change_helper.call_args[0][4])
+
     @patch.object(hooks, 'is_db_initialised')
     @patch('keystone_utils.log')
     @patch.object(hooks, 'send_notifications')
@@ -385,11 +427,33 @@ class KeystoneRelationTests(CharmTestCase):
             remote_unit='unit/0')
         self.add_service_to_keystone.assert_called_with(
             'identity-service:0',
-            'unit/0')
+            'unit/0',
+            publish_only=False)
         self.delete_service_entry.assert_called_with(
             'quantum',
             'network')
 
+    @patch.object(hooks, 'is_db_initialised')
+    @patch('keystone_utils.log')
+    @patch.object(hooks, 'send_notifications')
+    def test_identity_changed_leader_reconciled(self, mock_send_notifications,
+                                                mock_log,
+                                                mock_is_db_initialised):
+        self.expect_ha.return_value = False
+        mock_is_db_initialised.return_value = True
+        self.is_db_ready.return_value = True
+        self.is_service_present.return_value = True
+        self.relation_get.return_value = {}
+        hooks.identity_changed(
+            relation_id='identity-service:0',
+            remote_unit='unit/0',
+            reconciled=True)
+        self.add_service_to_keystone.assert_called_with(
+            'identity-service:0',
+            'unit/0',
+            publish_only=True)
+        self.assertFalse(self.delete_service_entry.called)
+
     @patch.object(hooks, 'is_db_initialised')
     @patch('keystone_utils.log')
     @patch.object(hooks, 'send_notifications')
@@ -449,6 +513,16 @@ class KeystoneRelationTests(CharmTestCase):
         whitelist = ['_passwd', 'identity-service:']
         self.peer_echo.assert_called_with(force=True, includes=whitelist)
         self.assertTrue(configs.write_all.called)
+        self.fernet_keys_rotate_and_sync.assert_not_called()
+
+        # the leader checks whether a pending rotation may go ahead
+        self.is_leader.return_value = True
+        self.fernet_enabled.return_value = True
+        hooks.cluster_changed()
+        self.key_acknowledgements.assert_called_once_with()
+        # the peer relation is only read once
+        self.fernet_keys_rotate_and_sync.assert_called_once_with(
+            acknowledgements=self.key_acknowledgements.return_value)
 
     @patch.object(hooks, 'update_all_identity_relation_units')
     @patch.object(hooks.CONFIGS, 'write')
@@ -719,7 +793,7 @@ class KeystoneRelationTests(CharmTestCase):
         hooks.leader_init_db_if_ready()
         self.is_db_ready.assert_called_with(use_current_context=False)
         self.migrate_database.assert_called_with()
-        update.assert_called_with(check_db_ready=False)
+        update.assert_called_with(check_db_ready=False, force=True)
 
     @patch.object(hooks, 'update_all_identity_relation_units')
     def test_leader_init_db_not_leader(self, update):
@@ -772,6 +846,13 @@ class KeystoneRelationTests(CharmTestCase):
                                                 configure_https):
         """ Verify all identity relations are updated """
         is_db_initialized.return_value = True
+        self.is_elected_leader.return_value = True
+        self.expect_ha.return_value = False
+        self.reconcile_identity_relations.return_value = set([
+            ('identity-relation:0', 'unit/0')])
+        fingerprints = {('identity-relation:0', 'unit/0'): 'abc'}
+        self.identity_relation_fingerprints.return_value = fingerprints
+        self.changed_identity_relation_units.return_value = set(fingerprints)
         self.relation_ids.return_value = ['identity-relation:0']
         self.related_units.return_value = ['unit/0']
         log_calls = [call('Firing identity_changed hook for all related '
@@ -781,14 +862,102 @@ class KeystoneRelationTests(CharmTestCase):
                      call('Firing identity_credentials_changed hook for all '
                           'related services.')]
         hooks.update_all_identity_relation_units(check_db_ready=False)
+        self.assertTrue(self.reconcile_identity_relations.called)
         identity_changed.assert_called_with(
             relation_id='identity-relation:0',
-            remote_unit='unit/0')
+            remote_unit='unit/0',
+            reconciled=True)
         identity_credentials_changed.assert_called_with(
             relation_id='identity-relation:0',
-            remote_unit='unit/0')
+            remote_unit='unit/0',
+            reconciled=True)
         admin_relation_changed.assert_called_with('identity-relation:0')
         self.log.assert_has_calls(log_calls, any_order=True)
+        self.store_identity_relation_fingerprints.assert_called_once_with(
+            fingerprints)
+        self.prefetch_relations.assert_called_once_with(
+            hooks.RESYNC_RELATIONS)
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'admin_relation_changed')
+    @patch.object(hooks, 'identity_credentials_changed')
+    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'is_db_initialised')
+    @patch.object(hooks, 'CONFIGS')
+    def test_update_all_identity_relation_units_unchanged(
+            self, configs, is_db_initialized, identity_changed,
+            identity_credentials_changed, admin_relation_changed,
+            configure_https):
+        """ Verify unchanged identity relation units are skipped """
+        is_db_initialized.return_value = True
+        self.is_elected_leader.return_value = True
+        self.expect_ha.return_value = False
+        self.reconcile_identity_relations.return_value = set([
+            ('identity-relation:0', 'unit/0')])
+        fingerprints = {('identity-relation:0', 'unit/0'): 'abc'}
+        self.identity_relation_fingerprints.return_value = fingerprints
+        self.changed_identity_relation_units.return_value = set()
+        self.relation_ids.return_value = ['identity-relation:0']
+        self.related_units.return_value = ['unit/0']
+        hooks.update_all_identity_relation_units(check_db_ready=False)
+        self.assertFalse(self.reconcile_identity_relations.called)
+        self.assertFalse(identity_changed.called)
+        self.assertFalse(identity_credentials_changed.called)
+        admin_relation_changed.assert_called_with('identity-relation:0')
+
+        hooks.update_all_identity_relation_units(check_db_ready=False,
+                                                 force=True)
+        self.assertTrue(self.reconcile_identity_relations.called)
+        identity_changed.assert_called_with(
+            relation_id='identity-relation:0',
+            remote_unit='unit/0',
+            reconciled=True)
+        self.assertEqual(
+            self.store_identity_relation_fingerprints.call_count, 2)
+
+    @patch.object(hooks, 'configure_https')
+    @patch.object(hooks, 'admin_relation_changed')
+    @patch.object(hooks, 'identity_credentials_changed')
+    @patch.object(hooks, 'identity_changed')
+    @patch.object(hooks, 'is_db_initialised')
+    @patch.object(hooks, 'CONFIGS')
+    def test_update_all_identity_relation_units_new_unit(
+            self, configs, is_db_initialized, identity_changed,
+            identity_credentials_changed, admin_relation_changed,
+            configure_https):
+        """ Verify a new unit is not handled again by the next resync """
+        is_db_initialized.return_value = True
+        self.is_elected_leader.return_value = True
+        self.expect_ha.return_value = False
+        self.relation_ids.side_effect = lambda relation: {
+            'identity-service': ['identity-service:0']}.get(relation, [])
+        self.related_units.return_value = ['nova/0']
+        key = ('identity-service:0', 'nova/0')
+        # the fingerprints include the passwords the leader holds
+        passwords = {}
+        self.identity_relation_fingerprints.side_effect = (
+            lambda: {key: 'nova:{}'.format(passwords.get('nova_passwd'))})
+
+        def reconcile():
+            passwords['nova_passwd'] = 'secret'
+            return set([key])
+
+        self.reconcile_identity_relations.side_effect = reconcile
+        stored = {}
+        self.changed_identity_relation_units.side_effect = (
+            lambda fingerprints: set(k for k, v in fingerprints.items()
+                                     if stored.get(k) != v))
+        self.store_identity_relation_fingerprints.side_effect = stored.update
+
+        hooks.update_all_identity_relation_units(check_db_ready=False)
+        identity_changed.assert_called_once_with(
+            relation_id='identity-service:0', remote_unit='nova/0',
+            reconciled=True)
+        self.assertEqual(stored, {key: 'nova:secret'})
+
+        hooks.update_all_identity_relation_units(check_db_ready=False)
+        self.assertEqual(identity_changed.call_count, 1)
+        self.assertEqual(self.reconcile_identity_relations.call_count, 1)
 
     @patch.object(hooks, 'configure_https')
     @patch.object(hooks, 'CONFIGS')
@@ -800,6 +969,7 @@ class KeystoneRelationTests(CharmTestCase):
         self.log.assert_called_with('Allowed_units list provided and this '
                                     'unit not present', level='INFO')
         self.assertFalse(self.relation_ids.called)
+        self.assertFalse(self.prefetch_relations.called)
 
     @patch.object(hooks, 'configure_https')
     @patch.object(hooks, 'is_db_initialised')
@@ -814,6 +984,7 @@ class KeystoneRelationTests(CharmTestCase):
                                     'deferring identity-relation updates',
                                     level='INFO')
         self.assertFalse(self.relation_ids.called)
+        self.assertFalse(self.prefetch_relations.called)
 
     @patch.object(hooks, 'configure_https')
     @patch.object(hooks, 'is_db_initialised')
@@ -839,6 +1010,8 @@ class KeystoneRelationTests(CharmTestCase):
         self.assertFalse(self.ensure_initial_admin.called)
         # Still updates relations
         self.assertTrue(self.relation_ids.called)
+        # the units' data is only fetched up front for the leader's resync
+        self.assertFalse(self.prefetch_relations.called)
 
     @patch.object(hooks, 'update_all_identity_relation_units')
     @patch.object(utils, 'os_release')
@@ -14,11 +14,16 @@
 
 import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
+import jinja2
 from mock import MagicMock, call, mock_open, patch
+from charmhelpers.core import unitdata
 from test_utils import CharmTestCase
 
 if sys.version_info.major == 2:
@@ -44,6 +49,7 @@ TO_PATCH = [
     'get_admin_token',
     'get_local_endpoint',
     'get_requested_roles',
+    'keystone_id_cache',
     'get_service_password',
     'get_os_codename_install_source',
     'grant_role',
@@ -329,6 +335,7 @@ class TestKeystoneUtils(CharmTestCase):
         mock_keystone = MagicMock()
         mock_keystone.resolve_tenant_id.return_value = 'tenant_id'
         mock_keystone.resolve_domain_id.return_value = service_domain_id
+        mock_keystone.resolve_user_id.return_value = None
         KeystoneManager.return_value = mock_keystone
 
         self.relation_get.return_value = {'service': 'keystone',
@@ -566,12 +573,15 @@ class TestKeystoneUtils(CharmTestCase):
         mock_keystone = MagicMock()
         KeystoneManager.return_value = mock_keystone
 
-        mock_user = MagicMock()
-        mock_keystone.resolve_user_id.return_value = mock_user
-        mock_keystone.api.users.list.return_value = [mock_user]
+        users = {}
+
+        def resolve_user_id(name, user_domain=None):
+            return users.get(name.lower())
+
+        mock_keystone.resolve_user_id.side_effect = resolve_user_id
 
         # User found is the same i.e. userA == userA
-        mock_user.name = 'userA'
+        users = {'usera': 'uid-a'}
         utils.create_user('userA', 'passA')
         mock_keystone.resolve_user_id.assert_called_with('userA',
                                                          user_domain=None)
@@ -579,14 +589,13 @@ class TestKeystoneUtils(CharmTestCase):
 
         # User found has different case but is the same
         # i.e. Usera != userA
-        mock_user.name = 'Usera'
-        utils.create_user('userA', 'passA')
-        mock_keystone.resolve_user_id.assert_called_with('userA',
+        utils.create_user('Usera', 'passA')
+        mock_keystone.resolve_user_id.assert_called_with('Usera',
                                                          user_domain=None)
         mock_keystone.create_user.assert_not_called()
 
         # User is different i.e. UserB != userA
-        mock_user.name = 'UserB'
+        users = {'userb': 'uid-b'}
         utils.create_user('userA', 'passA')
         mock_keystone.resolve_user_id.assert_called_with('userA',
                                                          user_domain=None)
@@ -718,6 +727,7 @@ class TestKeystoneUtils(CharmTestCase):
         self.related_units.return_value = []
         self.assertTrue(utils.is_db_ready())
 
+    @patch.object(utils, 'get_manager')
     @patch.object(utils, 'leader_set')
     @patch.object(utils, 'leader_get')
     @patch('charmhelpers.contrib.openstack.ip.unit_get')
@@ -736,7 +746,10 @@ class TestKeystoneUtils(CharmTestCase):
                                               _is_clustered,
                                               _unit_get,
                                               _leader_get,
-                                              _leader_set):
+                                              _leader_set,
+                                              _get_manager):
+        _get_manager.return_value.batch.side_effect = \
+            lambda calls: [c() for c in calls]
         _is_clustered.return_value = False
         _ip_config.side_effect = self.test_config.get
         _unit_get.return_value = '10.0.0.1'
@@ -752,6 +765,50 @@ class TestKeystoneUtils(CharmTestCase):
             region='RegionOne',
         )
 
+    @patch.object(utils, 'get_manager')
+    def test_grant_roles_resolves_before_batching(self, get_manager):
+        main = threading.current_thread()
+        lookups = []
+        grants = []
+        mock_keystone = get_manager.return_value
+
+        def _resolve(name, **kwargs):
+            lookups.append(threading.current_thread())
+            return name + '-id'
+
+        def _batch(calls):
+            results = []
+            for c in calls:
+                worker = threading.Thread(target=lambda: results.append(c()))
+                worker.start()
+                worker.join()
+            return results
+
+        def _add_user_role(**kwargs):
+            grants.append((threading.current_thread(), kwargs))
+
+        mock_keystone.resolve_user_id.side_effect = _resolve
+        mock_keystone.resolve_role_id.side_effect = _resolve
+        mock_keystone.resolve_tenant_id.side_effect = _resolve
+        mock_keystone.resolve_domain_id.side_effect = _resolve
+        mock_keystone.roles_for_user.side_effect = \
+            lambda *args, **kwargs: [MagicMock(id='Member-id')]
+        mock_keystone.add_user_role.side_effect = _add_user_role
+        mock_keystone.batch.side_effect = _batch
+        utils.grant_roles([
+            dict(user='admin', role='Member', tenant='admin',
+                 user_domain='admin_domain', project_domain='admin_domain'),
+            dict(user='admin', role='Admin', domain='admin_domain',
+                 user_domain='admin_domain')])
+        self.assertEqual(len(lookups), 6)
+        self.assertEqual(set(lookups), set([main]))
+        self.assertEqual(len(grants), 1)
+        self.assertNotEqual(grants[0][0], main)
+        self.assertEqual(grants[0][1], {'user': 'admin-id',
+                                        'role': 'Admin-id',
+                                        'tenant': None,
+                                        'domain': 'admin_domain-id'})
+
     @patch.object(utils, 'get_manager')
     def test_is_service_present(self, KeystoneManager):
         mock_keystone = MagicMock()
@@ -772,7 +829,7 @@ class TestKeystoneUtils(CharmTestCase):
         mock_keystone.resolve_service_id.return_value = 'sid1'
         KeystoneManager.return_value = mock_keystone
         utils.delete_service_entry('bob', 'bill')
-        mock_keystone.api.services.delete.assert_called_with('sid1')
+        mock_keystone.delete_service.assert_called_with('sid1')
 
     @patch('os.path.isfile')
     def test_get_file_stored_domain_id(self, isfile_mock):
@@ -1165,10 +1222,14 @@ class TestKeystoneUtils(CharmTestCase):
         utils.fernet_rotate()
         self.subprocess.check_output.called_with(cmd)
 
+    @patch.object(utils, 'leader_commit')
     @patch.object(utils, 'leader_set')
+    @patch.object(utils, 'leader_get')
     @patch('os.listdir')
-    def test_key_leader_set(self, listdir, leader_set):
+    def test_key_leader_set(self, listdir, leader_get, leader_set,
+                            leader_commit):
         listdir.return_value = ['0', '1']
+        leader_get.return_value = None
         self.time.time.return_value = "the-time"
         with patch.object(builtins, 'open', mock_open(
                 read_data="some_data")):
@@ -1176,19 +1237,45 @@ class TestKeystoneUtils(CharmTestCase):
         listdir.has_calls([
             call(utils.FERNET_KEY_REPOSITORY),
             call(utils.CREDENTIAL_KEY_REPOSITORY)])
+        digest = utils._key_digest('some_data')
         leader_set.assert_called_with(
             {'key_repository': json.dumps(
-                {utils.FERNET_KEY_REPOSITORY:
-                    {'0': 'some_data', '1': 'some_data'},
-                 utils.CREDENTIAL_KEY_REPOSITORY:
-                    {'0': 'some_data', '1': 'some_data'}})
+                {'generation': 1,
+                 'keys': {utils.FERNET_KEY_REPOSITORY:
+                          {'0': 'some_data', '1': 'some_data'},
+                          utils.CREDENTIAL_KEY_REPOSITORY:
+                          {'0': 'some_data', '1': 'some_data'}},
+                 'digests': {utils.FERNET_KEY_REPOSITORY:
+                             {'0': digest, '1': digest},
+                             utils.CREDENTIAL_KEY_REPOSITORY:
+                             {'0': digest, '1': digest}},
+                 'published': 'the-time'},
+                sort_keys=True)
              })
+        leader_commit.assert_called_once_with()
 
+        # the generation is bumped when a key changes and kept otherwise
+        leader_get.return_value = leader_set.call_args[0][0]['key_repository']
+        leader_set.reset_mock()
+        with patch.object(builtins, 'open', mock_open(
+                read_data="some_data")):
+            utils.key_leader_set()
+        leader_set.assert_not_called()
+        with patch.object(builtins, 'open', mock_open(
+                read_data="other_data")):
+            utils.key_leader_set()
+        self.assertEqual(json.loads(
+            leader_set.call_args[0][0]['key_repository'])['generation'], 2)
+
+    @patch.object(utils, '_fsync_directory')
+    @patch.object(utils.unitdata, 'kv')
     @patch('os.rename')
     @patch.object(utils, 'leader_get')
     @patch('os.listdir')
     @patch('os.remove')
-    def test_key_write(self, remove, listdir, leader_get, rename):
+    def test_key_write(self, remove, listdir, leader_get, rename, kv,
+                       _fsync_directory):
+        kv.return_value = unitdata.Storage(':memory:')
         leader_get.return_value = json.dumps(
             {utils.FERNET_KEY_REPOSITORY:
                 {'0': 'key0', '1': 'key1'},
@@ -1228,6 +1315,59 @@ class TestKeystoneUtils(CharmTestCase):
                      os.path.join(utils.FERNET_KEY_REPOSITORY, '1')),
             ], any_order=True)
 
+    @patch.object(utils.unitdata, 'kv')
+    @patch.object(utils, 'leader_get')
+    def test_key_write_incremental(self, leader_get, kv):
+        kv.return_value = unitdata.Storage(':memory:')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fernet = os.path.join(tmpdir, 'fernet-keys')
+        credential = os.path.join(tmpdir, 'credential-keys')
+        for path in (fernet, credential):
+            os.mkdir(path)
+        for key_number, key in (('0', 'key0'), ('1', 'old1'), ('2', 'key2')):
+            with open(os.path.join(fernet, key_number), 'w') as f:
+                f.write(key)
+
+        def write_file(path, content, **kwargs):
+            with open(path, 'w') as f:
+                f.write(content)
+        self.write_file.side_effect = write_file
+        keys = {fernet: {'0': 'key0', '1': 'key1'}, credential: {}}
+        digests = {fernet: {'0': utils._key_digest('key0'),
+                            '1': utils._key_digest('key1')},
+                   credential: {}}
+        leader_get.return_value = json.dumps(
+            {'generation': 3, 'keys': keys, 'digests': digests})
+        with patch.multiple(utils, FERNET_KEY_REPOSITORY=fernet,
+                            CREDENTIAL_KEY_REPOSITORY=credential,
+                            KEY_SETUP_FILE=os.path.join(tmpdir, 'key-setup')):
+            utils.key_write()
+            self.write_file.assert_called_once_with(
+                os.path.join(fernet, '.1'), 'key1', owner='keystone',
+                group='keystone', perms=0o600)
+            self.assertEqual(sorted(os.listdir(fernet)), ['0', '1'])
+            with open(os.path.join(fernet, '1')) as f:
+                self.assertEqual(f.read(), 'key1')
+            self.assertEqual(kv.return_value.get(utils.KEY_GENERATION_KEY), 3)
+
+            # the same generation is not looked at again
+            os.remove(os.path.join(fernet, '0'))
+            self.write_file.reset_mock()
+            utils.key_write()
+            self.write_file.assert_not_called()
+            self.assertEqual(os.listdir(fernet), ['1'])
+
+            # keys that do not match their digest are not written at all
+            keys[fernet]['0'] = 'corrupt'
+            leader_get.return_value = json.dumps(
+                {'generation': 4, 'keys': keys, 'digests': digests})
+            utils.key_write()
+            self.write_file.assert_not_called()
+            self.assertEqual(kv.return_value.get(utils.KEY_GENERATION_KEY), 3)
+
+    @patch.object(utils, 'fernet_rotation_acknowledged')
+    @patch.object(utils, 'update_fernet_rotation_schedule')
     @patch.object(utils, 'keystone_context')
     @patch.object(utils, 'fernet_rotate')
     @patch.object(utils, 'key_leader_set')
@@ -1236,7 +1376,9 @@ class TestKeystoneUtils(CharmTestCase):
     def test_fernet_keys_rotate_and_sync(self, mock_is_leader, mock_os,
                                          mock_key_leader_set,
                                          mock_fernet_rotate,
-                                         mock_keystone_context):
+                                         mock_keystone_context,
+                                         mock_update_schedule,
+                                         mock_acknowledged):
         self.test_config.set('fernet-max-active-keys', 3)
         self.test_config.set('token-expiration', 60)
         self.time.time.return_value = 0
@@ -1269,8 +1411,507 @@ class TestKeystoneUtils(CharmTestCase):
             'No rotation until at least Thu Jan  1 00:01:10 1970',
             level='DEBUG')
         mock_key_leader_set.assert_not_called()
-        # finally, set it up so that the rotation and sync occur
+        mock_update_schedule.assert_called_once_with()
+        # the peer units have not installed the current keys yet, the
+        # rotation is rescheduled rather than retried
         self.time.time.return_value = 71
+        mock_acknowledged.return_value = False
+        utils.fernet_keys_rotate_and_sync(log_func=self.log)
+        mock_acknowledged.assert_called_once_with(70, log_func=self.log,
+                                                  acknowledgements=None)
+        mock_fernet_rotate.assert_not_called()
+        self.assertEqual(mock_update_schedule.call_count, 2)
+        # finally, set it up so that the rotation and sync occur
+        mock_acknowledged.return_value = True
         utils.fernet_keys_rotate_and_sync()
         mock_fernet_rotate.assert_called_once_with()
         mock_key_leader_set.assert_called_once_with()
+        self.assertEqual(mock_update_schedule.call_count, 3)
+
+    @patch.object(utils, 'update_fernet_rotation_schedule')
+    @patch.object(utils, 'fernet_rotate')
+    @patch.object(utils, 'is_unit_paused_set')
+    @patch.object(utils, 'keystone_context')
+    @patch.object(utils, 'is_leader')
+    @patch('os.stat')
+    def test_fernet_keys_rotate_and_sync_reschedules(
+            self, mock_stat, mock_is_leader, mock_keystone_context,
+            mock_is_unit_paused_set, mock_fernet_rotate,
+            mock_update_schedule):
+        mock_is_leader.return_value = True
+        mock_keystone_context.fernet_enabled.return_value = True
+        # the timer runs once, a paused unit still needs the next run
+        mock_is_unit_paused_set.return_value = True
+        utils.fernet_keys_rotate_and_sync(log_func=self.log)
+        mock_update_schedule.assert_called_once_with()
+        mock_stat.assert_not_called()
+        # key repository not initialized yet
+        mock_is_unit_paused_set.return_value = False
+        mock_stat.side_effect = OSError()
+        mock_update_schedule.reset_mock()
+        utils.fernet_keys_rotate_and_sync(log_func=self.log)
+        mock_update_schedule.assert_called_once_with()
+        self.log.assert_called_with(
+            'Fernet key rotation requested but key repository not '
+            'initialized yet', level='WARNING')
+        mock_fernet_rotate.assert_not_called()
+
+    @patch.object(utils, 'relation_set')
+    @patch.object(utils, 'relation_ids')
+    @patch('os.path.isdir')
+    @patch('os.listdir')
+    @patch.object(utils, '_key_file_digest')
+    def test_publish_key_acknowledgement(self, _key_file_digest, listdir,
+                                         isdir, relation_ids, relation_set):
+        isdir.return_value = True
+        listdir.return_value = ['0', '1', '.2']
+        _key_file_digest.side_effect = lambda path: path[-1]
+        relation_ids.return_value = ['cluster:1']
+        utils.publish_key_acknowledgement()
+        relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={'fernet-key-digest': utils._key_set_digest(
+                {'0': '0', '1': '1'})})
+
+    @patch.object(utils.unitdata, 'kv')
+    @patch.object(utils, 'relation_get')
+    @patch.object(utils, 'related_units')
+    @patch.object(utils, 'relation_ids')
+    @patch.object(utils, 'leader_get')
+    def test_fernet_rotation_acknowledged(self, leader_get, relation_ids,
+                                          related_units, relation_get, kv):
+        db = kv.return_value = unitdata.Storage(':memory:')
+        digests = {utils.FERNET_KEY_REPOSITORY: {'0': 'a', '1': 'b'}}
+        leader_get.return_value = json.dumps(
+            {'generation': 2, 'keys': {}, 'digests': digests,
+             'published': 100})
+        relation_ids.return_value = ['cluster:1']
+        related_units.return_value = ['keystone/1', 'keystone/2']
+        acks = {'keystone/1': utils._key_set_digest(
+            digests[utils.FERNET_KEY_REPOSITORY])}
+        relation_get.side_effect = (
+            lambda attribute, rid, unit: acks.get(unit))
+        self.test_config.set('fernet-rotation-ack-timeout', 60)
+        self.time.time.return_value = 110
+        self.assertFalse(utils.fernet_rotation_acknowledged(100))
+        self.assertEqual(db.get(utils.FERNET_KEY_ACKS_KEY),
+                         {'generation': 2, 'latency': {'keystone/1': 10}})
+
+        self.test_config.set('fernet-rotation-quorum', 1)
+        self.assertTrue(utils.fernet_rotation_acknowledged(100))
+        self.test_config.set('fernet-rotation-quorum', 0)
+        self.time.time.return_value = 160
+        self.assertTrue(utils.fernet_rotation_acknowledged(100))
+
+        acks['keystone/2'] = acks['keystone/1']
+        self.time.time.return_value = 130
+        # acknowledgements already read are not read again
+        relation_get.reset_mock()
+        self.assertFalse(utils.fernet_rotation_acknowledged(
+            100, acknowledgements=(set(['keystone/1']), 2)))
+        relation_get.assert_not_called()
+        self.assertTrue(utils.fernet_rotation_acknowledged(100))
+        self.assertEqual(db.get(utils.FERNET_KEY_ACKS_KEY),
+                         {'generation': 2,
+                          'latency': {'keystone/1': 10, 'keystone/2': 30}})
+
+    @patch.object(utils, 'key_acknowledgements')
+    @patch('os.stat')
+    @patch.object(utils, 'keystone_context')
+    @patch.object(utils, 'is_leader')
+    def test_fernet_rotation_deadline(self, mock_is_leader,
+                                      mock_keystone_context, mock_stat,
+                                      mock_key_acknowledgements):
+        self.test_config.set('fernet-max-active-keys', 4)
+        self.test_config.set('token-expiration', 60)
+        self.test_config.set('fernet-rotation-ack-timeout', 300)
+        self.time.time.return_value = 0
+        mock_is_leader.return_value = True
+        mock_keystone_context.fernet_enabled.return_value = True
+        mock_stat.return_value.st_mtime = 10.5
+        self.assertEqual(utils.fernet_rotation_deadline(), 41)
+        mock_stat.assert_called_once_with(
+            os.path.join(utils.FERNET_KEY_REPOSITORY, '0'))
+        mock_key_acknowledgements.assert_not_called()
+        # a due rotation waits for the peer units until the ack timeout
+        self.time.time.return_value = 50
+        mock_key_acknowledgements.return_value = (set(['keystone/1']), 2)
+        self.assertEqual(utils.fernet_rotation_deadline(), 341)
+        mock_key_acknowledgements.return_value = (
+            set(['keystone/1', 'keystone/2']), 2)
+        self.assertEqual(utils.fernet_rotation_deadline(), 41)
+        mock_stat.side_effect = OSError()
+        self.assertEqual(utils.fernet_rotation_deadline(), None)
+        mock_stat.side_effect = None
+        mock_is_leader.return_value = False
+        self.assertEqual(utils.fernet_rotation_deadline(), None)
+
+    @patch.object(utils, 'render')
+    @patch.object(utils, 'keystone_context')
+    def test_update_fernet_rotation_schedule(self, mock_keystone_context,
+                                             mock_render):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = dict(
+            (name, os.path.join(tmpdir, name))
+            for name in ('keystone-fernet-rotate-sync',
+                         'fernet-rotation-deadline',
+                         'keystone-fernet-rotate-sync.service',
+                         'keystone-fernet-rotate-sync.timer'))
+        with open(paths['keystone-fernet-rotate-sync'], 'w') as f:
+            f.write('cron')
+
+        def write_file(path, content, **kwargs):
+            with open(path, 'w') as f:
+                f.write(content)
+        self.write_file.side_effect = write_file
+        mock_render.side_effect = (
+            lambda source, target, ctxt: '{} {}'.format(
+                source, ctxt['on_calendar']))
+        ctxt = {'enabled': True, 'deadline': 86400,
+                'on_calendar': '1970-01-02 00:00:00', 'on_active_sec': 60,
+                'on_unit_active_sec': 3600}
+        mock_keystone_context.FernetRotationContext.return_value \
+            .return_value = ctxt
+        timer = 'keystone-fernet-rotate-sync.timer'
+        with patch.multiple(
+                utils,
+                FERNET_KEY_ROTATE_SYNC_CRON_FILE=paths[
+                    'keystone-fernet-rotate-sync'],
+                FERNET_ROTATION_DEADLINE_FILE=paths[
+                    'fernet-rotation-deadline'],
+                FERNET_ROTATE_SYNC_SERVICE=paths[
+                    'keystone-fernet-rotate-sync.service'],
+                FERNET_ROTATE_SYNC_TIMER=paths[timer]):
+            utils.update_fernet_rotation_schedule()
+            self.assertEqual(sorted(os.listdir(tmpdir)), [
+                'fernet-rotation-deadline',
+                'keystone-fernet-rotate-sync.service',
+                'keystone-fernet-rotate-sync.timer'])
+            with open(paths['fernet-rotation-deadline']) as f:
+                self.assertEqual(f.read(), '86400\n')
+            with open(paths[timer]) as f:
+                self.assertEqual(f.read(), timer + ' 1970-01-02 00:00:00')
+            self.subprocess.check_call.assert_has_calls([
+                call(['systemctl', 'daemon-reload']),
+                call(['systemctl', 'enable', timer]),
+                call(['systemctl', 'restart', timer])])
+
+            # nothing to do while the deadline does not change
+            self.subprocess.check_call.reset_mock()
+            utils.update_fernet_rotation_schedule()
+            self.subprocess.check_call.assert_not_called()
+
+            ctxt['enabled'] = False
+            utils.update_fernet_rotation_schedule()
+            self.subprocess.check_call.assert_has_calls([
+                call(['systemctl', 'disable', '--now', timer]),
+                call(['systemctl', 'daemon-reload'])])
+            self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_fernet_rotate_sync_timer_template(self):
+        templates = os.path.join(os.path.dirname(__file__), '..',
+                                 'templates')
+        with open(os.path.join(templates,
+                               'keystone-fernet-rotate-sync.timer')) as f:
+            template = jinja2.Template(f.read())
+        timer = template.render(on_calendar='2026-10-18 12:00:00',
+                                on_active_sec=60, on_unit_active_sec=3600)
+        self.assertIn('\nOnCalendar=2026-10-18 12:00:00\n'
+                      'Persistent=true\nOnUnitActiveSec=3600\n\n[Install]',
+                      timer)
+        self.assertNotIn('OnActiveSec', timer)
+        # an overdue rotation, a past calendar event would never fire
+        timer = template.render(on_calendar=None, on_active_sec=60,
+                                on_unit_active_sec=3600)
+        self.assertIn('\nOnActiveSec=60\nOnUnitActiveSec=3600\n\n[Install]',
+                      timer)
+        self.assertNotIn('OnCalendar', timer)
+
+    @patch.object(utils, 'get_api_version')
+    def test_collect_desired_identity_state(self, get_api_version):
+        get_api_version.return_value = 3
+        self.test_config.set('service-tenant', 'services')
+        self.test_config.set('admin-role', 'Admin')
+        self.get_requested_roles.side_effect = \
+            lambda s: s.get('requested_roles', '').split(',') if \
+            s.get('requested_roles') else []
+        self.relation_ids.side_effect = lambda r: {
+            'identity-service': ['identity-service:0'],
+            'identity-credentials': ['identity-credentials:1']}[r]
+        self.related_units.side_effect = lambda rid: {
+            'identity-service:0': ['nova/0', 'nova/1', 'bad/0'],
+            'identity-credentials:1': ['vault/0']}[rid]
+        settings = {
+            'nova/0': {'nova_service': 'nova',
+                       'nova_region': 'RegionOne',
+                       'nova_public_url': 'http://pub',
+                       'nova_admin_url': 'http://adm',
+                       'nova_internal_url': 'http://int',
+                       'ec2_service': 'ec2',
+                       'ec2_region': 'RegionOne',
+                       'ec2_public_url': 'http://pub/ec2',
+                       'ec2_admin_url': 'http://adm/ec2',
+                       'ec2_internal_url': 'http://int/ec2',
+                       'requested_roles': 'Member'},
+            'bad/0': {'service': 'bad', 'region': 'RegionOne',
+                      'public_url': 'a', 'admin_url': 'b',
+                      'internal_url': 'c'},
+            'vault/0': {'username': 'vault', 'requested_grants': 'Reader'},
+        }
+        settings['nova/1'] = settings['nova/0']
+        self.relation_get.side_effect = \
+            lambda rid, unit: settings[unit]
+        state, units = utils.collect_desired_identity_state()
+        self.assertEqual(units, set([('identity-service:0', 'nova/0'),
+                                     ('identity-service:0', 'nova/1'),
+                                     ('identity-credentials:1', 'vault/0')]))
+        self.assertEqual(sorted(state['services'].keys()), ['ec2', 'nova'])
+        self.assertEqual(state['endpoints'][('nova', 'RegionOne')],
+                         {'public': 'http://pub',
+                          'admin': 'http://adm',
+                          'internal': 'http://int'})
+        self.assertEqual(state['roles'], ['Member'])
+        self.assertEqual(state['projects'], [('services', 'service_domain')])
+        self.assertEqual(dict(state['service_users']),
+                         {'ec2_nova': ['Member']})
+        self.assertEqual(
+            dict(state['credentials_users']),
+            {('vault', 'service_domain'): {'tenant': 'services',
+                                           'grants': ['Reader'],
+                                           'new_roles': []}})
+
+    def _catalog_manager(self, api_version):
+        manager = MagicMock()
+        manager.api_version = api_version
+        svc = MagicMock()
+        svc._info = {'id': 'sid1', 'name': 'nova', 'type': 'compute'}
+        manager.services_list.return_value = [svc]
+        eps = []
+        for i, (interface, url) in enumerate([('public', 'http://pub'),
+                                              ('admin', 'http://old'),
+                                              ('internal', 'http://int')]):
+            ep = MagicMock()
+            ep._info = {'id': 'eid{}'.format(i), 'service_id': 'sid1',
+                        'region': 'RegionOne', 'interface': interface,
+                        'url': url}
+            eps.append(ep)
+        manager.endpoints_list.return_value = eps
+        manager.resolve_role_id.side_effect = \
+            lambda r, **kwargs: 'rid1' if r == 'Admin' else None
+        manager.resolve_tenant_id.return_value = None
+        manager.resolve_service_id.return_value = None
+        return manager
+
+    def test_diff_identity_state_v3(self):
+        manager = self._catalog_manager(3)
+        state = {
+            'services': {'nova': utils.valid_services['nova'],
+                         'glance': utils.valid_services['glance']},
+            'endpoints': {('nova', 'RegionOne'): {'public': 'http://pub',
+                                                  'admin': 'http://adm',
+                                                  'internal': 'http://int'}},
+            'roles': ['Admin', 'Member'],
+            'projects': [('services', 'service_domain')],
+        }
+        changes = utils.diff_identity_state(manager, state)
+        self.assertEqual(changes, [
+            ('create_service', 'glance', 'image', 'Glance Image Service'),
+            ('delete_endpoint', 'eid1'),
+            ('create_endpoint', 'nova', 'RegionOne', 'admin', 'http://adm'),
+            ('create_role', 'Member'),
+            ('create_project', 'services', 'service_domain')])
+
+    def test_apply_identity_changes(self):
+        manager = MagicMock()
+        manager.resolve_service_id.return_value = 'sid2'
+        utils.apply_identity_changes(manager, [
+            ('create_service', 'glance', 'image', 'Glance Image Service'),
+            ('delete_endpoint', 'eid1'),
+            ('create_endpoint', 'glance', 'RegionOne', 'admin', 'http://adm'),
+            ('create_role', 'Member'),
+            ('create_project', 'services', 'service_domain')])
+        manager.create_service.assert_called_once_with(
+            'glance', 'image', description='Glance Image Service')
+        manager.delete_endpoint.assert_called_once_with('eid1')
+        manager.create_endpoint.assert_called_once_with(
+            'sid2', 'http://adm', interface='admin', region='RegionOne')
+        manager.create_role.assert_called_once_with(name='Member')
+        manager.create_tenant.assert_called_once_with(
+            tenant_name='services', domain='service_domain',
+            description='Created by Juju')
+
+    @patch.object(utils, 'create_user_credentials')
+    @patch.object(utils, 'create_service_credentials')
+    @patch.object(utils, 'apply_identity_changes')
+    @patch.object(utils, 'diff_identity_state')
+    @patch.object(utils, 'collect_desired_identity_state')
+    @patch.object(utils, 'get_manager')
+    def test_reconcile_identity_relations(self, get_manager, collect, diff,
+                                          apply_changes,
+                                          create_service_credentials,
+                                          create_user_credentials):
+        state = {
+            'service_users': {'nova': ['Member']},
+            'credentials_users': {('vault', 'service_domain'): {
+                'tenant': 'services', 'grants': ['Admin'],
+                'new_roles': []}},
+        }
+        units = set([('identity-service:0', 'nova/0')])
+        collect.return_value = (state, units)
+        self.assertEqual(utils.reconcile_identity_relations(), units)
+        diff.assert_called_once_with(get_manager.return_value, state)
+        apply_changes.assert_called_once_with(get_manager.return_value,
+                                              diff.return_value)
+        create_service_credentials.assert_called_once_with(
+            'nova', new_roles=['Member'])
+        create_user_credentials.assert_called_once_with(
+            'vault', utils.get_service_password, utils.set_service_password,
+            tenant='services', new_roles=[], grants=['Admin'],
+            domain='service_domain')
+
+    def test_retry_on_stale_ids(self):
+        cache = self.keystone_id_cache.return_value
+        cache.drop_served.return_value = ['roles//Admin']
+        not_found = Exception('Not Found')
+        not_found.http_status = 404
+        calls = MagicMock(side_effect=[not_found, 'ok'])
+
+        @utils.retry_on_stale_ids
+        def func(*args, **kwargs):
+            return calls(*args, **kwargs)
+
+        self.assertEqual(func('a', b=1), 'ok')
+        cache.drop_served.assert_called_once_with(cache.mark.return_value)
+        calls.assert_has_calls([call('a', b=1), call('a', b=1)])
+
+        cache.drop_served.return_value = []
+        calls.side_effect = not_found
+        calls.reset_mock()
+        with self.assertRaises(Exception):
+            func()
+        self.assertEqual(calls.call_count, 1)
+
+    def test_retry_on_stale_ids_nested(self):
+        not_found = Exception('Not Found')
+        not_found.http_status = 404
+        calls = MagicMock(side_effect=[None, not_found, None, 'ok'])
+
+        @utils.retry_on_stale_ids
+        def inner():
+            return calls()
+
+        @utils.retry_on_stale_ids
+        def outer():
+            calls('outer')
+            return inner()
+
+        self.assertEqual(outer(), 'ok')
+        calls.assert_has_calls([call('outer'), call(),
+                                call('outer'), call()])
+
+    @patch.object(utils, 'get_api_version')
+    @patch.object(utils, 'resolve_address')
+    @patch.object(utils, 'leader_get')
+    @patch.object(utils.unitdata, 'kv')
+    def test_identity_relation_fingerprints(self, kv, leader_get,
+                                            resolve_address,
+                                            get_api_version):
+        kv.return_value = unitdata.Storage(':memory:')
+        leader_settings = {'admin_domain_id': 'did1',
+                           'nova_passwd': 'secret'}
+        leader_get.side_effect = lambda attribute=None: (
+            leader_settings.get(attribute) if attribute
+            else dict(leader_settings))
+        resolve_address.return_value = '10.0.0.1'
+        get_api_version.return_value = 3
+        self.get_admin_token.return_value = 'token'
+        self.https.return_value = False
+        self.relation_ids.side_effect = lambda r: {
+            'identity-service': ['identity-service:0'],
+            'identity-credentials': ['identity-credentials:1']}[r]
+        self.related_units.side_effect = lambda rid: {
+            'identity-service:0': ['nova/0', 'glance/0'],
+            'identity-credentials:1': ['vault/0']}[rid]
+        settings = {
+            'nova/0': {'service': 'nova'},
+            'glance/0': {'service': 'glance'},
+            'vault/0': {'username': 'vault'},
+        }
+        self.relation_get.side_effect = lambda rid, unit: settings[unit]
+        fingerprints = utils.identity_relation_fingerprints()
+        self.assertEqual(len(set(fingerprints.values())), 3)
+        self.assertEqual(utils.changed_identity_relation_units(fingerprints),
+                         set(fingerprints))
+        utils.store_identity_relation_fingerprints(fingerprints)
+        self.assertEqual(utils.changed_identity_relation_units(
+            utils.identity_relation_fingerprints()), set())
+
+        settings['nova/0'] = {'service': 'nova', 'region': 'RegionTwo'}
+        self.assertEqual(utils.changed_identity_relation_units(
+            utils.identity_relation_fingerprints()),
+            set([('identity-service:0', 'nova/0')]))
+        utils.store_identity_relation_fingerprints(
+            utils.identity_relation_fingerprints())
+
+        # a changed service password is republished to every unit
+        leader_settings['nova_passwd'] = 'rotated'
+        fingerprints = utils.identity_relation_fingerprints()
+        self.assertEqual(utils.changed_identity_relation_units(fingerprints),
+                         set(fingerprints))
+
+        self.https.return_value = True
+        del settings['glance/0']
+        self.related_units.side_effect = lambda rid: {
+            'identity-service:0': ['nova/0'],
+            'identity-credentials:1': ['vault/0']}[rid]
+        fingerprints = utils.identity_relation_fingerprints()
+        self.assertEqual(utils.changed_identity_relation_units(fingerprints),
+                         set(fingerprints))
+        utils.store_identity_relation_fingerprints(fingerprints)
+        self.assertEqual(
+            sorted(kv.return_value.getrange(utils.FINGERPRINT_PREFIX,
+                                            strip=True)),
+            ['identity-credentials:1:vault/0',
+             'identity-service:0:nova/0'])
+
+    @patch.object(utils.unitdata, 'kv')
+    def test_prune_and_compact_unit_state(self, kv):
+        db = kv.return_value = unitdata.Storage(':memory:')
+        for i in range(5):
+            with db.hook_scope('hook-{}'.format(i)):
+                db.set('key', i)
+        self.test_config.set('unit-state-keep-revisions', 2)
+        self.test_config.set('unit-state-keep-days', 0)
+        utils.prune_unit_state()
+        self.assertEqual([r[0] for r in db.gethistory('key')], [4, 5])
+        self.assertEqual(db.stats()['hooks'], 2)
+
+        self.test_config.set('unit-state-keep-revisions', 1)
+        before, after = utils.compact_unit_state()
+        self.assertEqual((before['hooks'], before['kv_revisions']), (2, 2))
+        self.assertEqual((after['hooks'], after['kv_revisions']), (1, 1))
+        self.assertEqual(after['kv'], 1)
+
+    @patch.object(utils.unitdata, 'kv')
+    def test_prune_unit_state_disabled(self, kv):
+        db = kv.return_value = unitdata.Storage(':memory:')
+        for i in range(3):
+            with db.hook_scope('hook-{}'.format(i)):
+                db.set('key', i)
+        self.test_config.set('unit-state-keep-revisions', 0)
+        self.test_config.set('unit-state-keep-days', 0)
+        utils.prune_unit_state()
+        self.assertEqual(db.stats()['hooks'], 3)
+
+    @patch.object(utils, 'run_in_apache')
+    def test_restart_coordinator(self, run_in_apache):
+        run_in_apache.return_value = True
+        self.test_config.set('rolling-restart-slots', 2)
+        self.test_config.set('rolling-restart-timeout', 300)
+        coordinator = utils.restart_coordinator()
+        self.assertEqual(coordinator.peer_relation, 'cluster')
+        self.assertEqual(coordinator.slots, 2)
+        self.assertEqual(coordinator.timeout, 300)
+        self.assertEqual(coordinator.restart_functions,
+                         {'apache2': utils.restart_pid_check})
@@ -0,0 +1,444 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import time
+
+from mock import MagicMock, call
+from test_utils import CharmTestCase
+
+import manager
+
+TO_PATCH = [
+    'client',
+    'log',
+    'keystoneclient_v3',
+    'session',
+    'token_endpoint',
+]
+
+
+class FakeResource(object):
+
+    def __init__(self, **info):
+        self._info = info
+        for k, v in info.items():
+            setattr(self, k, v)
+
+
+class FakeCollection(object):
+    """Keystone collection honouring the name and domain query filters
+
+    Names are compared case insensitively, as the SQL backend does, unless
+    case_sensitive is set.
+    """
+
+    def __init__(self, *objects, **kwargs):
+        self.objects = list(objects)
+        self.case_sensitive = kwargs.get('case_sensitive', False)
+        self.list = MagicMock(side_effect=self._list)
+        self.get = MagicMock(side_effect=self._get)
+        self.create = MagicMock()
+        self.delete = MagicMock()
+
+    def _name_matches(self, obj, name):
+        if self.case_sensitive:
+            return obj._info['name'] == name
+        return obj._info['name'].lower() == name.lower()
+
+    def _get(self, obj_id):
+        for o in self.objects:
+            if o._info['id'] == obj_id:
+                return o
+        raise manager.exceptions.NotFound()
+
+    def _list(self, name=None, domain=None, **kwargs):
+        objects = list(self.objects)
+        if name is not None:
+            objects = [o for o in objects if self._name_matches(o, name)]
+        if domain is not None:
+            objects = [o for o in objects
+                       if o._info.get('domain_id') == domain]
+        return objects
+
+
+class TestKeystoneManager3(CharmTestCase):
+
+    def setUp(self):
+        super(TestKeystoneManager3, self).setUp(manager, TO_PATCH)
+        self.api = MagicMock()
+        self.keystoneclient_v3.Client.return_value = self.api
+        self.api.domains = FakeCollection(
+            FakeResource(id='did1', name='default'),
+            FakeResource(id='did2', name='service_domain'))
+        self.api.projects = FakeCollection(
+            FakeResource(id='pid1', name='services', domain_id='did1'),
+            FakeResource(id='pid2', name='services', domain_id='did2'))
+        self.api.users = FakeCollection(
+            FakeResource(id='uid1', name='Nova', domain_id='did1'),
+            FakeResource(id='uid2', name='nova', domain_id='did2'))
+        self.api.roles = FakeCollection(
+            FakeResource(id='rid1', name='Admin'))
+        self.manager = manager.KeystoneManager3('http://localhost/v3',
+                                                'token')
+
+    def test_resolve_without_snapshot(self):
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'Services', domain='service_domain'), 'pid2')
+        self.api.projects.list.assert_called_with(name='Services',
+                                                  domain='did2')
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'services', domain='missing'), None)
+        self.assertEqual(self.manager.resolve_role_id('admin'), 'rid1')
+        self.manager.resolve_role_id('admin')
+        self.assertEqual(self.api.roles.list.call_count, 2)
+
+    def test_resolve_user_id_filters_by_domain(self):
+        self.assertEqual(
+            self.manager.resolve_user_id('NOVA', user_domain='default'),
+            'uid1')
+        self.api.users.list.assert_called_with(name='NOVA', domain='did1')
+        self.assertEqual(self.manager.resolve_user_id('nova'), 'uid1')
+        self.api.users.list.assert_called_with(name='nova')
+        self.assertEqual(
+            self.manager.resolve_user_id('nova', user_domain='missing'),
+            None)
+
+    def test_resolve_miss_not_listed(self):
+        self.assertEqual(self.manager.resolve_role_id('missing'), None)
+        self.assertEqual(
+            self.manager.resolve_user_id('glance', user_domain='default'),
+            None)
+        # a miss is an absent object, the collections are not listed
+        self.api.roles.list.assert_called_once_with(name='missing')
+        self.api.users.list.assert_called_once_with(name='glance',
+                                                    domain='did1')
+
+    def test_resolve_case_sensitive_backend(self):
+        self.api.roles = FakeCollection(
+            FakeResource(id='rid1', name='Admin'), case_sensitive=True)
+        self.assertEqual(self.manager.resolve_role_id('Admin'), 'rid1')
+        # keystone decides how names match
+        self.assertEqual(self.manager.resolve_role_id('admin'), None)
+        self.assertEqual(self.api.roles.list.call_args_list,
+                         [call(name='Admin'), call(name='admin')])
+
+    def test_resolve_falls_back_when_filter_rejected(self):
+        objects = self.api.users.objects
+
+        def _list(name=None, domain=None, **kwargs):
+            if name is not None:
+                raise manager.exceptions.BadRequest()
+            return [o for o in objects
+                    if domain is None or o._info['domain_id'] == domain]
+
+        self.api.users.list.side_effect = _list
+        self.assertEqual(
+            self.manager.resolve_user_id('NOVA', user_domain='default'),
+            'uid1')
+        self.assertEqual(
+            self.manager.resolve_user_id('nova', user_domain='default'),
+            'uid1')
+        self.api.users.list.assert_called_with(domain='did1')
+        self.assertEqual(self.api.users.list.call_count, 3)
+
+    def test_snapshot_remembers_lookups(self):
+        self.manager.enable_snapshot()
+        for _ in range(3):
+            self.assertEqual(
+                self.manager.resolve_user_id('nova',
+                                             user_domain='service_domain'),
+                'uid2')
+            self.assertEqual(
+                self.manager.resolve_tenant_id('services',
+                                               domain='default'),
+                'pid1')
+        self.assertEqual(self.api.users.list.call_count, 1)
+        self.assertEqual(self.api.projects.list.call_count, 1)
+        self.assertEqual(self.api.domains.list.call_count, 2)
+
+    def test_snapshot_tracks_creates_and_deletes(self):
+        self.manager.enable_snapshot()
+        self.api.roles.create.return_value = FakeResource(id='rid2',
+                                                          name='Member')
+        self.assertEqual(self.manager.resolve_role_id('member'), None)
+        self.manager.create_role(name='Member')
+        self.assertEqual(self.manager.resolve_role_id('member'), 'rid2')
+
+        self.api.projects.create.return_value = FakeResource(
+            id='pid3', name='admin', domain_id='did2')
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'admin', domain='service_domain'), None)
+        self.manager.create_tenant('admin', 'desc', domain='service_domain')
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'admin', domain='service_domain'), 'pid3')
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'admin', domain='default'), None)
+        self.manager.delete_tenant('pid3')
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'admin', domain='service_domain'), None)
+        # misses are remembered, creates and deletes update them
+        self.assertEqual(self.api.roles.list.call_count, 1)
+        self.assertEqual(self.api.projects.list.call_count, 2)
+
+    def test_snapshot_user_in_two_domains(self):
+        self.manager.enable_snapshot()
+        self.manager.unfiltered_collections.add('users')
+        self.assertEqual(
+            self.manager.resolve_user_id('nova',
+                                         user_domain='service_domain'),
+            'uid2')
+        self.assertEqual(
+            self.manager.resolve_user_id('nova', user_domain='default'),
+            'uid1')
+        self.assertEqual(
+            [u.id for u in self.manager._list('users', domain='did2')],
+            ['uid2'])
+        self.assertEqual(
+            [u.id for u in self.manager._list('users', domain=None)],
+            ['uid1', 'uid2'])
+        self.assertEqual(self.api.users.list.call_count, 1)
+
+    def test_shared_snapshot(self):
+        snapshot = manager.KeystoneSnapshot()
+        self.manager.enable_snapshot(snapshot)
+        other = manager.KeystoneManager3('http://localhost/v3', 'token')
+        other.enable_snapshot(snapshot)
+        self.manager.resolve_role_id('admin')
+        self.assertEqual(other.resolve_role_id('Admin'), 'rid1')
+        self.assertEqual(self.api.roles.list.call_count, 1)
+        snapshot.invalidate('roles')
+        other.resolve_role_id('Admin')
+        self.assertEqual(self.api.roles.list.call_count, 2)
+
+    def test_create_endpoints(self):
+        create = self.api.endpoints.create
+        self.manager.create_endpoints('RegionOne', 'sid1', 'http://pub',
+                                      'http://adm', 'http://int')
+        create.assert_has_calls([
+            call('sid1', 'http://pub', interface='public', region='RegionOne'),
+            call('sid1', 'http://adm', interface='admin', region='RegionOne'),
+            call('sid1', 'http://int', interface='internal',
+                 region='RegionOne'),
+        ], any_order=True)
+
+    def test_batch_runs_concurrently(self):
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def _call(i):
+            with lock:
+                in_flight.append(i)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(i)
+            return i
+
+        calls = [lambda i=i: _call(i) for i in range(6)]
+        self.assertEqual(self.manager.batch(calls, workers=3), range(6))
+        self.assertEqual(max(peak), 3)
+
+    def test_batch_nested_runs_inline(self):
+        threads = []
+
+        def _inner():
+            threads.append(threading.current_thread())
+
+        def _outer():
+            self.manager.batch([_inner, _inner])
+            return threading.current_thread()
+
+        outer = self.manager.batch([_outer, _outer])
+        self.assertEqual(len(threads), 4)
+        self.assertEqual(set(threads), set(outer))
+
+    def test_batch_errors(self):
+        ran = []
+
+        def _fail(msg):
+            ran.append(msg)
+            raise ValueError(msg)
+
+        with self.assertRaisesRegexp(ValueError, 'first'):
+            self.manager.batch([lambda: ran.append('ok'),
+                                lambda: _fail('first'),
+                                lambda: _fail('second')])
+        self.assertEqual(sorted(ran), ['first', 'ok', 'second'])
+        self.assertEqual(self.log.call_count, 2)
+        self.assertIn('first', self.log.call_args_list[0][0][0])
+        self.assertIn('second', self.log.call_args_list[1][0][0])
+
+        with self.assertRaises(SystemExit):
+            self.manager.batch([lambda: ran.append('ok'),
+                                lambda: sys.exit(1)])
+
+    def test_find_endpoint_v3(self):
+        self.api.endpoints.list.return_value = [
+            FakeResource(id='eid1', service_id='sid1', region='RegionOne',
+                         interface='public', url='http://a'),
+            FakeResource(id='eid2', service_id='sid1', region='RegionOne',
+                         interface='admin', url='http://b')]
+        self.manager.enable_snapshot()
+        self.assertTrue(self.manager.delete_old_endpoint_v3(
+            'public', 'sid1', 'RegionOne', 'http://c'))
+        self.api.endpoints.delete.assert_called_with('eid1')
+        self.assertEqual(
+            self.manager.find_endpoint_v3('public', 'sid1', 'RegionOne'), [])
+        self.assertEqual(self.api.endpoints.list.call_count, 1)
+
+
+class TestKeystoneIdCache(CharmTestCase):
+
+    def setUp(self):
+        super(TestKeystoneIdCache, self).setUp(
+            manager, TO_PATCH + ['unitdata'])
+        self.kv = {}
+        self.unitdata.kv.return_value.get.side_effect = \
+            lambda k, default=None: self.kv.get(k, default)
+        self.unitdata.kv.return_value.set.side_effect = \
+            self.kv.__setitem__
+        self.api = MagicMock()
+        self.keystoneclient_v3.Client.return_value = self.api
+        self.api.domains = FakeCollection(
+            FakeResource(id='did1', name='default'))
+        self.api.projects = FakeCollection(
+            FakeResource(id='pid1', name='services', domain_id='did1'))
+        self.api.roles = FakeCollection(
+            FakeResource(id='rid1', name='Admin'))
+        self.manager = manager.KeystoneManager3('http://localhost/v3',
+                                                'token')
+
+    def test_resolve_through_cache(self):
+        self.manager.enable_id_cache(manager.KeystoneIdCache(scope='True'))
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'services', domain='default'), 'pid1')
+        self.assertEqual(self.manager.resolve_role_id('Admin'), 'rid1')
+        self.assertEqual(self.manager.resolve_role_id('Member'), None)
+        self.manager.id_cache.save()
+        self.assertEqual(self.kv[manager.ID_CACHE_KEY], {
+            'scope': 'True',
+            'ids': {'domains//default': 'did1',
+                    'projects/default/services': 'pid1',
+                    'roles//Admin': 'rid1'}})
+
+        self.manager.enable_id_cache(manager.KeystoneIdCache(scope='True'))
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'services', domain='default'), 'pid1')
+        self.assertEqual(self.manager.resolve_role_id('Admin'), 'rid1')
+        self.assertEqual(self.api.projects.list.call_count, 1)
+        self.assertEqual(self.api.domains.list.call_count, 1)
+        # Admin once, then the Member miss
+        self.assertEqual(self.api.roles.list.call_count, 2)
+
+    def test_scope_change_empties_cache(self):
+        self.kv[manager.ID_CACHE_KEY] = {'scope': None,
+                                         'ids': {'roles//Admin': 'rid0'}}
+        cache = manager.KeystoneIdCache(scope='True')
+        self.assertEqual(cache.get('roles', 'Admin'), None)
+        cache.save()
+        self.assertEqual(self.kv[manager.ID_CACHE_KEY],
+                         {'scope': 'True', 'ids': {}})
+
+    def test_drop_served(self):
+        cache = manager.KeystoneIdCache()
+        cache.set('roles', 'Admin', None, 'rid1')
+        cache.set('domains', 'default', None, 'did1')
+        cache.get('domains', 'default')
+        mark = cache.mark()
+        cache.get('roles', 'Admin')
+        cache.get('roles', 'Member')
+        self.assertEqual(cache.drop_served(mark), ['roles//Admin'])
+        self.assertEqual(cache.get('roles', 'Admin'), None)
+        self.assertEqual(cache.get('domains', 'default'), 'did1')
+
+    def test_verify_cached_ids(self):
+        self.kv[manager.ID_CACHE_KEY] = {
+            'scope': 'True', 'ids': {'roles//Admin': 'rid0',
+                                     'projects/default/services': 'pid1'}}
+        self.manager.enable_id_cache(manager.KeystoneIdCache(scope='True'))
+        # the role was deleted and recreated outside of the charm
+        self.assertEqual(self.manager.resolve_role_id('Admin'), 'rid0')
+        self.assertEqual(self.manager.resolve_role_id('Admin', verify=True),
+                         'rid1')
+        self.api.roles.get.assert_called_once_with('rid0')
+        self.assertEqual(self.manager.resolve_tenant_id(
+            'services', domain='default', verify=True), 'pid1')
+        self.api.projects.get.assert_called_once_with('pid1')
+        self.assertEqual(self.api.projects.list.call_count, 0)
+        self.api.roles.objects = []
+        self.assertEqual(self.manager.resolve_role_id('Admin', verify=True),
+                         None)
+        self.assertEqual(self.manager.id_cache.get('roles', 'Admin'), None)
+
+    def test_deleted_objects_dropped(self):
+        self.manager.enable_id_cache(manager.KeystoneIdCache())
+        self.manager.resolve_tenant_id('services', domain='default')
+        self.manager.delete_tenant('pid1')
+        self.assertEqual(
+            self.manager.id_cache.get('projects', 'services', 'default'),
+            None)
+
+
+class TestGetKeystoneManager(CharmTestCase):
+
+    def setUp(self):
+        super(TestGetKeystoneManager, self).setUp(
+            manager, TO_PATCH + ['unitdata'])
+        manager.reset_keystone_managers()
+        self.addCleanup(manager.reset_keystone_managers)
+        self.kv = {}
+        self.unitdata.kv.return_value.get.side_effect = \
+            lambda k, default=None: self.kv.get(k, default)
+        self.unitdata.kv.return_value.set.side_effect = \
+            self.kv.__setitem__
+        self.api = MagicMock()
+        self.api.services.list.return_value = [
+            FakeResource(id='sid1', type='identity')]
+        self.api.endpoints.list.return_value = [
+            FakeResource(id='eid1', service_id='sid1', interface='admin',
+                         url='http://localhost/v3')]
+        self.keystoneclient_v3.Client.return_value = self.api
+
+    def test_manager_reused(self):
+        m = manager.get_keystone_manager('http://localhost/v3/', 'token', 3)
+        self.assertIs(
+            manager.get_keystone_manager('http://localhost/v3/', 'token', 3),
+            m)
+        self.assertIsNot(
+            manager.get_keystone_manager('http://localhost/v3/', 'new', 3),
+            m)
+        self.assertEqual(self.keystoneclient_v3.Client.call_count, 2)
+
+    def test_discovered_version_persisted(self):
+        m = manager.get_keystone_manager('http://localhost/v3/', 'token')
+        self.assertEqual(m.api_version, 3)
+        self.assertEqual(self.kv[manager.API_VERSION_KEY],
+                         {'http://localhost/v3/': 3})
+        self.assertEqual(self.api.services.list.call_count, 1)
+        manager.reset_keystone_managers()
+        m = manager.get_keystone_manager('http://localhost/v3/', 'token')
+        self.assertEqual(m.api_version, 3)
+        self.assertEqual(self.api.services.list.call_count, 1)
+
+    def test_redirected_version_not_persisted(self):
+        self.api.endpoints.list.return_value = [
+            FakeResource(id='eid1', service_id='sid1',
+                         adminurl='http://localhost/v2.0')]
+        m = manager.get_keystone_manager('http://localhost/v3/', 'token')
+        self.assertEqual(m.api_version, 2)
+        self.assertEqual(m.endpoint, 'http://localhost/v2.0')
+        self.assertFalse(self.kv)